@@ -3,11 +3,10 @@
 
 import json
 import logging
-import xml.etree.cElementTree as etree
-from typing import Any, Dict, List, Union
+import re
+from typing import Any, Callable, Dict, Iterator, List, Union
 
-import six
-from six import BytesIO
+import msgspec
 from werkzeug.wrappers import Request, Response
 
 from acoustid.handler import Handler
@@ -17,62 +16,148 @@ from acoustid.utils import singular
 logger = logging.getLogger(__name__)
 
 
-def _serialize_xml_node(parent, data):
-    # type: (etree.Element, Union[List[Any], Dict[str, Any], int, float, str]) -> None
-    if isinstance(data, dict):
-        _serialize_xml_dict(parent, data)
-    elif isinstance(data, list):
-        _serialize_xml_list(parent, data)
-    else:
-        parent.text = six.text_type(data)
+# Number of strings to collect before an XML response chunk is emitted
+XML_CHUNK_PARTS = 4096
+
+
+def _escape_xml_text(text: str) -> str:
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def _escape_xml_attrib(text: str) -> str:
+    text = _escape_xml_text(text)
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+
+def iter_xml(data: Union[List[Any], Dict[str, Any]]) -> Iterator[bytes]:
+    """Encode a response as an XML document, in chunks.
+
+    Dict items become child elements, or attributes if their name starts
+    with "@", in the order of their names. List items become child elements
+    named after the singular of the list's name.
+    """
+    parts = ["<?xml version='1.0' encoding='UTF-8'?>\n"]
+    # (name, value) of an element to write, or the end tag of an open element
+    stack: List[Any] = [("response", data)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        name, value = item
+        if isinstance(value, dict):
+            parts.append("<" + name)
+            children = []
+            for key, child in sorted(value.items()):
+                if key.startswith("@"):
+                    parts.append(' %s="%s"' % (key[1:], _escape_xml_attrib(str(child))))
+                else:
+                    children.append((key, child))
+        elif isinstance(value, list):
+            parts.append("<" + name)
+            child_name = singular(name)
+            children = [(child_name, child) for child in value]
+        else:
+            text = str(value)
+            if text:
+                parts.append("<%s>%s</%s>" % (name, _escape_xml_text(text), name))
+            else:
+                parts.append("<%s />" % name)
+            children = None
+        if children:
+            parts.append(">")
+            stack.append("</%s>" % name)
+            stack.extend(reversed(children))
+        elif children is not None:
+            parts.append(" />")
+        if len(parts) >= XML_CHUNK_PARTS:
+            yield "".join(parts).encode("utf-8", "xmlcharrefreplace")
+            parts = []
+    yield "".join(parts).encode("utf-8", "xmlcharrefreplace")
 
 
-def _serialize_xml_dict(parent, data):
-    # type: (etree.Element, Dict[str, Any]) -> None
-    for name, value in sorted(data.items()):
-        if name.startswith("@"):
-            parent.attrib[name[1:]] = six.text_type(value)
-        else:
-            elem = etree.SubElement(parent, name)
-            _serialize_xml_node(elem, value)
+def serialize_xml(data, **kwargs):
+    # type: (Union[List[Any], Dict[str, Any]], **Any) -> Response
+    return Response(iter_xml(data), content_type="text/xml; charset=UTF-8", **kwargs)
 
 
-def _serialize_xml_list(parent, data):
-    # type: (etree.Element, List[Any]) -> None
-    name = singular(parent.tag)
-    for item in data:
-        elem = etree.SubElement(parent, name)
-        _serialize_xml_node(elem, item)
+_msgspec_json_encoder = msgspec.json.Encoder(order="sorted")
 
+_non_ascii_re = re.compile("[^\x00-\x7e]")
 
-def serialize_xml(data, **kwargs):
-    # type: (Union[List[Any], Dict[str, Any]], **Any) -> Response
-    root = etree.Element("response")
-    _serialize_xml_node(root, data)
-    tree = etree.ElementTree(root)
-    res = BytesIO()
-    tree.write(res, encoding="UTF-8", xml_declaration=True)
-    return Response(res.getvalue(), content_type="text/xml; charset=UTF-8", **kwargs)
+
+def _escape_non_ascii(match: "re.Match[str]") -> str:
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return "\\u%04x" % code
+    code -= 0x10000
+    return "\\u%04x\\u%04x" % (0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+
+
+def encode_json_stdlib(data: Any) -> bytes:
+    return json.dumps(data, sort_keys=True).encode("ascii")
+
+
+def encode_json_msgspec(data: Any) -> bytes:
+    """Encode the same bytes as encode_json_stdlib, except for floats in
+    exponent notation, e.g. 0.00001 and 1e16 instead of 1e-05 and 1e+16,
+    and NaN or infinity, which are written as null."""
+    res = msgspec.json.format(_msgspec_json_encoder.encode(data), indent=0)
+    # DEL is ASCII, but the standard library escapes it as well.
+    if not res.isascii() or b"\x7f" in res:
+        res = _non_ascii_re.sub(_escape_non_ascii, res.decode("utf-8")).encode("ascii")
+    return res
+
+
+def encode_json_msgspec_compact(data: Any) -> bytes:
+    """Encode with sorted keys, but without spaces and with non-ASCII
+    characters written as UTF-8 instead of escapes."""
+    return _msgspec_json_encoder.encode(data)
+
+
+JSON_ENCODERS: Dict[str, Callable[[Any], bytes]] = {
+    "json": encode_json_stdlib,
+    "msgspec": encode_json_msgspec,
+    "msgspec_compact": encode_json_msgspec_compact,
+}
 
 
-def serialize_json(data, callback=None, **kwargs):
-    # type: (Union[List[Any], Dict[str, Any], int, float, str], str | None, **Any) -> Response
-    res = json.dumps(data, sort_keys=True)
+def serialize_json(data, callback=None, json_encoder="json", **kwargs):
+    # type: (Union[List[Any], Dict[str, Any], int, float, str], str | None, str, **Any) -> Response
+    try:
+        encode = JSON_ENCODERS[json_encoder]
+    except KeyError:
+        raise ValueError("unknown JSON encoder %r" % json_encoder)
+    res = encode(data)
     if callback:
-        res = "%s(%s)" % (callback, res)
+        res = b"%s(%s)" % (callback.encode("ascii"), res)
         mime = "application/javascript; charset=UTF-8"
     else:
         mime = "application/json; charset=UTF-8"
     return Response(res, content_type=mime, **kwargs)
 
 
-def serialize_response(data, format, **kwargs):
-    # type: (Union[List[Any], Dict[str, Any]], str, **Any) -> Response
+def serialize_response(data, format, json_encoder="json", **kwargs):
+    # type: (Union[List[Any], Dict[str, Any]], str, str, **Any) -> Response
     if format == "json":
-        return serialize_json(data, **kwargs)
+        return serialize_json(data, json_encoder=json_encoder, **kwargs)
     elif format.startswith("jsonp:"):
         func = format.split(":", 1)[1]
-        return serialize_json(data, callback=func, **kwargs)
+        return serialize_json(data, callback=func, json_encoder=json_encoder, **kwargs)
     else:
         return serialize_xml(data, **kwargs)
 
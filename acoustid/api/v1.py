@@ -52,6 +52,7 @@ class LookupHandlerParams(v2.LookupHandlerParams):
 class LookupHandler(v2.LookupHandler):
     params_class = LookupHandlerParams
     recordings_name = "tracks"
+    endpoint = "v1.lookup"
 
 
 class SubmitHandlerParams(v2.SubmitHandlerParams):
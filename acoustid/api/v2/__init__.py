@@ -24,6 +24,7 @@ from typing import (
 
 import attr
 import cachetools
+from sqlalchemy.exc import OperationalError
 from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 from werkzeug.wrappers import Request, Response
@@ -43,11 +44,12 @@ from acoustid.data.musicbrainz import lookup_metadata
 from acoustid.data.stats import update_lookup_counter, update_user_agent_counter
 from acoustid.data.submission import insert_submission, lookup_submission_status
 from acoustid.data.track import lookup_mbids, lookup_meta_ids, resolve_track_gid
-from acoustid.db import DatabaseContext
+from acoustid.db import DatabaseContext, is_statement_timeout, set_statement_timeout
+from acoustid.deadline import Deadline
 from acoustid.handler import Handler
 from acoustid.ratelimiter import RateLimiter
 from acoustid.tasks import enqueue_task
-from acoustid.tracing import initialize_trace_id
+from acoustid.tracing import get_spans, initialize_spans, initialize_trace_id, span
 from acoustid.utils import check_demo_client_api_key, is_foreignid, is_uuid
 
 if TYPE_CHECKING:
@@ -63,11 +65,34 @@ DEMO_APPLICATION_ID = 2
 
 MAX_META_IDS_PER_TRACK = 10
 
+# A missing MBID is checked by the merge_missing_mbid task at most this
+# often, however many lookups return it.
+MISSING_MBID_TASK_INTERVAL = 60 * 60
+
 MAX_FINGERPRINT_QUERIES_PER_REQUEST = 20  # temporary, decreate to 10 or less later
 MAX_TRACK_QUERIES_PER_REQUEST = 100
 
 MAX_RESULTS_PER_FINGERPRINT_QUERY = 10
 
+# Meta flags that are reported in metrics, anything else a client sends is
+# left out to keep the number of tag values bounded.
+METRICS_META_FLAGS = frozenset(
+    [
+        "compress",
+        "isrcs",
+        "m2",
+        "recordingids",
+        "recordings",
+        "releasegroupids",
+        "releasegroups",
+        "releaseids",
+        "releases",
+        "sources",
+        "tracks",
+        "usermeta",
+    ]
+)
+
 
 def iter_args_suffixes(args: dict, *prefixes: str) -> Iterable[str]:
     results: set[int] = set()
@@ -162,13 +187,20 @@ class APIHandler(Handler):
     def _error(self, code, message, format=DEFAULT_FORMAT, status=400):
         # type: (int, str, str, int) -> Response
         response_data = {"status": "error", "error": {"code": code, "message": message}}
-        return serialize_response(response_data, format, status=status)
+        return serialize_response(
+            response_data,
+            format,
+            json_encoder=self.ctx.config.website.json_encoder,
+            status=status,
+        )
 
     def _ok(self, data, format=DEFAULT_FORMAT):
         # type: (Dict[str, Any], str) -> Response
         response_data = {"status": "ok"}
         response_data.update(data)
-        return serialize_response(response_data, format)
+        return serialize_response(
+            response_data, format, json_encoder=self.ctx.config.website.json_encoder
+        )
 
     def _count_rate_limited(self, bucket, application_id=None):
         # type: (str, Optional[int]) -> None
@@ -254,6 +286,8 @@ class APIHandler(Handler):
 
     def _handle_inside_context(self, req: Request) -> Response:
         initialize_trace_id()
+        initialize_spans()
+        self.deadline = Deadline(self.ctx.config.website.request_timeout)
         params = self.params_class(self.ctx.config)
         if req.access_route:
             self.user_ip = req.access_route[0]
@@ -267,7 +301,8 @@ class APIHandler(Handler):
             t0 = time.time()
             try:
                 try:
-                    params.parse(req.values, self.ctx.db)
+                    with span("parse"):
+                        params.parse(req.values, self.ctx.db)
                     self.ctx.db.session.close()
                     application_id = getattr(params, "application_id", None)
                     if self.ctx.statsd is not None:
@@ -277,8 +312,11 @@ class APIHandler(Handler):
                             )
                         )
                     if not self._is_cluster_request(req):
-                        self._rate_limit(self.user_ip, application_id)
-                    return self._ok(self._handle_internal(params), params.format)
+                        with span("rate_limit"):
+                            self._rate_limit(self.user_ip, application_id)
+                    response_data = self._handle_internal(params)
+                    with span("serialize"):
+                        return self._ok(response_data, params.format)
                 except errors.WebServiceError:
                     raise
                 except RequestEntityTooLarge:
@@ -305,6 +343,7 @@ class APIHandler(Handler):
                         "api.request_duration_seconds,request={}".format(request_type),
                         1000 * (t1 - t0),
                     )
+                self._report_spans(request_type, params, t1 - t0)
         except errors.WebServiceError as e:
             if self.ctx.statsd is not None:
                 self.ctx.statsd.incr(
@@ -316,6 +355,37 @@ class APIHandler(Handler):
                 e.code, e.message, getattr(params, "format", "unknown"), status=e.status
             )
 
+    def _report_spans(
+        self, request_type: str, params: APIHandlerParams, duration: float
+    ) -> None:
+        """Send the time spent in each stage, and log it for slow requests."""
+        stages = get_spans()
+        if not stages:
+            return
+        meta_flags = set(getattr(params, "meta", None) or []) & METRICS_META_FLAGS
+        meta = "+".join(sorted(meta_flags)) or "none"
+        if self.ctx.statsd is not None:
+            statsd = self.ctx.statsd.pipeline()
+            for stage, stage_duration in stages.items():
+                statsd.timing(
+                    f"api.stage_duration_seconds,request={request_type},meta={meta},stage={stage}",
+                    1000 * stage_duration,
+                )
+            statsd.send()
+        threshold = self.ctx.config.website.slow_request_threshold
+        if threshold > 0 and duration >= threshold:
+            logger.warning(
+                "Slow %s request took %.3f seconds",
+                request_type,
+                duration,
+                extra={
+                    "request": request_type,
+                    "meta": meta,
+                    "duration": round(duration, 4),
+                    "stages": {k: round(v, 4) for k, v in stages.items()},
+                },
+            )
+
     def _handle_internal(self, params):
         # type: (APIHandlerParams) -> Dict[str, Any]
         raise NotImplementedError(self._handle_internal)
@@ -399,6 +469,8 @@ class LookupHandlerParams(APIHandlerParams):
 class LookupHandler(APIHandler):
     params_class = LookupHandlerParams
     recordings_name = "recordings"
+    # Name of the endpoint in per-endpoint settings
+    endpoint = "v2.lookup"
 
     def check_for_missing_recordings(
         self, expected_mbids: Iterable[str], meta: List[Dict[str, Any]]
@@ -407,15 +479,23 @@ class LookupHandler(APIHandler):
         if missing_mbids:
             for mbid in missing_mbids:
                 logger.debug("Missing metadata for MBID %s", mbid)
-                enqueue_task(self.ctx, "merge_missing_mbid", {"mbid": str(mbid)})
+                enqueue_task(
+                    self.ctx,
+                    "merge_missing_mbid",
+                    {"mbid": str(mbid)},
+                    dedup_ttl=MISSING_MBID_TASK_INTERVAL,
+                )
 
     def _inject_recording_ids_internal(self, add=True, add_sources=False):
         # type: (bool, bool) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[int, List[str]]]
         el_recording = {}  # type: Dict[str, List[Dict[str, Any]]]
         res_map = {}  # type: Dict[int, List[str]]
-        track_mbid_map = lookup_mbids(
-            self.ctx.db.get_fingerprint_db(read_only=True), self.el_result.keys()
-        )
+        with span("lookup_mbids"):
+            track_mbid_map = lookup_mbids(
+                self.ctx.db.get_fingerprint_db(read_only=True),
+                self.el_result.keys(),
+                cache=self.ctx.track_mapping_cache,
+            )
         for track_id, mbids in track_mbid_map.items():
             res_map[track_id] = []
             for mbid, sources in mbids:
@@ -434,11 +514,13 @@ class LookupHandler(APIHandler):
     def _inject_user_meta_ids_internal(self, add=True):
         # type: (bool) -> Tuple[Dict[int, List[Dict[str, Any]]], Dict[int, List[int]]]
         el_recording = {}  # type: Dict[int, List[Dict[str, Any]]]
-        track_meta_map = lookup_meta_ids(
-            self.ctx.db.get_fingerprint_db(read_only=True),
-            self.el_result.keys(),
-            max_ids_per_track=MAX_META_IDS_PER_TRACK,
-        )
+        with span("lookup_meta_ids"):
+            track_meta_map = lookup_meta_ids(
+                self.ctx.db.get_fingerprint_db(read_only=True),
+                self.el_result.keys(),
+                max_ids_per_track=MAX_META_IDS_PER_TRACK,
+                cache=self.ctx.track_mapping_cache,
+            )
         for track_id, meta_ids in track_meta_map.items():
             for meta_id in meta_ids:
                 if add:
@@ -564,8 +646,7 @@ class LookupHandler(APIHandler):
         if "releasegroupids" in meta or "releasegroups" in meta:
             load_releases = True
             load_release_groups = True
-        metadata = lookup_metadata(
-            self.ctx.db.get_musicbrainz_db(read_only=True),
+        metadata = self._lookup_metadata(
             recording_els.keys(),
             load_releases=load_releases,
             load_release_groups=load_release_groups,
@@ -575,9 +656,10 @@ class LookupHandler(APIHandler):
         if "usermeta" in meta and not metadata:
             user_meta_els = self._inject_user_meta_ids_internal(True)[0]
             recording_els.update(user_meta_els)  # type: ignore
-            user_meta = lookup_meta(
-                self.ctx.db.get_fingerprint_db(read_only=True), user_meta_els.keys()
-            )
+            with span("lookup_meta"):
+                user_meta = lookup_meta(
+                    self.ctx.db.get_fingerprint_db(read_only=True), user_meta_els.keys()
+                )
             metadata.extend(user_meta)
         for recording, recording_metadata in self._group_recordings(
             metadata, "recordingids" in meta
@@ -663,8 +745,7 @@ class LookupHandler(APIHandler):
     def inject_releases(self, meta):
         # type: (List[str]) -> None
         recording_els, track_mbid_map = self._inject_recording_ids_internal(False)
-        metadata = lookup_metadata(
-            self.ctx.db.get_musicbrainz_db(read_only=True),
+        metadata = self._lookup_metadata(
             recording_els.keys(),
             load_releases=True,
             load_release_groups=True,
@@ -679,8 +760,7 @@ class LookupHandler(APIHandler):
     def inject_release_groups(self, meta):
         # type: (List[str]) -> None
         recording_els, track_mbid_map = self._inject_recording_ids_internal(False)
-        metadata = lookup_metadata(
-            self.ctx.db.get_musicbrainz_db(read_only=True),
+        metadata = self._lookup_metadata(
             recording_els.keys(),
             load_releases=True,
             load_release_groups=True,
@@ -692,15 +772,41 @@ class LookupHandler(APIHandler):
             for result_el in self.el_result[track_id]:
                 result_el.update(result)
 
+    def _lookup_metadata(self, recording_ids, **kwargs):
+        # type: (Iterable[str], Any) -> List[Dict[str, Any]]
+        document_db = None
+        if self.ctx.config.website.recording_documents:
+            document_db = self.ctx.db.get_fingerprint_db(read_only=True)
+        with span("lookup_metadata"):
+            return lookup_metadata(
+                self.ctx.db.get_musicbrainz_db(read_only=True),
+                recording_ids,
+                cache=self.ctx.metadata_cache,
+                document_db=document_db,
+                json_aggregation=self.ctx.config.website.metadata_json_aggregation,
+                deadline=self.deadline,
+                **kwargs,
+            )
+
+    def _index_metadata(self, metadata):
+        # type: (List[Dict[str, Any]]) -> Dict[str, List[int]]
+        """Positions of the metadata rows of each recording, in one pass."""
+        index = {}  # type: Dict[str, List[int]]
+        for i, item in enumerate(metadata):
+            index.setdefault(item["recording_id"], []).append(i)
+        return index
+
     def _group_metadata(self, metadata, track_mbid_map):
         # type: (List[Dict[str, Any]], Dict[int, List[str]]) -> Iterable[Tuple[int, List[Dict[str, Any]]]]
+        index = self._index_metadata(metadata)
         results = {}  # type: Dict[int, List[Dict[str, Any]]]
         for track_id, mbids in track_mbid_map.items():
-            mbids_set = set(mbids)
-            results[track_id] = []
-            for item in metadata:
-                if item["recording_id"] in mbids_set:
-                    results[track_id].append(item)
+            positions = []  # type: List[int]
+            for mbid in set(mbids):
+                positions.extend(index.get(mbid, ()))
+            # Keep the rows in their original order, like a scan would.
+            positions.sort()
+            results[track_id] = [metadata[i] for i in positions]
         return results.items()
 
     def _group_release_groups(self, metadata, only_ids=False):
@@ -754,30 +860,23 @@ class LookupHandler(APIHandler):
 
     def inject_m2(self, meta):
         el_recording = self._inject_recording_ids_internal(True)[0]
-        metadata = lookup_metadata(
-            self.ctx.db.get_musicbrainz_db(read_only=True),
+        metadata = self._lookup_metadata(
             el_recording.keys(),
             load_releases=True,
         )
         self.check_for_missing_recordings(el_recording.keys(), metadata)
-        last_recording_id = None
-        for item in metadata:
-            if last_recording_id != item["recording_id"]:
-                recording = self.extract_recording(item, True)
-                last_recording_id = item["recording_id"]
-                for el in el_recording[last_recording_id]:
-                    if item["recording_duration"]:
-                        recording["duration"] = float(item["recording_duration"])
-                    recording["tracks"] = []
-                    el.update(recording)
-        metadata = sorted(
-            metadata,
-            key=operator.itemgetter(
-                "recording_id", "release_id", "medium_position", "track_position"
-            ),
+        track_key = operator.itemgetter(
+            "release_id", "medium_position", "track_position"
         )
-        for item in metadata:
-            for el in el_recording[item["recording_id"]]:
+        for recording_id, positions in self._index_metadata(metadata).items():
+            items = [metadata[i] for i in positions]
+            recording = self.extract_recording(items[0], True)
+            if items[0]["recording_duration"]:
+                recording["duration"] = float(items[0]["recording_duration"])
+            # Only the rows of one recording need sorting.
+            items.sort(key=track_key)
+            tracks = []
+            for item in items:
                 medium = {
                     "track_count": item["medium_track_count"],
                     "position": item["medium_position"],
@@ -788,7 +887,7 @@ class LookupHandler(APIHandler):
                 }
                 if item["medium_format"]:
                     medium["format"] = item["medium_format"]
-                el["tracks"].append(
+                tracks.append(
                     {
                         "title": item["track_title"],
                         "duration": float(item["track_duration"]),
@@ -797,6 +896,9 @@ class LookupHandler(APIHandler):
                         "medium": medium,
                     }
                 )
+            for el in el_recording[recording_id]:
+                el.update(recording)
+                el["tracks"] = list(tracks)
 
     def inject_metadata(self, meta, result_map):
         self.el_result = result_map
@@ -815,6 +917,61 @@ class LookupHandler(APIHandler):
         elif "releases" in meta or "releaseids" in meta:
             self.inject_releases(meta)
 
+    def _inject_metadata_within_deadline(self, meta, result_map):
+        """Inject metadata, or leave the results without it if out of time."""
+        if self.deadline.expired():
+            self._count_degraded("metadata")
+            return
+        remaining = self.deadline.remaining()
+        if remaining is not None:
+            set_statement_timeout(
+                self.ctx.db.get_fingerprint_db(read_only=True), remaining
+            )
+            set_statement_timeout(
+                self.ctx.db.get_musicbrainz_db(read_only=True), remaining
+            )
+        try:
+            self.inject_metadata(meta, result_map)
+        except (OperationalError, TimeoutError) as ex:
+            # lookup_metadata() re-arms the statement timeout before each of
+            # its queries, and raises TimeoutError once nothing is left.
+            if isinstance(ex, OperationalError) and not is_statement_timeout(ex):
+                raise
+            logger.warning("Deadline exceeded while loading metadata")
+            self.ctx.db.session.close()
+            self._count_degraded("metadata")
+            # Drop whatever was injected before the timeout, so that a result
+            # has either all of the requested metadata or none.
+            for results in result_map.values():
+                for result in results:
+                    for key in list(result):
+                        if key not in ("id", "score"):
+                            del result[key]
+
+    def _count_degraded(self, stage: str) -> None:
+        if self.ctx.statsd is not None:
+            self.ctx.statsd.incr(f"api.lookup.degraded_total,stage={stage}")
+
+    def _resolve_track_gids(self, track_gids: List[str]) -> Dict[str, Optional[int]]:
+        """Resolve the track GIDs that can be resolved before the deadline."""
+        track_ids: Dict[str, Optional[int]] = {}
+        if not track_gids:
+            return track_ids
+        fingerprint_db = self.ctx.db.get_fingerprint_db(read_only=True)
+        set_statement_timeout(fingerprint_db, self.deadline.remaining())
+        for track_gid in track_gids:
+            if self.deadline.expired():
+                self._count_degraded("track")
+                break
+            try:
+                track_ids[track_gid] = resolve_track_gid(fingerprint_db, track_gid)
+            except OperationalError as ex:
+                if not is_statement_timeout(ex):
+                    raise
+                self._count_degraded("track")
+                break
+        return track_ids
+
     def _inject_results(self, results, result_map, matches):
         seen = set()
         for fingerprint_id, track_id, track_gid, score in matches:
@@ -861,12 +1018,66 @@ class LookupHandler(APIHandler):
         if num_track_queries > MAX_TRACK_QUERIES_PER_REQUEST:
             raise errors.RequestTooLargeError()
 
+        fingerprint_queries = [
+            p for p in fingerprints if isinstance(p, FingerprintLookupQuery)
+        ]
+        search_results = []  # type: List[List[FingerprintMatch]]
+        if fingerprint_queries:
+            searcher = FingerprintSearcher(
+                db=self.ctx.db.get_fingerprint_db(read_only=True),
+                index_pool=self.ctx.index,
+                fpstore=self.ctx.fpstore,
+                timeout=self.ctx.config.website.search_timeout,
+                cache=self.ctx.lookup_cache,
+                miss_cache=self.ctx.lookup_miss_cache,
+                compare_in_app=self.ctx.config.website.compare_in_app,
+                staged=self.ctx.config.website.staged_search,
+                deadline=self.deadline,
+                fallback=self.ctx.config.website.search_fallback,
+                simhash_radius=self.ctx.config.website.simhash_prefilter_radius.get(
+                    self.endpoint
+                ),
+            )
+            searcher.max_length_diff = params.max_duration_diff
+            # Libraries with duplicate files send the same fingerprint more
+            # than once. The length window is the same for all queries in the
+            # request, so identical fingerprints with identical durations are
+            # searched only once.
+            unique_queries = {}  # type: Dict[Tuple[Tuple[int, ...], int], int]
+            query_positions = []
+            for p in fingerprint_queries:
+                key = (tuple(p.fingerprint), p.duration)
+                query_positions.append(
+                    unique_queries.setdefault(key, len(unique_queries))
+                )
+            with span("search"):
+                unique_results = searcher.search_many(
+                    [(list(fp), duration) for fp, duration in unique_queries],
+                    max_results=MAX_RESULTS_PER_FINGERPRINT_QUERY,
+                )
+            # A search that did not complete has no matches to return.
+            search_results = [unique_results[i] or [] for i in query_positions]
+            self.ctx.db.session.close()
+            if statsd is not None:
+                for matches in search_results:
+                    statsd.incr("api.lookup.searches.total")
+                    statsd.incr("api.lookup.matches.total", len(matches))
+                # Queries answered by another query's search, included in the
+                # total above.
+                num_duplicates = len(fingerprint_queries) - len(unique_queries)
+                if num_duplicates:
+                    statsd.incr("api.lookup.searches.deduplicated", num_duplicates)
+        fingerprint_results = iter(search_results)
+
+        with span("resolve_tracks"):
+            resolved_track_ids = self._resolve_track_gids(
+                [p.track_gid for p in fingerprints if isinstance(p, TrackLookupQuery)]
+            )
+
         all_matches = []
         for p in fingerprints:
             if isinstance(p, TrackLookupQuery):
-                track_id = resolve_track_gid(
-                    self.ctx.db.get_fingerprint_db(read_only=True), p.track_gid
-                )
+                track_id = resolved_track_ids.get(p.track_gid)
                 if track_id:
                     matches = [
                         FingerprintMatch(
@@ -879,22 +1090,7 @@ class LookupHandler(APIHandler):
                 else:
                     matches = []
             elif isinstance(p, FingerprintLookupQuery):
-                searcher = FingerprintSearcher(
-                    db=self.ctx.db.get_fingerprint_db(read_only=True),
-                    index_pool=self.ctx.index,
-                    fpstore=self.ctx.fpstore,
-                    timeout=self.ctx.config.website.search_timeout,
-                )
-                searcher.max_length_diff = params.max_duration_diff
-                matches = searcher.search(
-                    p.fingerprint,
-                    p.duration,
-                    max_results=MAX_RESULTS_PER_FINGERPRINT_QUERY,
-                )
-                self.ctx.db.session.close()
-                if statsd is not None:
-                    statsd.incr("api.lookup.searches.total")
-                    statsd.incr("api.lookup.matches.total", len(matches))
+                matches = next(fingerprint_results)
             all_matches.append(matches)
 
         self.ctx.db.session.close()
@@ -924,7 +1120,8 @@ class LookupHandler(APIHandler):
 
         if self.ctx.config.website.search_return_metadata:
             if params.meta and result_map:
-                self.inject_metadata(params.meta, result_map)
+                with span("metadata"):
+                    self._inject_metadata_within_deadline(params.meta, result_map)
 
         if statsd is not None:
             statsd.send()
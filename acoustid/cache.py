@@ -0,0 +1,350 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import hashlib
+import logging
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+import cachetools
+from redis import Redis
+from statsd import StatsClient
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LocalCache(cachetools.TTLCache):
+    """TTLCache that reports the entries it evicts to make room for new ones."""
+
+    def __init__(self, maxsize: int, ttl: float, on_evict: Callable[[], None]) -> None:
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.on_evict = on_evict
+
+    def popitem(self) -> Any:
+        item = super().popitem()
+        self.on_evict()
+        return item
+
+
+class TwoTierCache(Generic[V]):
+    """In-process LRU in front of a shared Redis tier.
+
+    Both tiers expire entries after the same TTL. Redis errors are logged and
+    treated as misses, the cache is never the reason a request fails. The
+    local tier is shared by the request threads, so it is only accessed with
+    the lock held.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        encode: Callable[[V], bytes],
+        decode: Callable[[bytes], V],
+        ttl: int,
+        local_size: int,
+        redis: Optional[Redis] = None,
+        statsd: Optional[StatsClient] = None,
+    ) -> None:
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.ttl = ttl
+        self.redis = redis
+        self.statsd = statsd
+        self.lock = threading.Lock()
+        self.local: Optional[LocalCache] = None
+        if local_size > 0:
+            self.local = LocalCache(local_size, ttl, self._count_eviction)
+
+    def _redis_key(self, key: str) -> str:
+        return f"cache:{self.name}:{key}"
+
+    def _count(self, tier: str, result: str, count: int) -> None:
+        if self.statsd is not None and count:
+            self.statsd.incr(
+                f"cache.requests_total,cache={self.name},tier={tier},result={result}",
+                count,
+            )
+
+    def _count_eviction(self) -> None:
+        if self.statsd is not None:
+            self.statsd.incr(f"cache.evictions_total,cache={self.name}")
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, V]:
+        found: Dict[str, V] = {}
+        missing: List[str] = []
+        if self.local is None:
+            missing.extend(keys)
+        else:
+            with self.lock:
+                for key in keys:
+                    value = self.local.get(key)
+                    if value is not None:
+                        found[key] = value
+                    else:
+                        missing.append(key)
+        if self.local is not None:
+            self._count("local", "hit", len(found))
+            self._count("local", "miss", len(missing))
+
+        if self.redis is None or not missing:
+            return found
+
+        try:
+            encoded_values = self.redis.mget([self._redis_key(k) for k in missing])
+        except Exception:
+            logger.warning("Failed to read from the %s cache", self.name, exc_info=True)
+            return found
+
+        loaded: Dict[str, V] = {}
+        for key, encoded_value in zip(missing, encoded_values):
+            if encoded_value is None:
+                continue
+            try:
+                loaded[key] = self.decode(encoded_value)
+            except Exception:
+                logger.warning("Invalid entry %s in the %s cache", key, self.name)
+        found.update(loaded)
+        self._set_local(loaded)
+        num_hits = len(loaded)
+        self._count("redis", "hit", num_hits)
+        self._count("redis", "miss", len(missing) - num_hits)
+        return found
+
+    def get(self, key: str) -> Optional[V]:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: Dict[str, V]) -> None:
+        if not items:
+            return
+        self._set_local(items)
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value in items.items():
+                pipe.set(self._redis_key(key), self.encode(value), ex=self.ttl)
+            pipe.execute()
+        except Exception:
+            logger.warning("Failed to write to the %s cache", self.name, exc_info=True)
+
+    def _set_local(self, items: Dict[str, V]) -> None:
+        if self.local is not None and items:
+            with self.lock:
+                for key, value in items.items():
+                    self.local[key] = value
+
+    def set(self, key: str, value: V) -> None:
+        self.set_many({key: value})
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        if self.local is not None:
+            with self.lock:
+                for key in keys:
+                    self.local.pop(key, None)
+        if self.redis is None:
+            return
+        try:
+            self.redis.delete(*[self._redis_key(k) for k in keys])
+        except Exception:
+            logger.warning(
+                "Failed to delete from the %s cache", self.name, exc_info=True
+            )
+
+    def clear_local(self) -> None:
+        if self.local is not None:
+            with self.lock:
+                self.local.clear()
+
+
+def get_entry_size(value: Any) -> int:
+    """Lists count as their number of items, anything else as one."""
+    if isinstance(value, list):
+        return max(1, len(value))
+    return 1
+
+
+class DimensionCache(Generic[K, V]):
+    """Bounded in-process cache of rows by id, filled in batches.
+
+    Meant for small rows that appear in many responses. The size counts the
+    items of list values, so a few huge entries cannot crowd out the rest.
+    Entries are never stale on their own, the owner clears the cache when
+    the underlying data changes.
+    """
+
+    def __init__(
+        self, name: str, maxsize: int, statsd: Optional[StatsClient] = None
+    ) -> None:
+        self.name = name
+        self.statsd = statsd
+        self.lock = threading.Lock()
+        self.entries: cachetools.LRUCache = cachetools.LRUCache(
+            maxsize, getsizeof=get_entry_size
+        )
+
+    def _count(self, result: str, count: int) -> None:
+        if self.statsd is not None and count:
+            self.statsd.incr(
+                f"cache.requests_total,cache={self.name},tier=local,result={result}",
+                count,
+            )
+
+    def get_many(
+        self,
+        ids: Iterable[K],
+        load: Callable[[Set[K]], Dict[K, V]],
+        default: Optional[V] = None,
+    ) -> Dict[K, V]:
+        """Values for the ids, loading the missing ones with a single call.
+
+        Ids that `load` does not return get `default`, or are left out of
+        the result and not cached if there is no default.
+        """
+        found: Dict[K, V] = {}
+        missing: Set[K] = set()
+        with self.lock:
+            for id in ids:
+                value = self.entries.get(id)
+                if value is None:
+                    missing.add(id)
+                else:
+                    found[id] = value
+        self._count("hit", len(found))
+        self._count("miss", len(missing))
+        if not missing:
+            return found
+        loaded = load(missing)
+        with self.lock:
+            for id in missing:
+                value = loaded.get(id, default)
+                if value is None:
+                    continue
+                found[id] = value
+                try:
+                    self.entries[id] = value
+                except ValueError:
+                    pass  # larger than the whole cache
+        return found
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class TimeSlicedBloomFilter(object):
+    """Bloom filter in Redis bitmaps, expiring in time slices.
+
+    Keys are added to the slice of the current time and looked up in the
+    last `num_slices` slices, so an entry is forgotten between `ttl` minus
+    one slice and `ttl` after it was added. Like TwoTierCache, Redis errors
+    are logged and every key is reported as not present.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: int,
+        size: int,
+        num_hashes: int = 7,
+        num_slices: int = 4,
+        redis: Optional[Redis] = None,
+        statsd: Optional[StatsClient] = None,
+    ) -> None:
+        self.name = name
+        self.size = size
+        self.num_hashes = num_hashes
+        self.num_slices = num_slices
+        self.slice_duration = max(1, ttl // num_slices)
+        self.redis = redis
+        self.statsd = statsd
+
+    def _slice_keys(self) -> List[str]:
+        current = int(time.time()) // self.slice_duration
+        return [f"bloom:{self.name}:{current - i}" for i in range(self.num_slices)]
+
+    def _positions(self, key: str) -> List[int]:
+        # Double hashing, the positions are derived from two 64-bit halves
+        # of a single digest.
+        digest = hashlib.blake2b(key.encode("utf8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little")
+        return [(h1 + i * h2) % self.size for i in range(self.num_hashes)]
+
+    def _count(self, result: str, count: int) -> None:
+        if self.statsd is not None and count:
+            self.statsd.incr(
+                f"cache.requests_total,cache={self.name},tier=redis,result={result}",
+                count,
+            )
+
+    def contains_many(self, keys: List[str]) -> List[bool]:
+        if self.redis is None or not keys:
+            return [False] * len(keys)
+        slice_keys = self._slice_keys()
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                positions = self._positions(key)
+                for slice_key in slice_keys:
+                    for position in positions:
+                        pipe.getbit(slice_key, position)
+            bits = pipe.execute()
+        except Exception:
+            logger.warning(
+                "Failed to read from the %s filter", self.name, exc_info=True
+            )
+            return [False] * len(keys)
+
+        # The bits come back in the order they were asked for: per key, per
+        # slice, num_hashes of them.
+        results = []
+        bits_iter = iter(bits)
+        for key in keys:
+            slices = [
+                all([next(bits_iter) for i in range(self.num_hashes)])
+                for slice_key in slice_keys
+            ]
+            results.append(any(slices))
+        num_hits = sum(results)
+        self._count("hit", num_hits)
+        self._count("miss", len(keys) - num_hits)
+        return results
+
+    def add_many(self, keys: Iterable[str]) -> None:
+        if self.redis is None:
+            return
+        slice_key = self._slice_keys()[0]
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            num_keys = 0
+            for key in keys:
+                for position in self._positions(key):
+                    pipe.setbit(slice_key, position, 1)
+                num_keys += 1
+            if not num_keys:
+                return
+            # The slice is read for num_slices slices after it starts, give
+            # it one more to cover clock differences between the servers.
+            pipe.expire(slice_key, self.slice_duration * (self.num_slices + 1))
+            pipe.execute()
+        except Exception:
+            logger.warning("Failed to write to the %s filter", self.name, exc_info=True)
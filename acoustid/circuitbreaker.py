@@ -0,0 +1,118 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import logging
+import threading
+import time
+from typing import Optional
+
+from statsd import StatsClient
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Values of the state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """The backend failed too often recently, the call was not attempted."""
+
+
+class CircuitBreaker(object):
+    """Stops calling a backend after consecutive failures.
+
+    After `failure_threshold` failures in a row the circuit opens and calls
+    are rejected right away. Once `reset_timeout` has passed, a single call
+    is let through as a probe. If it succeeds the circuit closes, otherwise
+    it opens again for another `reset_timeout`. A threshold of zero disables
+    the breaker.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 10.0,
+        statsd: Optional[StatsClient] = None,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.statsd = statsd
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _set_state(self, state: str) -> None:
+        # Called with the lock held.
+        if state == self.state:
+            return
+        logger.warning("Circuit breaker %s is %s", self.name, state)
+        self.state = state
+        if self.statsd is not None:
+            self.statsd.gauge(
+                f"circuit_breaker.state,breaker={self.name}", STATE_VALUES[state]
+            )
+            self.statsd.incr(
+                f"circuit_breaker.transitions_total,breaker={self.name},state={state}"
+            )
+
+    def allow(self) -> bool:
+        """Can a call be made now? A True in the half-open state is the probe."""
+        if self.failure_threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return self._reject()
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return self._reject()
+                self.probing = True
+            return True
+
+    def _reject(self) -> bool:
+        if self.statsd is not None:
+            self.statsd.incr(f"circuit_breaker.rejected_total,breaker={self.name}")
+        return False
+
+    def check(self) -> None:
+        """Raise CircuitOpenError if a call cannot be made now."""
+        if not self.allow():
+            raise CircuitOpenError(f"circuit breaker {self.name} is open")
+
+    def record_success(self) -> None:
+        if self.failure_threshold <= 0:
+            return
+        with self.lock:
+            self.consecutive_failures = 0
+            self.probing = False
+            self._set_state(CLOSED)
+
+    def record_ignored(self) -> None:
+        """End a call that says nothing about the health of the service."""
+        if self.failure_threshold <= 0:
+            return
+        with self.lock:
+            # A probe that did not tell either way lets the next call probe.
+            self.probing = False
+
+    def record_failure(self) -> None:
+        if self.failure_threshold <= 0:
+            return
+        with self.lock:
+            self.consecutive_failures += 1
+            if (
+                self.state == HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                self.probing = False
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
@@ -4,14 +4,19 @@
 import logging
 import os.path
 from configparser import RawConfigParser
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
-from acoustid.const import DEFAULT_GLOBAL_RATE_LIMIT
+from acoustid.const import (
+    DEFAULT_GLOBAL_RATE_LIMIT,
+    JSON_ENCODER_NAMES,
+    SEARCH_FALLBACKS,
+    SIMHASH_PREFILTER_MAX_RADIUS,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +26,20 @@ def str_to_bool(x):
     return x.lower() in ("1", "on", "true")
 
 
+def split_list(x):
+    # type: (str) -> List[str]
+    return [item.strip() for item in x.split(",") if item.strip()]
+
+
+def parse_int_map(x):
+    # type: (str) -> Dict[str, int]
+    result = {}
+    for item in split_list(x):
+        key, value = item.split("=", 1)
+        result[key.strip()] = int(value)
+    return result
+
+
 def read_config_secret_str_option(parser, section, obj, key, name):
     value = None
     if parser.has_option(section, name):
@@ -253,6 +272,9 @@ class IndexConfig(BaseConfig):
         # type: () -> None
         self.host = "127.0.0.1"
         self.port = 6080
+        # Same as the fpstore options
+        self.breaker_failures = 5
+        self.breaker_reset_timeout = 10.0
 
     def read_section(self, parser, section):
         # type: (RawConfigParser, str) -> None
@@ -260,29 +282,256 @@ class IndexConfig(BaseConfig):
             self.host = parser.get(section, "host")
         if parser.has_option(section, "port"):
             self.port = parser.getint(section, "port")
+        if parser.has_option(section, "breaker_failures"):
+            self.breaker_failures = parser.getint(section, "breaker_failures")
+        if parser.has_option(section, "breaker_reset_timeout"):
+            self.breaker_reset_timeout = parser.getfloat(
+                section, "breaker_reset_timeout"
+            )
 
     def read_env(self, prefix):
         read_env_item(self, "host", prefix + "INDEX_HOST")
         read_env_item(self, "port", prefix + "INDEX_PORT", convert=int)
+        read_env_item(
+            self, "breaker_failures", prefix + "INDEX_BREAKER_FAILURES", convert=int
+        )
+        read_env_item(
+            self,
+            "breaker_reset_timeout",
+            prefix + "INDEX_BREAKER_RESET_TIMEOUT",
+            convert=float,
+        )
 
 
 class FpstoreConfig(BaseConfig):
     def __init__(self) -> None:
         self.host = ""
         self.port = 4659
+        self.search_concurrency = 5
+        # "json" or "msgpack", which sends the hashes as a bin of
+        # little-endian uint32 values and needs the server to support it
+        self.encoding = "json"
+        # Connections kept open to the fpstore host. When pool_block is set,
+        # requests wait for a free connection instead of opening extra ones.
+        self.pool_size = 20
+        self.pool_block = False
+        self.keep_alive = True
+        # Additional "host:port" replicas to spread searches over.
+        self.replicas = []  # type: List[str]
+        # A search that has not finished within this percentile of recent
+        # latencies is also sent to another replica, 0 disables hedging.
+        self.hedge_percentile = 95.0
+        self.hedge_min_delay = 0.01
+        # Replicas are taken out of rotation for eject_time seconds after
+        # eject_failures failures in a row, or when their median latency is
+        # eject_latency_factor times that of the other replicas.
+        self.eject_failures = 5
+        self.eject_latency_factor = 3.0
+        self.eject_time = 30.0
+        # Searches are failed right away for breaker_reset_timeout seconds
+        # after breaker_failures failed searches in a row, 0 disables it.
+        self.breaker_failures = 5
+        self.breaker_reset_timeout = 10.0
 
     def read_section(self, parser: RawConfigParser, section: str) -> None:
         if parser.has_option(section, "host"):
             self.host = parser.get(section, "host")
         if parser.has_option(section, "port"):
             self.port = parser.getint(section, "port")
+        if parser.has_option(section, "search_concurrency"):
+            self.search_concurrency = parser.getint(section, "search_concurrency")
+        if parser.has_option(section, "encoding"):
+            self.encoding = parser.get(section, "encoding")
+        if parser.has_option(section, "pool_size"):
+            self.pool_size = parser.getint(section, "pool_size")
+        if parser.has_option(section, "pool_block"):
+            self.pool_block = parser.getboolean(section, "pool_block")
+        if parser.has_option(section, "keep_alive"):
+            self.keep_alive = parser.getboolean(section, "keep_alive")
+        if parser.has_option(section, "replicas"):
+            self.replicas = split_list(parser.get(section, "replicas"))
+        if parser.has_option(section, "hedge_percentile"):
+            self.hedge_percentile = parser.getfloat(section, "hedge_percentile")
+        if parser.has_option(section, "hedge_min_delay"):
+            self.hedge_min_delay = parser.getfloat(section, "hedge_min_delay")
+        if parser.has_option(section, "eject_failures"):
+            self.eject_failures = parser.getint(section, "eject_failures")
+        if parser.has_option(section, "eject_latency_factor"):
+            self.eject_latency_factor = parser.getfloat(section, "eject_latency_factor")
+        if parser.has_option(section, "eject_time"):
+            self.eject_time = parser.getfloat(section, "eject_time")
+        if parser.has_option(section, "breaker_failures"):
+            self.breaker_failures = parser.getint(section, "breaker_failures")
+        if parser.has_option(section, "breaker_reset_timeout"):
+            self.breaker_reset_timeout = parser.getfloat(
+                section, "breaker_reset_timeout"
+            )
 
     def read_env(self, prefix: str) -> None:
         read_env_item(self, "host", prefix + "FPSTORE_HOST")
         read_env_item(self, "port", prefix + "FPSTORE_PORT", convert=int)
+        read_env_item(
+            self,
+            "search_concurrency",
+            prefix + "FPSTORE_SEARCH_CONCURRENCY",
+            convert=int,
+        )
+        read_env_item(self, "encoding", prefix + "FPSTORE_ENCODING")
+        read_env_item(self, "pool_size", prefix + "FPSTORE_POOL_SIZE", convert=int)
+        read_env_item(
+            self, "pool_block", prefix + "FPSTORE_POOL_BLOCK", convert=str_to_bool
+        )
+        read_env_item(
+            self, "keep_alive", prefix + "FPSTORE_KEEP_ALIVE", convert=str_to_bool
+        )
+        read_env_item(self, "replicas", prefix + "FPSTORE_REPLICAS", convert=split_list)
+        read_env_item(
+            self,
+            "hedge_percentile",
+            prefix + "FPSTORE_HEDGE_PERCENTILE",
+            convert=float,
+        )
+        read_env_item(
+            self, "hedge_min_delay", prefix + "FPSTORE_HEDGE_MIN_DELAY", convert=float
+        )
+        read_env_item(
+            self, "eject_failures", prefix + "FPSTORE_EJECT_FAILURES", convert=int
+        )
+        read_env_item(
+            self,
+            "eject_latency_factor",
+            prefix + "FPSTORE_EJECT_LATENCY_FACTOR",
+            convert=float,
+        )
+        read_env_item(self, "eject_time", prefix + "FPSTORE_EJECT_TIME", convert=float)
+        read_env_item(
+            self, "breaker_failures", prefix + "FPSTORE_BREAKER_FAILURES", convert=int
+        )
+        read_env_item(
+            self,
+            "breaker_reset_timeout",
+            prefix + "FPSTORE_BREAKER_RESET_TIMEOUT",
+            convert=float,
+        )
+
+    def get_replicas(self) -> List[Tuple[str, int]]:
+        replicas = []
+        if self.host:
+            replicas.append((self.host, self.port))
+        for replica in self.replicas:
+            host, sep, port = replica.rpartition(":")
+            if sep:
+                replicas.append((host, int(port)))
+            else:
+                replicas.append((replica, self.port))
+        return replicas
 
     def is_enabled(self) -> bool:
-        return bool(self.host)
+        return bool(self.get_replicas())
+
+
+class FpindexConfig(BaseConfig):
+    def __init__(self) -> None:
+        self.url = "http://localhost:5000"
+        self.index_name = "acoustid"
+
+    def read_section(self, parser: RawConfigParser, section: str) -> None:
+        if parser.has_option(section, "url"):
+            self.url = parser.get(section, "url")
+        if parser.has_option(section, "index_name"):
+            self.index_name = parser.get(section, "index_name")
+
+    def read_env(self, prefix: str) -> None:
+        read_env_item(self, "url", prefix + "FPINDEX_URL")
+        read_env_item(self, "index_name", prefix + "FPINDEX_INDEX_NAME")
+
+
+class CacheConfig(BaseConfig):
+    def __init__(self) -> None:
+        # TTLs are in seconds, zero disables the cache.
+        self.lookup_ttl = 0
+        self.lookup_local_size = 10000
+        # Lookups that found nothing, kept in a Bloom filter of this many bits
+        # per time slice. 2^26 bits is 8MiB per slice and stays below one
+        # false positive per million lookups with a million misses a slice.
+        self.lookup_miss_ttl = 0
+        self.lookup_miss_filter_size = 2**26
+        # Recording metadata, also invalidated by MusicBrainz replication.
+        self.metadata_ttl = 0
+        self.metadata_local_size = 10000
+        # Artist credits, release groups, release events and medium formats,
+        # in list items per table, zero disables the caches.
+        self.metadata_dimension_size = 0
+        # MBIDs and meta ids of tracks. Only the process that changes a
+        # mapping drops its local copy, so the local tier is off by default.
+        self.track_mapping_ttl = 0
+        self.track_mapping_local_size = 0
+
+    def read_section(self, parser: RawConfigParser, section: str) -> None:
+        if parser.has_option(section, "lookup_ttl"):
+            self.lookup_ttl = parser.getint(section, "lookup_ttl")
+        if parser.has_option(section, "lookup_local_size"):
+            self.lookup_local_size = parser.getint(section, "lookup_local_size")
+        if parser.has_option(section, "lookup_miss_ttl"):
+            self.lookup_miss_ttl = parser.getint(section, "lookup_miss_ttl")
+        if parser.has_option(section, "lookup_miss_filter_size"):
+            self.lookup_miss_filter_size = parser.getint(
+                section, "lookup_miss_filter_size"
+            )
+        if parser.has_option(section, "metadata_ttl"):
+            self.metadata_ttl = parser.getint(section, "metadata_ttl")
+        if parser.has_option(section, "metadata_local_size"):
+            self.metadata_local_size = parser.getint(section, "metadata_local_size")
+        if parser.has_option(section, "metadata_dimension_size"):
+            self.metadata_dimension_size = parser.getint(
+                section, "metadata_dimension_size"
+            )
+        if parser.has_option(section, "track_mapping_ttl"):
+            self.track_mapping_ttl = parser.getint(section, "track_mapping_ttl")
+        if parser.has_option(section, "track_mapping_local_size"):
+            self.track_mapping_local_size = parser.getint(
+                section, "track_mapping_local_size"
+            )
+
+    def read_env(self, prefix: str) -> None:
+        read_env_item(self, "lookup_ttl", prefix + "CACHE_LOOKUP_TTL", convert=int)
+        read_env_item(
+            self,
+            "lookup_local_size",
+            prefix + "CACHE_LOOKUP_LOCAL_SIZE",
+            convert=int,
+        )
+        read_env_item(
+            self, "lookup_miss_ttl", prefix + "CACHE_LOOKUP_MISS_TTL", convert=int
+        )
+        read_env_item(
+            self,
+            "lookup_miss_filter_size",
+            prefix + "CACHE_LOOKUP_MISS_FILTER_SIZE",
+            convert=int,
+        )
+        read_env_item(self, "metadata_ttl", prefix + "CACHE_METADATA_TTL", convert=int)
+        read_env_item(
+            self,
+            "metadata_local_size",
+            prefix + "CACHE_METADATA_LOCAL_SIZE",
+            convert=int,
+        )
+        read_env_item(
+            self,
+            "metadata_dimension_size",
+            prefix + "CACHE_METADATA_DIMENSION_SIZE",
+            convert=int,
+        )
+        read_env_item(
+            self, "track_mapping_ttl", prefix + "CACHE_TRACK_MAPPING_TTL", convert=int
+        )
+        read_env_item(
+            self,
+            "track_mapping_local_size",
+            prefix + "CACHE_TRACK_MAPPING_LOCAL_SIZE",
+            convert=int,
+        )
 
 
 class RedisConfig(BaseConfig):
@@ -364,7 +613,38 @@ class WebSiteConfig(BaseConfig):
         self.shutdown_delay = 0
         self.shutdown_file_path = "/tmp/acoustid-server-shutdown.txt"
         self.search_timeout = 1.0
+        # Budget for a whole API request, 0 means no limit
+        self.request_timeout = 0.0
         self.search_return_metadata = True
+        self.compare_in_app = False
+        # Search the database with the first part of the query first and only
+        # use the full query if that does not find a confident match
+        self.staged_search = False
+        # What a lookup returns when the fingerprint index is not available,
+        # "empty" for no results or "database" to search the database instead.
+        self.search_fallback = "empty"
+        # Requests slower than this are logged with their stage timings,
+        # 0 disables the log
+        self.slow_request_threshold = 2.0
+        # Hamming radius of the simhash prefilter per lookup endpoint, e.g.
+        # {"v2.lookup": 1}, endpoints that are not listed do not use it
+        self.simhash_prefilter_radius = {}  # type: Dict[str, int]
+        # Read recording metadata from the documents built by the
+        # build_recording_documents task, recordings without a document
+        # that is at most two days behind the last replication are loaded
+        # from MusicBrainz, so edits can take that long to show up
+        self.recording_documents = False
+        # Load recording metadata with one query that has Postgres nest the
+        # releases into a JSON document per recording
+        self.metadata_json_aggregation = False
+        # Encoder of JSON API responses, one of acoustid.api.JSON_ENCODERS
+        self.json_encoder = "json"
+        # Compress API responses of at least min_size bytes with gzip, or
+        # with zstd if the zstd level is not 0 and the client accepts it
+        self.response_compression = False
+        self.response_compression_min_size = 1024
+        self.response_compression_gzip_level = 6
+        self.response_compression_zstd_level = 0
 
     def read_section(self, parser, section):
         # type: (RawConfigParser, str) -> None
@@ -395,10 +675,71 @@ class WebSiteConfig(BaseConfig):
             self.shutdown_file_path = parser.get(section, "shutdown_file")
         if parser.has_option(section, "search_timeout"):
             self.search_timeout = parser.getfloat(section, "search_timeout")
+        if parser.has_option(section, "request_timeout"):
+            self.request_timeout = parser.getfloat(section, "request_timeout")
         if parser.has_option(section, "search_return_metadata"):
             self.search_return_metadata = parser.getboolean(
                 section, "search_return_metadata"
             )
+        if parser.has_option(section, "compare_in_app"):
+            self.compare_in_app = parser.getboolean(section, "compare_in_app")
+        if parser.has_option(section, "staged_search"):
+            self.staged_search = parser.getboolean(section, "staged_search")
+        if parser.has_option(section, "search_fallback"):
+            self.search_fallback = parser.get(section, "search_fallback")
+            self.check_search_fallback()
+        if parser.has_option(section, "slow_request_threshold"):
+            self.slow_request_threshold = parser.getfloat(
+                section, "slow_request_threshold"
+            )
+        if parser.has_option(section, "recording_documents"):
+            self.recording_documents = parser.getboolean(section, "recording_documents")
+        if parser.has_option(section, "metadata_json_aggregation"):
+            self.metadata_json_aggregation = parser.getboolean(
+                section, "metadata_json_aggregation"
+            )
+        if parser.has_option(section, "json_encoder"):
+            self.json_encoder = parser.get(section, "json_encoder")
+            self.check_json_encoder()
+        if parser.has_option(section, "response_compression"):
+            self.response_compression = parser.getboolean(
+                section, "response_compression"
+            )
+        if parser.has_option(section, "response_compression_min_size"):
+            self.response_compression_min_size = parser.getint(
+                section, "response_compression_min_size"
+            )
+        if parser.has_option(section, "response_compression_gzip_level"):
+            self.response_compression_gzip_level = parser.getint(
+                section, "response_compression_gzip_level"
+            )
+        if parser.has_option(section, "response_compression_zstd_level"):
+            self.response_compression_zstd_level = parser.getint(
+                section, "response_compression_zstd_level"
+            )
+        for name in parser.options(section):
+            if name.startswith("simhash_prefilter_radius."):
+                endpoint = name.split(".", 1)[1]
+                self.simhash_prefilter_radius[endpoint] = parser.getint(section, name)
+        self.check_simhash_prefilter_radius()
+
+    def check_search_fallback(self):
+        # type: () -> None
+        if self.search_fallback not in SEARCH_FALLBACKS:
+            raise ValueError(f"Unsupported search fallback: {self.search_fallback}")
+
+    def check_simhash_prefilter_radius(self):
+        # type: () -> None
+        for endpoint, radius in self.simhash_prefilter_radius.items():
+            if not 0 <= radius <= SIMHASH_PREFILTER_MAX_RADIUS:
+                raise ValueError(
+                    f"Unsupported simhash prefilter radius for {endpoint}: {radius}"
+                )
+
+    def check_json_encoder(self):
+        # type: () -> None
+        if self.json_encoder not in JSON_ENCODER_NAMES:
+            raise ValueError(f"Unsupported JSON encoder: {self.json_encoder}")
 
     def read_env(self, prefix):
         read_env_item(self, "debug", prefix + "DEBUG", convert=str_to_bool)
@@ -412,6 +753,68 @@ class WebSiteConfig(BaseConfig):
         )
         read_env_item(self, "shutdown_delay", prefix + "SHUTDOWN_DELAY", convert=int)
         read_env_item(self, "shutdown_file_path", prefix + "SHUTDOWN_FILE")
+        read_env_item(
+            self, "compare_in_app", prefix + "COMPARE_IN_APP", convert=str_to_bool
+        )
+        read_env_item(
+            self, "staged_search", prefix + "STAGED_SEARCH", convert=str_to_bool
+        )
+        read_env_item(
+            self, "request_timeout", prefix + "REQUEST_TIMEOUT", convert=float
+        )
+        read_env_item(self, "search_fallback", prefix + "SEARCH_FALLBACK")
+        self.check_search_fallback()
+        read_env_item(
+            self,
+            "slow_request_threshold",
+            prefix + "SLOW_REQUEST_THRESHOLD",
+            convert=float,
+        )
+        read_env_item(
+            self,
+            "simhash_prefilter_radius",
+            prefix + "SIMHASH_PREFILTER_RADIUS",
+            convert=parse_int_map,
+        )
+        self.check_simhash_prefilter_radius()
+        read_env_item(
+            self,
+            "recording_documents",
+            prefix + "RECORDING_DOCUMENTS",
+            convert=str_to_bool,
+        )
+        read_env_item(
+            self,
+            "metadata_json_aggregation",
+            prefix + "METADATA_JSON_AGGREGATION",
+            convert=str_to_bool,
+        )
+        read_env_item(self, "json_encoder", prefix + "JSON_ENCODER")
+        self.check_json_encoder()
+        read_env_item(
+            self,
+            "response_compression",
+            prefix + "RESPONSE_COMPRESSION",
+            convert=str_to_bool,
+        )
+        read_env_item(
+            self,
+            "response_compression_min_size",
+            prefix + "RESPONSE_COMPRESSION_MIN_SIZE",
+            convert=int,
+        )
+        read_env_item(
+            self,
+            "response_compression_gzip_level",
+            prefix + "RESPONSE_COMPRESSION_GZIP_LEVEL",
+            convert=int,
+        )
+        read_env_item(
+            self,
+            "response_compression_zstd_level",
+            prefix + "RESPONSE_COMPRESSION_ZSTD_LEVEL",
+            convert=int,
+        )
 
 
 class GunicornConfig(BaseConfig):
@@ -599,7 +1002,9 @@ class Config(object):
         self.website = WebSiteConfig()
         self.index = IndexConfig()
         self.fpstore = FpstoreConfig()
+        self.fpindex = FpindexConfig()
         self.redis = RedisConfig()
+        self.cache = CacheConfig()
         self.replication = ReplicationConfig()
         self.cluster = ClusterConfig()
         self.rate_limiter = RateLimiterConfig()
@@ -626,7 +1031,9 @@ class Config(object):
         self.website.read(parser, "website")
         self.index.read(parser, "index")
         self.fpstore.read(parser, "fpstore")
+        self.fpindex.read(parser, "fpindex")
         self.redis.read(parser, "redis")
+        self.cache.read(parser, "cache")
         self.replication.read(parser, "replication")
         self.cluster.read(parser, "cluster")
         self.rate_limiter.read(parser, "rate_limiter")
@@ -644,7 +1051,9 @@ class Config(object):
         self.website.read_env(prefix)
         self.index.read_env(prefix)
         self.fpstore.read_env(prefix)
+        self.fpindex.read_env(prefix)
         self.redis.read_env(prefix)
+        self.cache.read_env(prefix)
         self.replication.read_env(prefix)
         self.cluster.read_env(prefix)
         self.rate_limiter.read_env(prefix)
@@ -23,3 +23,15 @@ FINGERPRINT_MAX_ALLOWED_LENGTH_DIFF = 30
 MAX_REQUESTS_PER_SECOND = 4
 
 DEFAULT_GLOBAL_RATE_LIMIT = 100
+
+# names of the encoders in acoustid.api.JSON_ENCODERS
+JSON_ENCODER_NAMES = ("json", "msgspec", "msgspec_compact")
+
+# what searches do when the fingerprint store or the index is not available
+SEARCH_FALLBACK_EMPTY = "empty"
+SEARCH_FALLBACK_DATABASE = "database"
+SEARCH_FALLBACKS = (SEARCH_FALLBACK_EMPTY, SEARCH_FALLBACK_DATABASE)
+
+# the simhash prefilter probes every simhash within the radius, which is
+# 1 + 32 for radius 1 and 1 + 32 + 496 for radius 2
+SIMHASH_PREFILTER_MAX_RADIUS = 2
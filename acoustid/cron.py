@@ -34,6 +34,10 @@ def create_schedule(script: Script) -> Scheduler:
     # job that only gets one attempt a day turns a single missed run into a
     # day of lost headroom.
     schedule.every().hour.do(run_task("manage_fpindex_changelog"))
+    # Does nothing until a new replication packet changes the cache generation.
+    schedule.every(10).minutes.do(run_task("warm_metadata_cache"))
+    # Each run does a bounded amount of work, new recordings first.
+    schedule.every(5).minutes.do(run_task("build_recording_documents"))
     return schedule
 
 
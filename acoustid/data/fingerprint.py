@@ -1,19 +1,59 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import array
 import logging
-from typing import Any, Dict, List, NamedTuple, Optional, cast
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast,
+)
 
-from acoustid_ext.fingerprint import FingerprintError, decode_legacy_fingerprint
-from sqlalchemy import func, literal_column, select, sql, text
+import msgspec
+import requests
+from acoustid_ext.fingerprint import (
+    FingerprintError,
+    compare_fingerprints,
+    compute_simhash,
+    decode_legacy_fingerprint,
+    extract_query,
+)
+from redis import Redis
+from sqlalchemy import Integer, func, literal_column, select, sql
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql.elements import BooleanClauseList, ColumnElement
+from statsd import StatsClient
 
 from acoustid import const
 from acoustid import tables as schema
-from acoustid.db import FingerprintDB, IngestDB
+from acoustid.cache import TimeSlicedBloomFilter, TwoTierCache
+from acoustid.circuitbreaker import CircuitOpenError
+from acoustid.config import CacheConfig
+from acoustid.const import (
+    SEARCH_FALLBACK_DATABASE,
+    SEARCH_FALLBACK_EMPTY,
+    SEARCH_FALLBACKS,
+    SIMHASH_PREFILTER_MAX_RADIUS,
+)
+from acoustid.db import (
+    FingerprintDB,
+    IngestDB,
+    is_statement_timeout,
+    set_statement_timeout,
+)
+from acoustid.deadline import Deadline
+from acoustid.fingerprint import compute_fingerprint_gid
 from acoustid.fpstore import FpstoreClient
-from acoustid.indexclient import Index, IndexClientError, IndexClientPool
+from acoustid.indexclient import Index, IndexClientPool, IndexClientUnavailableError
+from acoustid.tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +72,14 @@ SELECT f.id, f.track_id, t.gid AS track_gid, score FROM (
 
 SEARCH_ONLY_IN_DATABASE = False
 
+# Prefilter candidates need to score at least this to answer the query
+# without the full search.
+SIMHASH_PREFILTER_MIN_SCORE = 0.9
+
+# In the staged search, the first part of the query is enough if the best
+# match scores this much above the track merge threshold.
+STAGED_SEARCH_MARGIN = 0.1
+
 
 def decode_fingerprint(data: str) -> list[int] | None:
     """Decode a compressed and base64-encoded fingerprint"""
@@ -50,6 +98,95 @@ FingerprintMatch = NamedTuple(
 )
 
 
+LookupCache = TwoTierCache[List[FingerprintMatch]]
+
+
+def encode_lookup_cache_entry(matches: List[FingerprintMatch]) -> bytes:
+    return msgspec.msgpack.encode(
+        [(m.fingerprint_id, m.track_id, str(m.track_gid), m.score) for m in matches]
+    )
+
+
+def decode_lookup_cache_entry(data: bytes) -> List[FingerprintMatch]:
+    return [FingerprintMatch(*m) for m in msgspec.msgpack.decode(data)]
+
+
+def create_lookup_cache(
+    config: CacheConfig, redis: Optional[Redis], statsd: Optional[StatsClient]
+) -> LookupCache:
+    return TwoTierCache(
+        "lookup",
+        encode=encode_lookup_cache_entry,
+        decode=decode_lookup_cache_entry,
+        ttl=config.lookup_ttl,
+        local_size=config.lookup_local_size,
+        redis=redis,
+        statsd=statsd,
+    )
+
+
+# Hamming distance between simhashes within which a new fingerprint
+# invalidates recorded misses.
+LOOKUP_MISS_INVALIDATION_RADIUS = 1
+
+
+def simhash_neighbors(simhash: int, radius: int) -> Set[int]:
+    """All signed 32-bit simhashes within `radius` bits of `simhash`."""
+    results = {simhash & 0xFFFFFFFF}
+    for i in range(radius):
+        results |= {h ^ (1 << bit) for h in results for bit in range(32)}
+    return {h - (1 << 32) if h & 0x80000000 else h for h in results}
+
+
+class LookupMissCache(object):
+    """Lookups that recently found nothing.
+
+    A miss is recorded under the lookup's cache key. It stops counting when
+    the importer adds a fingerprint whose simhash is near the simhash of the
+    missed fingerprint, and otherwise expires with the filter's time slices.
+    Bloom filters cannot forget a single entry, so the importer records the
+    simhashes of new fingerprints in the same filter and a recorded miss only
+    counts if its fingerprint's simhash is not among them.
+    """
+
+    def __init__(self, bloom_filter: TimeSlicedBloomFilter) -> None:
+        self.bloom_filter = bloom_filter
+
+    def contains_many(self, queries: Sequence[Tuple[str, int]]) -> List[bool]:
+        """Check (cache key, simhash) pairs for a miss that still holds."""
+        keys = []
+        for key, simhash in queries:
+            keys.append(f"miss:{key}")
+            keys.append(f"new:{simhash}")
+        found = self.bloom_filter.contains_many(keys)
+        return [found[i] and not found[i + 1] for i in range(0, len(found), 2)]
+
+    def add_many(self, keys: Iterable[str]) -> None:
+        self.bloom_filter.add_many(f"miss:{key}" for key in keys)
+
+    def invalidate(self, simhash: int) -> None:
+        neighbors = simhash_neighbors(simhash, LOOKUP_MISS_INVALIDATION_RADIUS)
+        self.bloom_filter.add_many(f"new:{h}" for h in neighbors)
+
+
+def create_lookup_miss_cache(
+    config: CacheConfig, redis: Optional[Redis], statsd: Optional[StatsClient]
+) -> LookupMissCache:
+    return LookupMissCache(
+        TimeSlicedBloomFilter(
+            "lookup_miss",
+            ttl=config.lookup_miss_ttl,
+            size=config.lookup_miss_filter_size,
+            redis=redis,
+            statsd=statsd,
+        )
+    )
+
+
+def compute_query_simhash(fp: List[int]) -> int:
+    return compute_simhash(array.array("i", fp), signed=True)
+
+
 class FingerprintSearcher(object):
     def __init__(
         self,
@@ -58,15 +195,42 @@ class FingerprintSearcher(object):
         fpstore: Optional[FpstoreClient] = None,
         fast: bool = True,
         timeout: Optional[float] = None,
+        cache: Optional[LookupCache] = None,
+        compare_in_app: bool = False,
+        deadline: Optional[Deadline] = None,
+        miss_cache: Optional[LookupMissCache] = None,
+        fallback: str = SEARCH_FALLBACK_EMPTY,
+        simhash_radius: Optional[int] = None,
+        staged: bool = False,
     ) -> None:
+        if fallback not in SEARCH_FALLBACKS:
+            raise ValueError(f"Unsupported search fallback: {fallback}")
+        if simhash_radius is not None and not (
+            0 <= simhash_radius <= SIMHASH_PREFILTER_MAX_RADIUS
+        ):
+            raise ValueError(f"Unsupported simhash prefilter radius: {simhash_radius}")
         self.db = db
         self.index_pool = index_pool
         self.fpstore = fpstore
+        self.cache = cache
+        self.miss_cache = miss_cache
+        self.fallback = fallback
+        self.simhash_radius = simhash_radius
+        self.staged = staged
+        self.compare_in_app = compare_in_app
         self.min_score = const.TRACK_GROUP_MERGE_THRESHOLD
         self.max_length_diff = const.FINGERPRINT_MAX_LENGTH_DIFF
         self.max_offset = const.TRACK_MAX_OFFSET
         self.fast = fast
         self.timeout = timeout
+        self.deadline = deadline
+
+    def _get_timeout(self) -> Optional[float]:
+        """The search timeout, or less if the request deadline is closer."""
+        timeout = self.timeout or None
+        if self.deadline is None:
+            return timeout
+        return self.deadline.timeout(timeout)
 
     def _create_search_query(
         self,
@@ -114,10 +278,49 @@ class FingerprintSearcher(object):
             query = query.limit(max_results)
         return query
 
+    def _create_compare_query(self, length: int, condition: Any) -> Any:
+        """Fetch the candidate fingerprints themselves, to be scored in the app."""
+        return (
+            select(
+                schema.fingerprint.c.id,
+                schema.fingerprint.c.track_id,
+                schema.track.c.gid.label("track_gid"),
+                schema.fingerprint.c.fingerprint,
+            )
+            .select_from(
+                schema.fingerprint.join(
+                    schema.track, schema.track.c.id == schema.fingerprint.c.track_id
+                )
+            )
+            .where(condition)
+            .where(
+                schema.fingerprint.c.length.between(
+                    length - self.max_length_diff, length + self.max_length_diff
+                )
+            )
+        )
+
+    def _compare_candidates(
+        self, fp: List[int], candidates: Sequence[Any], max_results: Optional[int]
+    ) -> List[FingerprintMatch]:
+        with span("compare"):
+            scores = compare_fingerprints(
+                fp, [c.fingerprint for c in candidates], self.max_offset, signed=True
+            )
+        matches = [
+            FingerprintMatch(c.id, c.track_id, c.track_gid, score)
+            for c, score in zip(candidates, scores)
+            if score > self.min_score
+        ]
+        matches.sort(key=lambda m: (-m.score, m.fingerprint_id))
+        if max_results:
+            matches = matches[:max_results]
+        return matches
+
     def _search_index(self, fp, length, index, max_candidates=None, min_score_pct=None):
         # type: (List[int], int, Index, Optional[int], Optional[float]) -> Optional[ColumnElement[bool]]
         # index search
-        fp_query = self.db.execute(select(func.acoustid_extract_query(fp))).scalar()
+        fp_query = extract_query(fp, signed=True).tolist()
         if not fp_query:
             return None
         results = index.search(fp_query)
@@ -151,102 +354,231 @@ class FingerprintSearcher(object):
         )
         return condition
 
+    def _search_database_part(self, fp, min_fingerprint_id, part):
+        # type: (List[int], int, Tuple[int, int]) -> ColumnElement[bool]
+        part_start, part_length = part
+        condition = sql.and_(
+            func.subarray(func.acoustid_extract_query(fp), part_start, part_length).op(
+                "&&"
+            )(func.acoustid_extract_query(schema.fingerprint.c.fingerprint)),
+            schema.fingerprint.c.id > min_fingerprint_id,
+        )
+        return condition
+
+    def _search_first_part(
+        self,
+        fp: List[int],
+        length: int,
+        conditions: Sequence[ColumnElement[bool]],
+        min_fingerprint_id: int,
+        max_results: Optional[int],
+    ) -> Optional[List[FingerprintMatch]]:
+        """Search the database with only the first part of the query.
+
+        Returns the matches if the best one is a confident match, otherwise
+        None and the caller needs to search with the full query.
+        """
+        condition = sql.or_(
+            *conditions, self._search_database_part(fp, min_fingerprint_id, PARTS[0])
+        )
+        matches = self._run_search_query(fp, length, condition, max_results)
+        if not matches:
+            return None
+        if matches[0].score < const.TRACK_MERGE_THRESHOLD + STAGED_SEARCH_MARGIN:
+            return None
+        return matches
+
     def _get_max_indexed_fingerprint_id(self, index):
         # type: (Index) -> int
         return int(index.get_attribute("max_document_id") or "0")
 
-    def _search_via_fpstore(
-        self, fp: List[int], length: int, max_results: Optional[int] = None
-    ) -> List[FingerprintMatch]:
-        assert self.fpstore is not None
+    def _search_fpstore_candidates(
+        self, fps: Sequence[List[int]], max_results: int
+    ) -> List[Optional[Dict[int, float]]]:
+        """Ask fpstore for candidates for each query, concurrently if more than one.
 
-        if max_results is None:
-            max_results = 100
+        Returns a map of fingerprint ID to score per query. In fast mode a query
+        that timed out gets None, rather than failing the whole batch.
+        """
+        assert self.fpstore is not None
 
-        try:
-            matching_fingerprints = self.fpstore.search(
-                fp,
-                limit=max_results,
-                fast_mode=self.fast,
-                min_score=self.min_score,
-                timeout=self.timeout,
+        if len(fps) == 1:
+            futures = None
+        else:
+            futures = [
+                self.fpstore.submit_search(
+                    fp,
+                    limit=max_results,
+                    fast_mode=self.fast,
+                    min_score=self.min_score,
+                    timeout=self.timeout,
+                    deadline=self.deadline,
+                )
+                for fp in fps
+            ]
+
+        all_candidates: List[Optional[Dict[int, float]]] = []
+        for i, fp in enumerate(fps):
+            try:
+                if futures is None:
+                    matching_fingerprints = self.fpstore.search(
+                        fp,
+                        limit=max_results,
+                        fast_mode=self.fast,
+                        min_score=self.min_score,
+                        timeout=self.timeout,
+                        deadline=self.deadline,
+                    )
+                else:
+                    matching_fingerprints = futures[i].result()
+            except TimeoutError:
+                if not self.fast:
+                    raise
+                all_candidates.append(None)
+                continue
+            candidates: Dict[int, float] = {}
+            for m in matching_fingerprints:
+                candidates[m.fingerprint_id] = m.score
+            all_candidates.append(candidates)
+        return all_candidates
+
+    def _create_candidates_query(
+        self, fingerprint_ids: Sequence[int], min_length: int, max_length: int
+    ) -> Any:
+        # A single array parameter instead of an IN list, so that the statement
+        # text does not change with the number of candidates.
+        ids_param = sql.bindparam(
+            "fingerprint_ids", list(fingerprint_ids), type_=ARRAY(Integer)
+        )
+        return (
+            select(
+                schema.fingerprint.c.id,
+                schema.fingerprint.c.track_id,
+                schema.fingerprint.c.length,
+                schema.track.c.gid.label("track_gid"),
             )
-        except TimeoutError:
-            if self.fast:
-                return []
-            raise
-
-        if not matching_fingerprints:
-            return []
+            .join(schema.track, schema.track.c.id == schema.fingerprint.c.track_id)
+            .where(schema.fingerprint.c.id == sql.any_(ids_param))
+            .where(schema.fingerprint.c.length.between(min_length, max_length))
+        )
 
-        matching_fingerprint_ids: Dict[int, float] = {}
-        for m in matching_fingerprints:
-            matching_fingerprint_ids[m.fingerprint_id] = m.score
+    def _resolve_fpstore_candidates(
+        self,
+        lengths: Sequence[int],
+        all_candidates: Sequence[Optional[Dict[int, float]]],
+        max_results: int,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        """Join fpstore candidates to their tracks, applying the length filter.
+
+        All queries are resolved with one statement over the union of their
+        candidates. The length filter in SQL covers every query's window and
+        each query's own window is applied when the rows are split back out.
+        Queries without candidates, None, stay None.
+        """
+        all_matches: List[Optional[List[FingerprintMatch]]] = [
+            None if candidates is None else [] for candidates in all_candidates
+        ]
 
-        query = self._create_search_query(
-            length,
-            schema.fingerprint.c.id.in_(matching_fingerprint_ids.keys()),
-            max_results=max_results,
+        fingerprint_ids: Set[int] = set()
+        min_length: Optional[int] = None
+        max_length: Optional[int] = None
+        for length, candidates in zip(lengths, all_candidates):
+            if not candidates:
+                continue
+            fingerprint_ids.update(candidates.keys())
+            if min_length is None or length - self.max_length_diff < min_length:
+                min_length = length - self.max_length_diff
+            if max_length is None or length + self.max_length_diff > max_length:
+                max_length = length + self.max_length_diff
+        if not fingerprint_ids:
+            return all_matches
+        assert min_length is not None and max_length is not None
+
+        query = self._create_candidates_query(
+            sorted(fingerprint_ids), min_length, max_length
         )
-        if self.timeout:
-            timeout_ms = int(self.timeout * 1000)
-            self.db.execute(text(f"SET LOCAL statement_timeout TO {timeout_ms}"))
+        set_statement_timeout(self.db, self._get_timeout())
         try:
-            results = self.db.execute(query)
+            rows = {row.id: row for row in self.db.execute(query)}
         except OperationalError as ex:
-            if "canceling statement due to statement timeout" in str(ex):
-                return []
+            if is_statement_timeout(ex):
+                return [None] * len(all_candidates)
             raise
 
-        matches = []
-        for result in results:
-            match = FingerprintMatch(*result)
-            match = match._replace(score=matching_fingerprint_ids[match.fingerprint_id])
-            matches.append(match)
+        for i, (length, candidates) in enumerate(zip(lengths, all_candidates)):
+            if not candidates:
+                continue
+            matches = []
+            for fingerprint_id, score in candidates.items():
+                row = rows.get(fingerprint_id)
+                if row is None or abs(row.length - length) > self.max_length_diff:
+                    continue
+                matches.append(
+                    FingerprintMatch(
+                        fingerprint_id=row.id,
+                        track_id=row.track_id,
+                        track_gid=row.track_gid,
+                        score=score,
+                    )
+                )
+            matches.sort(key=lambda m: (-m.score, m.fingerprint_id))
+            all_matches[i] = matches[:max_results]
 
-        matches.sort(key=lambda m: -m.score)
+        return all_matches
 
-        return matches
+    def _search_via_fpstore(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        if max_results is None:
+            max_results = 100
+
+        with span("fpstore"):
+            all_candidates = self._search_fpstore_candidates(
+                [fp for fp, length in queries], max_results
+            )
+        with span("fpstore_resolve"):
+            return self._resolve_fpstore_candidates(
+                [length for fp, length in queries], all_candidates, max_results
+            )
 
     def _search_directly(
         self, fp: List[int], length: int, max_results: Optional[int] = None
-    ) -> List[FingerprintMatch]:
+    ) -> Optional[List[FingerprintMatch]]:
         conditions: List[ColumnElement[bool]] = []
-
-        if self.fast:
-            max_candidates = 10
-            min_score_pct = 40
-        else:
-            max_candidates = 20
-            min_score_pct = 10
-
-        if not SEARCH_ONLY_IN_DATABASE:
-            with self.index_pool.connect() as index:
-                if not self.fast:
+        max_indexed_fingerprint_id = 0
+
+        # Fast searches do not use the index, so they do not connect to it.
+        if not SEARCH_ONLY_IN_DATABASE and not self.fast:
+            try:
+                index = self.index_pool.connect()
+            except IndexClientUnavailableError:
+                # Without the index, a search that does not fall back to
+                # the database would miss tracks, and the importer would
+                # then create duplicates of them.
+                if self.fallback != SEARCH_FALLBACK_DATABASE:
+                    raise
+                logger.debug("Index circuit breaker is open")
+                index = None
+            if index is not None:
+                with index:
                     max_indexed_fingerprint_id = self._get_max_indexed_fingerprint_id(
                         index
                     )
-
-                    try:
-                        condition = self._search_index(
-                            fp,
-                            length,
-                            index,
-                            max_candidates=max_candidates,
-                            min_score_pct=min_score_pct,
-                        )
-                        if condition is not None:
-                            conditions.append(condition)
-                    except IndexClientError:
-                        if not self.fast:
-                            raise
-                        # In fast mode we carry on without the index, so this is
-                        # a degraded search rather than a failed one.
-                        logger.warning("Index search error", exc_info=True)
-        else:
-            max_indexed_fingerprint_id = 0
+                    condition = self._search_index(
+                        fp, length, index, max_candidates=20, min_score_pct=10
+                    )
+                    if condition is not None:
+                        conditions.append(condition)
 
         if not self.fast or SEARCH_ONLY_IN_DATABASE:
+            if self.staged:
+                matches = self._search_first_part(
+                    fp, length, conditions, max_indexed_fingerprint_id, max_results
+                )
+                if matches is not None:
+                    return matches
             condition = self._search_database(fp, length, max_indexed_fingerprint_id)
             if condition is not None:
                 conditions.append(condition)
@@ -256,32 +588,221 @@ class FingerprintSearcher(object):
 
         # Use the original or_ function but with proper typing
         combined_condition = sql.or_(*conditions)
+        return self._run_search_query(fp, length, combined_condition, max_results)
 
-        query = self._create_search_query(
-            length, combined_condition, max_results=max_results, compare_to=fp
-        )
+    def _run_search_query(
+        self,
+        fp: List[int],
+        length: int,
+        combined_condition: ColumnElement[bool],
+        max_results: Optional[int],
+    ) -> Optional[List[FingerprintMatch]]:
+        if self.compare_in_app:
+            query = self._create_compare_query(length, combined_condition)
+        else:
+            query = self._create_search_query(
+                length, combined_condition, max_results=max_results, compare_to=fp
+            )
 
-        if self.timeout:
-            timeout_ms = int(self.timeout * 1000)
-            self.db.execute(text(f"SET LOCAL statement_timeout TO {timeout_ms}"))
+        set_statement_timeout(self.db, self._get_timeout())
 
         try:
-            results = self.db.execute(query)
+            with span("db_search"):
+                results = self.db.execute(query)
         except OperationalError as ex:
-            if "canceling statement due to statement timeout" in str(ex):
-                return []
+            if is_statement_timeout(ex):
+                return None
             raise
 
+        if self.compare_in_app:
+            return self._compare_candidates(fp, results.all(), max_results)
+
         matches = [FingerprintMatch(*result) for result in results]
         return matches
 
     def search(
         self, fp: List[int], length: int, max_results: Optional[int] = None
-    ) -> List[FingerprintMatch]:
+    ) -> Optional[List[FingerprintMatch]]:
+        return self.search_many([(fp, length)], max_results)[0]
+
+    def search_many(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        """Search for several (fingerprint, length) queries at once.
+
+        With fpstore, the index searches run concurrently and the whole batch
+        then costs about as much as its slowest query. Results are returned
+        in the order of the queries, None for a search that did not complete,
+        e.g. because it timed out or the fingerprint store was not available.
+        """
+        if not queries:
+            return []
+
+        if self.cache is None and self.miss_cache is None:
+            return self._search_many(queries, max_results)
+
+        keys = [self._cache_key(fp, length, max_results) for fp, length in queries]
+        results: List[Optional[List[FingerprintMatch]]] = [None] * len(queries)
+        missing = list(range(len(queries)))
+        if self.cache is not None:
+            with span("search_cache"):
+                cached = self.cache.get_many(keys)
+            results = [cached.get(key) for key in keys]
+            missing = [i for i, key in enumerate(keys) if key not in cached]
+
+        if self.miss_cache is not None and missing:
+            with span("search_cache"):
+                known_misses = self.miss_cache.contains_many(
+                    [(keys[i], compute_query_simhash(queries[i][0])) for i in missing]
+                )
+            for i, known_miss in zip(missing, known_misses):
+                if known_miss:
+                    results[i] = []
+            missing = [
+                i for i, known_miss in zip(missing, known_misses) if not known_miss
+            ]
+
+        if missing:
+            found = self._search_many([queries[i] for i in missing], max_results)
+            to_cache = {}
+            new_misses = []
+            for i, matches in zip(missing, found):
+                results[i] = matches
+                # A search that timed out is a guess, not an answer.
+                if matches is None:
+                    continue
+                # Misses go to the miss cache, where imports can invalidate
+                # them, the lookup cache cannot.
+                if not matches and self.miss_cache is not None:
+                    new_misses.append(keys[i])
+                else:
+                    to_cache[keys[i]] = matches
+            if self.cache is not None:
+                self.cache.set_many(to_cache)
+            if self.miss_cache is not None:
+                self.miss_cache.add_many(new_misses)
+        return results
+
+    def _cache_key(self, fp: List[int], length: int, max_results: Optional[int]) -> str:
+        # Lengths are whole seconds and the length window is part of the key,
+        # so the duration needs no coarser bucketing to be shared.
+        fp_gid = compute_fingerprint_gid(FINGERPRINT_VERSION, array.array("i", fp))
+        return ":".join(
+            map(
+                str,
+                [
+                    fp_gid,
+                    length,
+                    self.max_length_diff,
+                    max_results,
+                    self.min_score,
+                    int(self.fast),
+                    self.simhash_radius,
+                    int(self.staged),
+                ],
+            )
+        )
+
+    def _search_fallback(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        """Search without the fingerprint store, as configured by the fallback."""
+        results: List[Optional[List[FingerprintMatch]]] = [None] * len(queries)
+        if self.fallback == SEARCH_FALLBACK_DATABASE:
+            for i, (fp, length) in enumerate(queries):
+                if self.staged:
+                    results[i] = self._search_first_part(fp, length, [], 0, max_results)
+                    if results[i] is not None:
+                        continue
+                condition = self._search_database(fp, length, 0)
+                if condition is not None:
+                    results[i] = self._run_search_query(
+                        fp, length, condition, max_results
+                    )
+        return results
+
+    def _search_simhash_prefilter(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        """Answer re-lookups of known fingerprints from their simhash alone.
+
+        Stored fingerprints whose simhash is within `simhash_radius` bits of
+        the query's are compared to the query. If some of them are near-exact
+        matches, they are the result. Other queries get None and need the
+        full search.
+        """
+        assert self.simhash_radius is not None
+        results: List[Optional[List[FingerprintMatch]]] = [None] * len(queries)
+        for i, (fp, length) in enumerate(queries):
+            simhashes = simhash_neighbors(
+                compute_query_simhash(fp), self.simhash_radius
+            )
+            condition = schema.fingerprint.c.id.in_(
+                select(schema.fingerprint_data.c.id).where(
+                    schema.fingerprint_data.c.simhash.in_(simhashes)
+                )
+            )
+            query = self._create_compare_query(length, condition)
+            set_statement_timeout(self.db, self._get_timeout())
+            try:
+                with span("simhash_prefilter"):
+                    candidates = list(self.db.execute(query))
+            except OperationalError as ex:
+                if is_statement_timeout(ex):
+                    continue
+                raise
+            matches = [
+                m
+                for m in self._compare_candidates(fp, candidates, max_results)
+                if m.score >= SIMHASH_PREFILTER_MIN_SCORE
+            ]
+            if matches:
+                results[i] = matches
+        return results
+
+    def _search_many(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        if self.simhash_radius is None:
+            return self._search_backends(queries, max_results)
+        results = self._search_simhash_prefilter(queries, max_results)
+        missing = [i for i, matches in enumerate(results) if matches is None]
+        if missing:
+            found = self._search_backends([queries[i] for i in missing], max_results)
+            for i, matches in zip(missing, found):
+                results[i] = matches
+        return results
+
+    def _search_backends(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
         if self.fpstore is not None and not SEARCH_ONLY_IN_DATABASE:
-            return self._search_via_fpstore(fp, length, max_results)
+            try:
+                return self._search_via_fpstore(queries, max_results)
+            except CircuitOpenError:
+                if not self.fast:
+                    raise
+                logger.debug("Fingerprint store circuit breaker is open")
+                return self._search_fallback(queries, max_results)
+            except requests.RequestException:
+                if not self.fast:
+                    raise
+                logger.warning("Fingerprint store search failed", exc_info=True)
+                return self._search_fallback(queries, max_results)
         else:
-            return self._search_directly(fp, length, max_results)
+            return [
+                self._search_directly(fp, length, max_results) for fp, length in queries
+            ]
 
 
 def insert_fingerprint(
@@ -2,18 +2,41 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import datetime
+import functools
 import logging
+import threading
+import time
 from collections.abc import Iterable
-from typing import Any
+from typing import Any, Optional
 
+import msgspec
+from redis import Redis
 from sqlalchemy import String, sql
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by, insert
+from sqlalchemy.engine import Connection
+from statsd import StatsClient
 
 from acoustid import tables as schema
-from acoustid.db import MusicBrainzDB
+from acoustid.cache import DimensionCache, TwoTierCache
+from acoustid.config import CacheConfig
+from acoustid.db import FingerprintDB, MusicBrainzDB, set_statement_timeout
+from acoustid.deadline import Deadline
 
 logger = logging.getLogger(__name__)
 
 
+def check_deadline(conn: Connection, deadline: Optional[Deadline]) -> None:
+    """Limit the next statement to what is left of the deadline.
+
+    Raises TimeoutError if nothing is left.
+    """
+    if deadline is None:
+        return
+    if deadline.expired():
+        raise TimeoutError()
+    set_statement_timeout(conn, deadline.remaining())
+
+
 def get_last_replication_date(conn: MusicBrainzDB) -> datetime.datetime:
     last_replication_date = conn.execute(
         sql.select(schema.mb_replication_control.c.last_replication_date)
@@ -213,6 +236,208 @@ def _load_release_groups(
     return result
 
 
+def _load_medium_formats(
+    conn: MusicBrainzDB, format_ids: Iterable[int]
+) -> dict[int, str]:
+    if not format_ids:
+        return {}
+    query = sql.select(
+        schema.mb_medium_format.c.id, schema.mb_medium_format.c.name
+    ).where(schema.mb_medium_format.c.id.in_(format_ids))
+    return {row.id: row.name for row in conn.execute(query)}
+
+
+class DimensionCaches(object):
+    """In-process caches of the small rows shared by many recordings.
+
+    The loaders only query the ids that are not cached yet. Like the
+    metadata cache, they are cleared when MusicBrainz replication runs.
+    """
+
+    def __init__(self, maxsize: int, statsd: Optional[StatsClient] = None) -> None:
+        self.artists: DimensionCache[int, list[dict[str, Any]]] = DimensionCache(
+            "mb_artist_credits", maxsize, statsd
+        )
+        self.release_groups: DimensionCache[int, dict[str, Any]] = DimensionCache(
+            "mb_release_groups", maxsize, statsd
+        )
+        self.release_events: DimensionCache[int, list[dict[str, Any]]] = DimensionCache(
+            "mb_release_events", maxsize, statsd
+        )
+        self.medium_formats: DimensionCache[int, str] = DimensionCache(
+            "mb_medium_formats", maxsize, statsd
+        )
+
+    def load_artists(
+        self, conn: MusicBrainzDB, artist_credit_ids: Iterable[int]
+    ) -> dict[int, list[dict[str, Any]]]:
+        return self.artists.get_many(
+            artist_credit_ids, functools.partial(_load_artists, conn)
+        )
+
+    def load_release_groups(
+        self, conn: MusicBrainzDB, release_group_ids: Iterable[int]
+    ) -> dict[int, dict[str, Any]]:
+        return self.release_groups.get_many(
+            release_group_ids, functools.partial(_load_release_groups, conn)
+        )
+
+    def load_release_events(
+        self, conn: MusicBrainzDB, release_ids: Iterable[int]
+    ) -> dict[int, list[dict[str, Any]]]:
+        # Releases without events are common, remember them too.
+        return self.release_events.get_many(
+            release_ids, functools.partial(_load_release_events, conn), default=[]
+        )
+
+    def load_medium_formats(
+        self, conn: MusicBrainzDB, format_ids: Iterable[int]
+    ) -> dict[int, str]:
+        return self.medium_formats.get_many(
+            format_ids, functools.partial(_load_medium_formats, conn)
+        )
+
+    def clear(self) -> None:
+        self.artists.clear()
+        self.release_groups.clear()
+        self.release_events.clear()
+        self.medium_formats.clear()
+
+
+class MetadataCache(object):
+    """Recording metadata rows, cached per recording and set of loaded data.
+
+    MusicBrainz data only changes when replication runs, so the entries are
+    keyed by the last replication date. A new replication packet starts a new
+    generation of keys and the old entries simply expire. The replication
+    date itself is read at most once every `generation_ttl` seconds.
+
+    Either of the recording cache and the dimension caches can be left out.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[TwoTierCache[list[dict[str, Any]]]],
+        dimensions: Optional[DimensionCaches] = None,
+        generation_ttl: float = 60.0,
+    ) -> None:
+        self.cache = cache
+        self.dimensions = dimensions
+        self.generation_ttl = generation_ttl
+        self.lock = threading.Lock()
+        self.replication_date: Optional[datetime.datetime] = None
+        self.generation_checked = 0.0
+
+    def get_replication_date(self, conn: MusicBrainzDB) -> datetime.datetime:
+        with self.lock:
+            if self.replication_date is not None:
+                if time.monotonic() - self.generation_checked < self.generation_ttl:
+                    return self.replication_date
+        replication_date = get_last_replication_date(conn)
+        with self.lock:
+            if replication_date != self.replication_date:
+                # Entries of the previous generation would never be read again.
+                if self.cache is not None:
+                    self.cache.clear_local()
+                if self.dimensions is not None:
+                    self.dimensions.clear()
+                self.replication_date = replication_date
+            self.generation_checked = time.monotonic()
+        return replication_date
+
+    def get_generation(self, conn: MusicBrainzDB) -> str:
+        return str(int(self.get_replication_date(conn).timestamp()))
+
+    def lookup_metadata(
+        self,
+        conn: MusicBrainzDB,
+        recording_ids: Iterable[str],
+        load_releases: bool = False,
+        load_release_groups: bool = False,
+        load_isrcs: bool = False,
+        document_db: Optional[FingerprintDB] = None,
+        json_aggregation: bool = False,
+        deadline: Optional[Deadline] = None,
+    ) -> list[dict[str, Any]]:
+        recording_ids = list(dict.fromkeys(str(id).lower() for id in recording_ids))
+        if not recording_ids:
+            return []
+        load_release_groups = load_releases and load_release_groups
+        flags = "".join(
+            str(int(flag)) for flag in (load_releases, load_release_groups, load_isrcs)
+        )
+        check_deadline(conn, deadline)
+        replication_date = self.get_replication_date(conn)
+        prefix = f"{int(replication_date.timestamp())}:{flags}:"
+        if self.cache is None:
+            return _load_metadata(
+                conn,
+                recording_ids,
+                load_releases=load_releases,
+                load_release_groups=load_release_groups,
+                load_isrcs=load_isrcs,
+                dimensions=self.dimensions,
+                document_db=document_db,
+                json_aggregation=json_aggregation,
+                replication_date=replication_date,
+                deadline=deadline,
+            )
+        found = self.cache.get_many(prefix + id for id in recording_ids)
+        missing = [id for id in recording_ids if prefix + id not in found]
+        if missing:
+            rows = _load_metadata(
+                conn,
+                missing,
+                load_releases=load_releases,
+                load_release_groups=load_release_groups,
+                load_isrcs=load_isrcs,
+                dimensions=self.dimensions,
+                document_db=document_db,
+                json_aggregation=json_aggregation,
+                replication_date=replication_date,
+                deadline=deadline,
+            )
+            # Recordings that do not exist are cached too, as empty entries.
+            loaded: dict[str, list[dict[str, Any]]] = {id: [] for id in missing}
+            for row in rows:
+                loaded[row["recording_id"]].append(row)
+            self.cache.set_many({prefix + id: loaded[id] for id in missing})
+            found.update((prefix + id, loaded[id]) for id in missing)
+        return [row for id in recording_ids for row in found[prefix + id]]
+
+
+# Durations come back from the database as decimals, keep them numbers.
+_msgpack_encoder = msgspec.msgpack.Encoder(decimal_format="number")
+
+
+def encode_metadata_cache_entry(rows: list[dict[str, Any]]) -> bytes:
+    return _msgpack_encoder.encode(rows)
+
+
+def decode_metadata_cache_entry(data: bytes) -> list[dict[str, Any]]:
+    return msgspec.msgpack.decode(data)
+
+
+def create_metadata_cache(
+    config: CacheConfig, redis: Optional[Redis], statsd: Optional[StatsClient]
+) -> MetadataCache:
+    cache: Optional[TwoTierCache[list[dict[str, Any]]]] = None
+    if config.metadata_ttl > 0:
+        cache = TwoTierCache(
+            "metadata",
+            encode=encode_metadata_cache_entry,
+            decode=decode_metadata_cache_entry,
+            ttl=config.metadata_ttl,
+            local_size=config.metadata_local_size,
+            redis=redis,
+            statsd=statsd,
+        )
+    dimensions = None
+    if config.metadata_dimension_size > 0:
+        dimensions = DimensionCaches(config.metadata_dimension_size, statsd)
+    return MetadataCache(cache, dimensions)
+
+
 def lookup_metadata(
     conn: MusicBrainzDB,
     recording_ids: Iterable[str],
@@ -220,9 +445,265 @@ def lookup_metadata(
     load_release_groups: bool = False,
     load_artists: bool = False,
     load_isrcs: bool = False,
+    cache: Optional[MetadataCache] = None,
+    document_db: Optional[FingerprintDB] = None,
+    json_aggregation: bool = False,
+    deadline: Optional[Deadline] = None,
 ) -> list[dict[str, Any]]:
+    """Metadata rows of the recordings.
+
+    With a `deadline`, each statement is limited to what is left of it, and
+    TimeoutError is raised if nothing is left before a statement.
+    """
     if not recording_ids:
         return []
+    if cache is not None:
+        return cache.lookup_metadata(
+            conn,
+            recording_ids,
+            load_releases=load_releases,
+            load_release_groups=load_release_groups,
+            load_isrcs=load_isrcs,
+            document_db=document_db,
+            json_aggregation=json_aggregation,
+            deadline=deadline,
+        )
+    return _load_metadata(
+        conn,
+        recording_ids,
+        load_releases=load_releases,
+        load_release_groups=load_release_groups,
+        load_isrcs=load_isrcs,
+        document_db=document_db,
+        json_aggregation=json_aggregation,
+        deadline=deadline,
+    )
+
+
+def _load_metadata(
+    conn: MusicBrainzDB,
+    recording_ids: Iterable[str],
+    load_releases: bool = False,
+    load_release_groups: bool = False,
+    load_isrcs: bool = False,
+    dimensions: Optional[DimensionCaches] = None,
+    document_db: Optional[FingerprintDB] = None,
+    json_aggregation: bool = False,
+    replication_date: Optional[datetime.datetime] = None,
+    deadline: Optional[Deadline] = None,
+) -> list[dict[str, Any]]:
+    """Metadata rows from the recording documents, or MusicBrainz if there are none.
+
+    The documents are only used if they are at most RECORDING_DOCUMENT_MAX_AGE
+    behind the last MusicBrainz replication, `replication_date` if it is
+    already known.
+    """
+    if json_aggregation:
+        lookup = functools.partial(_lookup_metadata_json, deadline=deadline)
+    else:
+        lookup = functools.partial(
+            _lookup_metadata, dimensions=dimensions, deadline=deadline
+        )
+    if document_db is None:
+        return lookup(
+            conn,
+            recording_ids,
+            load_releases=load_releases,
+            load_release_groups=load_release_groups,
+            load_isrcs=load_isrcs,
+        )
+    recording_ids = list(dict.fromkeys(str(id).lower() for id in recording_ids))
+    if replication_date is None:
+        check_deadline(conn, deadline)
+        replication_date = get_last_replication_date(conn)
+    check_deadline(document_db, deadline)
+    documents = load_recording_documents(document_db, recording_ids, replication_date)
+    results: list[dict[str, Any]] = []
+    for id in recording_ids:
+        document = documents.get(id)
+        if document is not None:
+            results.extend(
+                project_recording_document(
+                    document,
+                    load_releases=load_releases,
+                    load_release_groups=load_release_groups,
+                    load_isrcs=load_isrcs,
+                )
+            )
+    missing = [id for id in recording_ids if id not in documents]
+    if missing:
+        results.extend(
+            lookup(
+                conn,
+                missing,
+                load_releases=load_releases,
+                load_release_groups=load_release_groups,
+                load_isrcs=load_isrcs,
+            )
+        )
+    return results
+
+
+# Keys of the metadata rows that describe the recording itself, the rest
+# describe the track and the release it appears on.
+RECORDING_DOCUMENT_KEYS = frozenset(
+    [
+        "recording_id",
+        "recording_title",
+        "recording_duration",
+        "recording_artists",
+        "recording_isrcs",
+    ]
+)
+
+
+def build_recording_documents(
+    conn: MusicBrainzDB,
+    recording_ids: Iterable[str],
+    dimensions: Optional[DimensionCaches] = None,
+) -> dict[str, dict[str, Any]]:
+    """Build documents with everything lookup_metadata can load for the recordings.
+
+    A recording that is not in MusicBrainz gets a document without the
+    recording, so that it does not fall back to MusicBrainz on every lookup.
+    """
+    recording_ids = list(dict.fromkeys(str(id).lower() for id in recording_ids))
+    documents: dict[str, dict[str, Any]] = {
+        id: {"recording": None, "releases": []} for id in recording_ids
+    }
+    if not recording_ids:
+        return documents
+    for row in _lookup_metadata(
+        conn, recording_ids, load_isrcs=True, dimensions=dimensions
+    ):
+        documents[row["recording_id"]]["recording"] = row
+    for row in _lookup_metadata(
+        conn,
+        recording_ids,
+        load_releases=True,
+        load_release_groups=True,
+        load_isrcs=True,
+        dimensions=dimensions,
+    ):
+        release = {k: v for k, v in row.items() if k not in RECORDING_DOCUMENT_KEYS}
+        documents[row["recording_id"]]["releases"].append(release)
+    return documents
+
+
+def project_recording_document(
+    document: dict[str, Any],
+    load_releases: bool = False,
+    load_release_groups: bool = False,
+    load_isrcs: bool = False,
+) -> list[dict[str, Any]]:
+    """Metadata rows of the document, as _lookup_metadata would return them."""
+    recording = document["recording"]
+    if recording is None:
+        return []
+    recording = dict(recording)
+    if not load_isrcs:
+        recording.pop("recording_isrcs", None)
+    if not load_releases:
+        return [recording]
+    results = []
+    for release in document["releases"]:
+        row = dict(recording)
+        if load_release_groups:
+            row.update(release)
+        else:
+            row.update(
+                (k, v) for k, v in release.items() if not k.startswith("release_group_")
+            )
+        results.append(row)
+    return results
+
+
+def encode_recording_document(document: dict[str, Any]) -> bytes:
+    return _msgpack_encoder.encode(document)
+
+
+def decode_recording_document(data: bytes) -> dict[str, Any]:
+    return msgspec.msgpack.decode(data)
+
+
+# Documents are rebuilt periodically instead of following individual
+# MusicBrainz edits, so a document built from a replication more than this
+# much older than the last one is not used. Edits reach the lookups within
+# this time.
+RECORDING_DOCUMENT_MAX_AGE = datetime.timedelta(days=2)
+
+
+def load_recording_documents(
+    conn: FingerprintDB,
+    recording_ids: Iterable[str],
+    replication_date: Optional[datetime.datetime] = None,
+) -> dict[str, dict[str, Any]]:
+    """Documents of the recordings.
+
+    With `replication_date`, documents more than RECORDING_DOCUMENT_MAX_AGE
+    behind that MusicBrainz replication are left out.
+    """
+    recording_ids = list(recording_ids)
+    if not recording_ids:
+        return {}
+    query = sql.select(
+        schema.recording_metadata.c.mbid, schema.recording_metadata.c.document
+    ).where(schema.recording_metadata.c.mbid.in_(recording_ids))
+    if replication_date is not None:
+        query = query.where(
+            schema.recording_metadata.c.replication_date
+            >= replication_date - RECORDING_DOCUMENT_MAX_AGE
+        )
+    return {
+        str(row.mbid): decode_recording_document(row.document)
+        for row in conn.execute(query)
+    }
+
+
+def save_recording_documents(
+    conn: FingerprintDB,
+    documents: dict[str, dict[str, Any]],
+    replication_date: datetime.datetime,
+) -> None:
+    if not documents:
+        return
+    insert_stmt = insert(schema.recording_metadata).values(
+        [
+            {
+                "mbid": mbid,
+                "document": encode_recording_document(document),
+                "replication_date": replication_date,
+            }
+            for mbid, document in documents.items()
+        ]
+    )
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[schema.recording_metadata.c.mbid],
+        set_={
+            "document": insert_stmt.excluded.document,
+            "replication_date": insert_stmt.excluded.replication_date,
+            "updated": sql.func.current_timestamp(),
+        },
+    )
+    conn.execute(upsert_stmt)
+
+
+def _lookup_metadata(
+    conn: MusicBrainzDB,
+    recording_ids: Iterable[str],
+    load_releases: bool = False,
+    load_release_groups: bool = False,
+    load_isrcs: bool = False,
+    dimensions: Optional[DimensionCaches] = None,
+    deadline: Optional[Deadline] = None,
+) -> list[dict[str, Any]]:
+    load_artists = _load_artists
+    load_release_events = _load_release_events
+    load_release_groups_ = _load_release_groups
+    if dimensions is not None:
+        load_artists = dimensions.load_artists
+        load_release_events = dimensions.load_release_events
+        load_release_groups_ = dimensions.load_release_groups
     src = schema.mb_recording
     columns = [
         sql.cast(schema.mb_recording.c.gid, String).label("recording_id"),
@@ -240,10 +721,14 @@ def lookup_metadata(
         src = src.join(
             schema.mb_release, schema.mb_medium.c.release == schema.mb_release.c.id
         )
-        src = src.outerjoin(
-            schema.mb_medium_format,
-            schema.mb_medium.c.format == schema.mb_medium_format.c.id,
-        )
+        if dimensions is None:
+            src = src.outerjoin(
+                schema.mb_medium_format,
+                schema.mb_medium.c.format == schema.mb_medium_format.c.id,
+            )
+            columns.append(schema.mb_medium_format.c.name.label("medium_format"))
+        else:
+            columns.append(schema.mb_medium.c.format.label("medium_format_id"))
         columns.extend(
             [
                 sql.cast(schema.mb_track.c.gid, String).label("track_id"),
@@ -254,7 +739,6 @@ def lookup_metadata(
                 schema.mb_medium.c.position.label("medium_position"),
                 schema.mb_medium.c.track_count.label("medium_track_count"),
                 schema.mb_medium.c.name.label("medium_title"),
-                schema.mb_medium_format.c.name.label("medium_format"),
                 schema.mb_release.c.id.label("release_rid"),
                 sql.cast(schema.mb_release.c.gid, String).label("release_id"),
                 schema.mb_release.c.name.label("release_title"),
@@ -268,6 +752,7 @@ def lookup_metadata(
     artist_credit_ids = set()
     release_ids = set()
     release_group_ids = set()
+    check_deadline(conn, deadline)
     for row in conn.execute(query):
         r = dict(row._mapping)
         results.append(r)
@@ -280,15 +765,26 @@ def lookup_metadata(
                 release_group_ids.add(row.release_group_rid)
 
     if load_releases:
+        check_deadline(conn, deadline)
         releases = _load_release_meta(conn, release_ids)
-        release_events = _load_release_events(conn, release_ids)
+        check_deadline(conn, deadline)
+        release_events = load_release_events(conn, release_ids)
         for row2 in results:
             r_id = row2.pop("release_rid")
             row2.update(releases[r_id])
             row2["release_events"] = release_events.get(r_id, {})
 
+        if dimensions is not None:
+            check_deadline(conn, deadline)
+            medium_formats = dimensions.load_medium_formats(
+                conn, {r["medium_format_id"] for r in results} - {None}
+            )
+            for row2 in results:
+                row2["medium_format"] = medium_formats.get(row2.pop("medium_format_id"))
+
         if load_release_groups:
-            release_groups = _load_release_groups(conn, release_group_ids)
+            check_deadline(conn, deadline)
+            release_groups = load_release_groups_(conn, release_group_ids)
             for row2 in results:
                 rg_id = row2.pop("release_group_rid")
                 row2.update(release_groups[rg_id])
@@ -299,11 +795,13 @@ def lookup_metadata(
         # grouped by recording downstream and the group's representative is
         # whichever came back first, so putting it on one row would be a
         # coin toss.
+        check_deadline(conn, deadline)
         isrcs = _load_isrcs(conn, {r["recording_id"] for r in results})
         for row2 in results:
             row2["recording_isrcs"] = isrcs.get(row2["recording_id"], [])
 
-    artists = _load_artists(conn, artist_credit_ids)
+    check_deadline(conn, deadline)
+    artists = load_artists(conn, artist_credit_ids)
     for row2 in results:
         row2["recording_artists"] = artists[row2.pop("recording_artist_credit")]
         if load_releases:
@@ -316,6 +814,179 @@ def lookup_metadata(
     return results
 
 
+def _json_object(**fields: Any) -> Any:
+    args = []
+    for name, value in fields.items():
+        args.extend([sql.literal_column(f"'{name}'"), value])
+    return sql.func.json_build_object(*args)
+
+
+def _artists_json(artist_credit: Any) -> Any:
+    artist_credit_name = schema.mb_artist_credit_name.alias()
+    artist = schema.mb_artist.alias()
+    artist_json = sql.func.json_strip_nulls(
+        _json_object(
+            id=sql.cast(artist.c.gid, String),
+            name=artist_credit_name.c.name,
+            joinphrase=sql.func.nullif(artist_credit_name.c.join_phrase, ""),
+        )
+    )
+    return (
+        sql.select(
+            sql.func.json_agg(
+                aggregate_order_by(artist_json, artist_credit_name.c.position)
+            )
+        )
+        .select_from(
+            artist_credit_name.join(artist, artist_credit_name.c.artist == artist.c.id)
+        )
+        .where(artist_credit_name.c.artist_credit == artist_credit)
+        .scalar_subquery()
+    )
+
+
+def _release_events_json(release_id: Any) -> Any:
+    release_country = schema.mb_release_country.alias()
+    iso_3166_1 = schema.mb_iso_3166_1.alias()
+    event_json = _json_object(
+        release_country=iso_3166_1.c.code,
+        release_date_year=release_country.c.date_year,
+        release_date_month=release_country.c.date_month,
+        release_date_day=release_country.c.date_day,
+    )
+    return (
+        sql.select(sql.func.json_agg(event_json))
+        .select_from(
+            release_country.outerjoin(
+                iso_3166_1, iso_3166_1.c.area == release_country.c.country
+            )
+        )
+        .where(release_country.c.release == release_id)
+        .scalar_subquery()
+    )
+
+
+def _release_group_json_fields(release_group: Any) -> dict[str, Any]:
+    primary_type = schema.mb_release_group_primary_type.alias()
+    secondary_type_join = schema.mb_release_group_secondary_type_join.alias()
+    secondary_type = schema.mb_release_group_secondary_type.alias()
+    return {
+        "release_group_id": sql.cast(release_group.c.gid, String),
+        "release_group_title": release_group.c.name,
+        "release_group_artists": _artists_json(release_group.c.artist_credit),
+        "release_group_primary_type": sql.select(primary_type.c.name)
+        .where(primary_type.c.id == release_group.c.type)
+        .scalar_subquery(),
+        "release_group_secondary_types": sql.select(
+            sql.func.json_agg(secondary_type.c.name)
+        )
+        .select_from(
+            secondary_type_join.join(
+                secondary_type,
+                secondary_type_join.c.secondary_type == secondary_type.c.id,
+            )
+        )
+        .where(secondary_type_join.c.release_group == release_group.c.id)
+        .scalar_subquery(),
+    }
+
+
+def _lookup_metadata_json(
+    conn: MusicBrainzDB,
+    recording_ids: Iterable[str],
+    load_releases: bool = False,
+    load_release_groups: bool = False,
+    load_isrcs: bool = False,
+    deadline: Optional[Deadline] = None,
+) -> list[dict[str, Any]]:
+    """The same rows as _lookup_metadata, from one query with JSON aggregates.
+
+    Postgres nests the tracks, releases and artists of each recording into a
+    single JSON document, instead of sending one wide row per track and
+    release, followed by the queries for release, artist and release group
+    data. The rows are only flattened here.
+    """
+    recording = schema.mb_recording
+    columns = [
+        sql.cast(recording.c.gid, String).label("recording_id"),
+        recording.c.name.label("recording_title"),
+        (recording.c.length / 1000).label("recording_duration"),
+        sql.type_coerce(_artists_json(recording.c.artist_credit), JSON).label(
+            "recording_artists"
+        ),
+    ]
+    if load_isrcs:
+        isrcs = (
+            sql.select(sql.func.json_agg(schema.mb_isrc.c.isrc))
+            .where(schema.mb_isrc.c.recording == recording.c.id)
+            .scalar_subquery()
+        )
+        columns.append(sql.type_coerce(isrcs, JSON).label("recording_isrcs"))
+    if load_releases:
+        track = schema.mb_track.alias()
+        medium = schema.mb_medium.alias()
+        release = schema.mb_release.alias()
+        release_medium = schema.mb_medium.alias()
+        medium_format = schema.mb_medium_format.alias()
+        src = track.join(medium, track.c.medium == medium.c.id)
+        src = src.join(release, medium.c.release == release.c.id)
+        fields = {
+            "track_id": sql.cast(track.c.gid, String),
+            "track_position": track.c.position,
+            "track_title": track.c.name,
+            "track_artists": _artists_json(track.c.artist_credit),
+            "track_duration": track.c.length / 1000,
+            "medium_position": medium.c.position,
+            "medium_track_count": medium.c.track_count,
+            "medium_title": medium.c.name,
+            "medium_format": sql.select(medium_format.c.name)
+            .where(medium_format.c.id == medium.c.format)
+            .scalar_subquery(),
+            "release_id": sql.cast(release.c.gid, String),
+            "release_title": release.c.name,
+            "release_artists": _artists_json(release.c.artist_credit),
+            "release_medium_count": sql.select(sql.func.count(release_medium.c.id))
+            .where(release_medium.c.release == release.c.id)
+            .scalar_subquery(),
+            "release_track_count": sql.select(
+                sql.func.sum(release_medium.c.track_count)
+            )
+            .where(release_medium.c.release == release.c.id)
+            .scalar_subquery(),
+            "release_events": _release_events_json(release.c.id),
+        }
+        if load_release_groups:
+            release_group = schema.mb_release_group.alias()
+            src = src.join(release_group, release.c.release_group == release_group.c.id)
+            fields.update(_release_group_json_fields(release_group))
+        else:
+            fields["release_group_rid"] = release.c.release_group
+        tracks = (
+            sql.select(sql.func.json_agg(_json_object(**fields)))
+            .select_from(src)
+            .where(track.c.recording == recording.c.id)
+            .scalar_subquery()
+        )
+        columns.append(sql.type_coerce(tracks, JSON).label("tracks"))
+    query = sql.select(*columns).where(recording.c.gid.in_(recording_ids))
+    results: list[dict[str, Any]] = []
+    check_deadline(conn, deadline)
+    for row in conn.execute(query):
+        r = dict(row._mapping)
+        if load_isrcs:
+            r["recording_isrcs"] = sorted(r["recording_isrcs"] or [])
+        if not load_releases:
+            results.append(r)
+            continue
+        # Like the inner join in _lookup_metadata, a recording without
+        # tracks has no rows.
+        for track_data in r.pop("tracks") or []:
+            # _lookup_metadata falls back to an empty dict here.
+            track_data["release_events"] = track_data["release_events"] or {}
+            results.append({**r, **track_data})
+    return results
+
+
 def lookup_recording_metadata(
     conn: MusicBrainzDB, mbids: Iterable[str]
 ) -> dict[str, dict[str, Any]]:
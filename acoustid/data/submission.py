@@ -8,13 +8,14 @@ import uuid
 from typing import Any, Dict, Iterable
 
 import pytz
-from acoustid_ext.fingerprint import compute_simhash
+from acoustid_ext.fingerprint import compute_simhash, extract_query
 from sqlalchemy import RowMapping, sql
 
 from acoustid import const
 from acoustid import tables as schema
 from acoustid.data.fingerprint import (
     FingerprintSearcher,
+    LookupMissCache,
     inc_fingerprint_submission_count,
     insert_fingerprint,
 )
@@ -23,6 +24,7 @@ from acoustid.data.format import find_or_insert_format
 from acoustid.data.meta import check_meta_id, find_or_insert_meta, fix_meta
 from acoustid.data.source import find_or_insert_source, get_source
 from acoustid.data.track import (
+    TrackMappingCache,
     can_add_fp_to_track,
     can_merge_tracks,
     insert_mbid,
@@ -69,6 +71,9 @@ def import_submission(
     fingerprint_db: FingerprintDB,
     index_pool: IndexClientPool,
     submission: RowMapping,
+    compare_in_app: bool = False,
+    lookup_miss_cache: LookupMissCache | None = None,
+    track_mapping_cache: TrackMappingCache | None = None,
 ) -> tuple[bool, dict[str, Any] | None]:
     """
     Import the given submission into the main fingerprint database
@@ -124,11 +129,7 @@ def import_submission(
         logger.info("Skipping, has only %d unique items", num_unique_items)
         return True, None
 
-    num_query_items = fingerprint_db.execute(
-        sql.select(
-            sql.func.icount(sql.func.acoustid_extract_query(submission["fingerprint"]))
-        )
-    ).scalar()
+    num_query_items = len(extract_query(submission["fingerprint"], signed=True))
     if not num_query_items:
         logger.info("Skipping, no data to index")
         return True, None
@@ -171,9 +172,17 @@ def import_submission(
         "format_id": format_id,
     }
 
-    searcher = FingerprintSearcher(fingerprint_db, index_pool, fast=False)
+    searcher = FingerprintSearcher(
+        fingerprint_db, index_pool, fast=False, compare_in_app=compare_in_app
+    )
     searcher.min_score = const.TRACK_MERGE_THRESHOLD
     matches = searcher.search(submission["fingerprint"], submission["length"])
+    if matches is None:
+        # A new track could duplicate one the search did not get to find,
+        # fail the import, so that it is retried.
+        raise TimeoutError(
+            "Fingerprint search for submission %d did not complete" % submission["id"]
+        )
     if matches:
         all_track_ids: set[int] = set()
         possible_track_ids: set[int] = set()
@@ -192,6 +201,7 @@ def import_submission(
                 m.track_id,
                 submission["fingerprint"],
                 submission["length"],
+                compare_in_app=compare_in_app,
             ):
                 possible_track_ids.add(m.track_id)
                 if not fingerprint["track_id"]:
@@ -200,12 +210,18 @@ def import_submission(
                         fingerprint["id"] = m.fingerprint_id
         # TODO fix merge_tracks to not delete track_mbid rows and then enable it
         if len(possible_track_ids) > 1 and False:
-            for group in can_merge_tracks(fingerprint_db, possible_track_ids):
+            for group in can_merge_tracks(
+                fingerprint_db, possible_track_ids, compare_in_app=compare_in_app
+            ):
                 if fingerprint["track_id"] in group and len(group) > 1:
                     fingerprint["track_id"] = min(group)
                     group.remove(fingerprint["track_id"])
                     merge_tracks(
-                        fingerprint_db, ingest_db, fingerprint["track_id"], list(group)
+                        fingerprint_db,
+                        ingest_db,
+                        fingerprint["track_id"],
+                        list(group),
+                        cache=track_mapping_cache,
                     )
                     break
 
@@ -219,6 +235,8 @@ def import_submission(
         fingerprint["id"] = insert_fingerprint(
             fingerprint_db, ingest_db, fingerprint, submission["id"], source_id
         )
+        if lookup_miss_cache is not None:
+            lookup_miss_cache.invalidate(fingerprint_hash)
     else:
         assert isinstance(fingerprint["id"], int)
         inc_fingerprint_submission_count(
@@ -235,6 +253,7 @@ def import_submission(
             submission["mbid"],
             submission["id"],
             source_id,
+            cache=track_mapping_cache,
         )
         submission_result["mbid"] = submission["mbid"]
 
@@ -268,6 +287,7 @@ def import_submission(
                 meta_id,
                 submission["id"],
                 source_id,
+                cache=track_mapping_cache,
             )
             submission_result["meta_id"] = meta_id
             submission_result["meta_gid"] = meta_gid
@@ -301,6 +321,9 @@ def import_queued_submissions(
     index_pool: IndexClientPool,
     limit: int = 100,
     ids: list[int] | None = None,
+    compare_in_app: bool = False,
+    lookup_miss_cache: LookupMissCache | None = None,
+    track_mapping_cache: TrackMappingCache | None = None,
 ) -> int:
     """
     Import the given submission into the main fingerprint database
@@ -325,7 +348,14 @@ def import_queued_submissions(
     for submission in submissions:
         try:
             handled, fingerprint = import_submission(
-                ingest_db, app_db, fingerprint_db, index_pool, submission._mapping
+                ingest_db,
+                app_db,
+                fingerprint_db,
+                index_pool,
+                submission._mapping,
+                compare_in_app=compare_in_app,
+                lookup_miss_cache=lookup_miss_cache,
+                track_mapping_cache=track_mapping_cache,
             )
         except Exception:
             # The caller reports the failure without naming the submission.
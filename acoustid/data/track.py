@@ -6,15 +6,124 @@ import uuid
 from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 from uuid import UUID
 
+import msgspec
+from acoustid_ext.fingerprint import compare_fingerprints
+from redis import Redis
 from sqlalchemy import Column, Row, Table, sql
+from statsd import StatsClient
 
 from acoustid import const
 from acoustid import tables as schema
-from acoustid.db import FingerprintDB, IngestDB, MusicBrainzDB, pg_advisory_xact_lock
+from acoustid.cache import TwoTierCache
+from acoustid.config import CacheConfig
+from acoustid.db import (
+    FingerprintDB,
+    IngestDB,
+    MusicBrainzDB,
+    pg_advisory_xact_lock,
+    run_after_commit,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class TrackMappingCache(object):
+    """MBIDs and meta ids of tracks, shared by all processes.
+
+    The functions in this module that change the mappings delete the entries
+    of the tracks they touch once their transaction commits, so a lookup
+    running in the meantime can't store the old mapping again.
+    """
+
+    def __init__(self, cache: TwoTierCache[Any]) -> None:
+        self.cache = cache
+
+    def lookup_mbids(self, conn, track_ids):
+        # type: (FingerprintDB, Iterable[int]) -> Dict[int, List[Tuple[str, int]]]
+        track_ids = list(dict.fromkeys(track_ids))
+        found = self.cache.get_many(f"mbids:{id}" for id in track_ids)
+        missing = [id for id in track_ids if f"mbids:{id}" not in found]
+        if missing:
+            loaded = _lookup_mbids(conn, missing)
+            # Tracks without MBIDs are cached too, as empty entries.
+            entries = {f"mbids:{id}": loaded.get(id, []) for id in missing}
+            self.cache.set_many(entries)
+            found.update(entries)
+        results = {}  # type: Dict[int, List[Tuple[str, int]]]
+        for id in track_ids:
+            mbids = found[f"mbids:{id}"]
+            if mbids:
+                results[id] = [(mbid, sources) for mbid, sources in mbids]
+        return results
+
+    def lookup_meta_ids(self, conn, track_ids, max_ids_per_track=None):
+        # type: (FingerprintDB, Iterable[int], Optional[int]) -> Dict[int, List[int]]
+        track_ids = list(dict.fromkeys(track_ids))
+        found = self.cache.get_many(f"meta:{id}" for id in track_ids)
+        results = {}  # type: Dict[int, List[int]]
+        missing = []
+        for id in track_ids:
+            # Entries are [limit, meta_ids] and only serve the same or
+            # a lower limit.
+            entry = found.get(f"meta:{id}")
+            if entry is None or not (
+                entry[0] is None
+                or (max_ids_per_track is not None and max_ids_per_track <= entry[0])
+            ):
+                missing.append(id)
+                continue
+            meta_ids = entry[1][:max_ids_per_track]
+            if meta_ids:
+                results[id] = meta_ids
+        if missing:
+            loaded = _lookup_meta_ids(conn, missing, max_ids_per_track)
+            self.cache.set_many(
+                {
+                    f"meta:{id}": [max_ids_per_track, loaded.get(id, [])]
+                    for id in missing
+                }
+            )
+            results.update(loaded)
+        return results
+
+    def invalidate(self, track_ids):
+        # type: (Iterable[int]) -> None
+        keys = []
+        for id in set(track_ids):
+            keys.append(f"mbids:{id}")
+            keys.append(f"meta:{id}")
+        self.cache.delete_many(keys)
+
+    def invalidate_after_commit(self, conn, track_ids):
+        # type: (FingerprintDB, Iterable[int]) -> None
+        track_ids = list(track_ids)
+        run_after_commit(conn, lambda: self.invalidate(track_ids))
+
+
+def encode_track_mapping_cache_entry(value: Any) -> bytes:
+    return msgspec.msgpack.encode(value)
+
+
+def decode_track_mapping_cache_entry(data: bytes) -> Any:
+    return msgspec.msgpack.decode(data)
+
+
+def create_track_mapping_cache(
+    config: CacheConfig, redis: Optional[Redis], statsd: Optional[StatsClient]
+) -> TrackMappingCache:
+    return TrackMappingCache(
+        TwoTierCache(
+            "track_mapping",
+            encode=encode_track_mapping_cache_entry,
+            decode=decode_track_mapping_cache_entry,
+            ttl=config.track_mapping_ttl,
+            local_size=config.track_mapping_local_size,
+            redis=redis,
+            statsd=statsd,
+        )
+    )
+
+
 def resolve_track_gid(conn: FingerprintDB, gid: str) -> int | None:
     query = sql.select(schema.track.c.id, schema.track.c.new_id).where(
         schema.track.c.gid == gid
@@ -29,13 +138,20 @@ def resolve_track_gid(conn: FingerprintDB, gid: str) -> int | None:
     return conn.execute(query).scalar()
 
 
-def lookup_mbids(conn, track_ids):
-    # type: (FingerprintDB, Iterable[int]) -> Dict[int, List[Tuple[str, int]]]
+def lookup_mbids(conn, track_ids, cache=None):
+    # type: (FingerprintDB, Iterable[int], Optional[TrackMappingCache]) -> Dict[int, List[Tuple[str, int]]]
     """
     Lookup MBIDs for the specified AcoustID track IDs.
     """
     if not track_ids:
         return {}
+    if cache is not None:
+        return cache.lookup_mbids(conn, track_ids)
+    return _lookup_mbids(conn, track_ids)
+
+
+def _lookup_mbids(conn, track_ids):
+    # type: (FingerprintDB, Iterable[int]) -> Dict[int, List[Tuple[str, int]]]
     query = sql.select(
         schema.track_mbid.c.track_id,
         schema.track_mbid.c.mbid,
@@ -54,10 +170,17 @@ def lookup_mbids(conn, track_ids):
     return results
 
 
-def lookup_meta_ids(conn, track_ids, max_ids_per_track=None):
-    # type: (FingerprintDB, Iterable[int], Optional[int]) -> Dict[int, List[int]]
+def lookup_meta_ids(conn, track_ids, max_ids_per_track=None, cache=None):
+    # type: (FingerprintDB, Iterable[int], Optional[int], Optional[TrackMappingCache]) -> Dict[int, List[int]]
     if not track_ids:
         return {}
+    if cache is not None:
+        return cache.lookup_meta_ids(conn, track_ids, max_ids_per_track)
+    return _lookup_meta_ids(conn, track_ids, max_ids_per_track)
+
+
+def _lookup_meta_ids(conn, track_ids, max_ids_per_track=None):
+    # type: (FingerprintDB, Iterable[int], Optional[int]) -> Dict[int, List[int]]
     query = (
         sql.select(schema.track_meta.c.track_id, schema.track_meta.c.meta_id)
         .where(
@@ -105,17 +228,20 @@ def disable_mbid(
     mbid: str,
     account_id: int,
     note: str,
+    cache: Optional[TrackMappingCache] = None,
 ) -> None:
     result = fingerprint_db.execute(
         schema.track_mbid.update()
-        .returning(schema.track_mbid.c.id)
+        .returning(schema.track_mbid.c.id, schema.track_mbid.c.track_id)
         .where(schema.track_mbid.c.mbid == mbid)
         .values(
             disabled=True,
             updated=sql.func.current_timestamp(),
         )
     )
+    track_ids = []
     for row in result:
+        track_ids.append(row.track_id)
         ingest_db.execute(
             schema.track_mbid_change.insert().values(
                 track_mbid_id=row.id,
@@ -125,6 +251,8 @@ def disable_mbid(
                 disabled=True,
             )
         )
+    if cache is not None:
+        cache.invalidate_after_commit(fingerprint_db, track_ids)
 
 
 def merge_mbids(
@@ -132,6 +260,7 @@ def merge_mbids(
     ingest_db: IngestDB,
     source_mbid: UUID,
     target_mbid: UUID,
+    cache: Optional[TrackMappingCache] = None,
 ) -> None:
     pg_advisory_xact_lock(fingerprint_db, "merge_mbids:target", str(target_mbid))
 
@@ -156,6 +285,9 @@ def merge_mbids(
         for row in fingerprint_db.execute(query):
             track_mbids_by_track_id.setdefault(row.track_id, {})[row.mbid] = row
 
+    if cache is not None:
+        cache.invalidate_after_commit(fingerprint_db, track_mbids_by_track_id.keys())
+
     for track_id, track_mbids in track_mbids_by_track_id.items():
         source = track_mbids.get(source_mbid)
         if source is None:
@@ -234,6 +366,7 @@ def merge_missing_mbid(
     ingest_db: IngestDB,
     musicbrainz_db: MusicBrainzDB,
     old_mbid: UUID,
+    cache: Optional[TrackMappingCache] = None,
 ) -> bool:
     """
     Lookup which MBIDs has been merged in MusicBrainz and merge then
@@ -246,7 +379,7 @@ def merge_missing_mbid(
         .where(schema.mb_recording_gid_redirect.c.gid == old_mbid)
     ).scalar_one_or_none()
     if new_mbid is not None:
-        merge_mbids(fingerprint_db, ingest_db, old_mbid, new_mbid)
+        merge_mbids(fingerprint_db, ingest_db, old_mbid, new_mbid, cache=cache)
         return True
 
     new_mbid = musicbrainz_db.execute(
@@ -322,12 +455,14 @@ def _merge_tracks_gids(fingerprint_db, ingest_db, name_with_id, target_id, sourc
             )
 
 
-def merge_tracks(fingerprint_db, ingest_db, target_id, source_ids):
-    # type: (FingerprintDB, IngestDB, int, List[int]) -> None
+def merge_tracks(fingerprint_db, ingest_db, target_id, source_ids, cache=None):
+    # type: (FingerprintDB, IngestDB, int, List[int], Optional[TrackMappingCache]) -> None
     """
     Merge the specified tracks.
     """
     logger.info("Merging tracks %s into %s", ", ".join(map(str, source_ids)), target_id)
+    if cache is not None:
+        cache.invalidate_after_commit(fingerprint_db, [target_id] + source_ids)
     _merge_tracks_gids(fingerprint_db, ingest_db, "mbid", target_id, source_ids)
     _merge_tracks_gids(fingerprint_db, ingest_db, "puid", target_id, source_ids)
     _merge_tracks_gids(fingerprint_db, ingest_db, "meta_id", target_id, source_ids)
@@ -402,9 +537,15 @@ def _insert_gid(
 
 
 def insert_mbid(
-    fingerprint_db, ingest_db, track_id, mbid, submission_id=None, source_id=None
+    fingerprint_db,
+    ingest_db,
+    track_id,
+    mbid,
+    submission_id=None,
+    source_id=None,
+    cache=None,
 ):
-    # type: (FingerprintDB, IngestDB, int, str, Optional[int], Optional[int]) -> None
+    # type: (FingerprintDB, IngestDB, int, str, Optional[int], Optional[int], Optional[TrackMappingCache]) -> None
     _insert_gid(
         fingerprint_db,
         ingest_db,
@@ -417,6 +558,8 @@ def insert_mbid(
         submission_id,
         source_id,
     )
+    if cache is not None:
+        cache.invalidate_after_commit(fingerprint_db, [track_id])
 
 
 def insert_puid(
@@ -461,9 +604,15 @@ def insert_track_foreignid(
 
 
 def insert_track_meta(
-    fingerprint_db, ingest_db, track_id, meta_id, submission_id=None, source_id=None
+    fingerprint_db,
+    ingest_db,
+    track_id,
+    meta_id,
+    submission_id=None,
+    source_id=None,
+    cache=None,
 ):
-    # type: (FingerprintDB, IngestDB, int, int, Optional[int], Optional[int]) -> None
+    # type: (FingerprintDB, IngestDB, int, int, Optional[int], Optional[int], Optional[TrackMappingCache]) -> None
     _insert_gid(
         fingerprint_db,
         ingest_db,
@@ -476,28 +625,36 @@ def insert_track_meta(
         submission_id,
         source_id,
     )
+    if cache is not None:
+        cache.invalidate_after_commit(fingerprint_db, [track_id])
 
 
-def calculate_fingerprint_similarity_matrix(conn, track_ids):
-    # type: (FingerprintDB, List[int]) -> Dict[int, Dict[int, float]]
-    fp1 = schema.fingerprint.alias("fp1")
-    fp2 = schema.fingerprint.alias("fp2")
-    src = fp1.join(fp2, fp1.c.id < fp2.c.id)
-    cond = sql.and_(fp1.c.track_id.in_(track_ids), fp2.c.track_id.in_(track_ids))
-    query = (
-        sql.select(
-            fp1.c.id,
-            fp2.c.id,
-            sql.func.acoustid_compare2(
-                fp1.c.fingerprint, fp2.c.fingerprint, const.TRACK_MAX_OFFSET
-            ),
+def calculate_fingerprint_similarity_matrix(conn, track_ids, compare_in_app=False):
+    # type: (FingerprintDB, List[int], bool) -> Dict[int, Dict[int, float]]
+    if compare_in_app:
+        rows = _compare_track_fingerprints(conn, track_ids)
+    else:
+        fp1 = schema.fingerprint.alias("fp1")
+        fp2 = schema.fingerprint.alias("fp2")
+        src = fp1.join(fp2, fp1.c.id < fp2.c.id)
+        cond = sql.and_(fp1.c.track_id.in_(track_ids), fp2.c.track_id.in_(track_ids))
+        query = (
+            sql.select(
+                fp1.c.id,
+                fp2.c.id,
+                sql.func.acoustid_compare2(
+                    fp1.c.fingerprint, fp2.c.fingerprint, const.TRACK_MAX_OFFSET
+                ),
+            )
+            .where(cond)
+            .select_from(src)
+            .order_by(fp1.c.id, fp2.c.id)
         )
-        .where(cond)
-        .select_from(src)
-        .order_by(fp1.c.id, fp2.c.id)
-    )
+        rows = [
+            (fp1_id, fp2_id, score) for fp1_id, fp2_id, score in conn.execute(query)
+        ]
     result = {}  # type: Dict[int, Dict[int, float]]
-    for fp1_id, fp2_id, score in conn.execute(query):
+    for fp1_id, fp2_id, score in rows:
         result.setdefault(fp1_id, {})[fp2_id] = score
         result.setdefault(fp2_id, {})[fp1_id] = score
         result.setdefault(fp1_id, {})[fp1_id] = 1.0
@@ -505,30 +662,70 @@ def calculate_fingerprint_similarity_matrix(conn, track_ids):
     return result
 
 
-def can_merge_tracks(conn, track_ids):
-    # type: (FingerprintDB, Iterable[int]) -> List[Set[int]]
-    fp1 = schema.fingerprint.alias("fp1")
-    fp2 = schema.fingerprint.alias("fp2")
-    join_cond = sql.and_(fp1.c.id < fp2.c.id, fp1.c.track_id < fp2.c.track_id)
-    src = fp1.join(fp2, join_cond)
-    cond = sql.and_(fp1.c.track_id.in_(track_ids), fp2.c.track_id.in_(track_ids))
+def _load_track_fingerprints(conn, track_ids):
+    # type: (FingerprintDB, Iterable[int]) -> List[Row[Any]]
     query = (
         sql.select(
-            fp1.c.track_id,
-            fp2.c.track_id,
-            sql.func.max(sql.func.abs(fp1.c.length - fp2.c.length)),
-            sql.func.min(
-                sql.func.acoustid_compare2(
-                    fp1.c.fingerprint, fp2.c.fingerprint, const.TRACK_MAX_OFFSET
-                )
-            ),
+            schema.fingerprint.c.id,
+            schema.fingerprint.c.track_id,
+            schema.fingerprint.c.length,
+            schema.fingerprint.c.fingerprint,
         )
-        .where(cond)
-        .select_from(src)
-        .group_by(fp1.c.track_id, fp2.c.track_id)
-        .order_by(fp1.c.track_id, fp2.c.track_id)
+        .where(schema.fingerprint.c.track_id.in_(track_ids))
+        .order_by(schema.fingerprint.c.id)
     )
-    rows = conn.execute(query)
+    return list(conn.execute(query))
+
+
+def _compare_track_fingerprints(conn, track_ids):
+    # type: (FingerprintDB, Iterable[int]) -> List[Tuple[int, int, float]]
+    """Score every pair of fingerprints of the tracks in the app tier.
+
+    Returns (fp1_id, fp2_id, score) with fp1_id < fp2_id, the same as
+    acoustid_compare2(fp1, fp2) would in the database.
+    """
+    fingerprints = _load_track_fingerprints(conn, track_ids)
+    result = []  # type: List[Tuple[int, int, float]]
+    for i, fp2 in enumerate(fingerprints):
+        others = fingerprints[:i]
+        scores = compare_fingerprints(
+            fp2.fingerprint,
+            [fp1.fingerprint for fp1 in others],
+            const.TRACK_MAX_OFFSET,
+            signed=True,
+        )
+        for fp1, score in zip(others, scores):
+            result.append((fp1.id, fp2.id, score))
+    return result
+
+
+def can_merge_tracks(conn, track_ids, compare_in_app=False):
+    # type: (FingerprintDB, Iterable[int], bool) -> List[Set[int]]
+    if compare_in_app:
+        rows = _compare_tracks(conn, track_ids)
+    else:
+        fp1 = schema.fingerprint.alias("fp1")
+        fp2 = schema.fingerprint.alias("fp2")
+        join_cond = sql.and_(fp1.c.id < fp2.c.id, fp1.c.track_id < fp2.c.track_id)
+        src = fp1.join(fp2, join_cond)
+        cond = sql.and_(fp1.c.track_id.in_(track_ids), fp2.c.track_id.in_(track_ids))
+        query = (
+            sql.select(
+                fp1.c.track_id,
+                fp2.c.track_id,
+                sql.func.max(sql.func.abs(fp1.c.length - fp2.c.length)),
+                sql.func.min(
+                    sql.func.acoustid_compare2(
+                        fp1.c.fingerprint, fp2.c.fingerprint, const.TRACK_MAX_OFFSET
+                    )
+                ),
+            )
+            .where(cond)
+            .select_from(src)
+            .group_by(fp1.c.track_id, fp2.c.track_id)
+            .order_by(fp1.c.track_id, fp2.c.track_id)
+        )
+        rows = [tuple(row) for row in conn.execute(query)]
     merges = {}  # type: Dict[int, int]
     for fp1_id, fp2_id, length_diff, score in rows:
         if score < const.TRACK_GROUP_MERGE_THRESHOLD:
@@ -545,15 +742,58 @@ def can_merge_tracks(conn, track_ids):
     return result
 
 
-def can_add_fp_to_track(conn, track_id, fingerprint, length):
-    # type: (FingerprintDB, int, List[int], int) -> bool
-    query = sql.select(
-        sql.func.acoustid_compare2(
-            schema.fingerprint.c.fingerprint, fingerprint, const.TRACK_MAX_OFFSET
-        ),
-        schema.fingerprint.c.length,
-    ).where(schema.fingerprint.c.track_id == track_id)
-    for fp_score, fp_length in conn.execute(query):
+def _compare_tracks(conn, track_ids):
+    # type: (FingerprintDB, Iterable[int]) -> List[Tuple[int, int, int, float]]
+    """Same as the can_merge_tracks query, but scored in the app tier.
+
+    Returns (track1_id, track2_id, max_length_diff, min_score) for each pair
+    of tracks with track1_id < track2_id.
+    """
+    fingerprints = _load_track_fingerprints(conn, track_ids)
+    pairs = {}  # type: Dict[Tuple[int, int], Tuple[int, float]]
+    for i, fp2 in enumerate(fingerprints):
+        others = [fp1 for fp1 in fingerprints[:i] if fp1.track_id < fp2.track_id]
+        scores = compare_fingerprints(
+            fp2.fingerprint,
+            [fp1.fingerprint for fp1 in others],
+            const.TRACK_MAX_OFFSET,
+            signed=True,
+        )
+        for fp1, score in zip(others, scores):
+            key = (fp1.track_id, fp2.track_id)
+            length_diff = abs(fp1.length - fp2.length)
+            if key in pairs:
+                max_length_diff, min_score = pairs[key]
+                length_diff = max(length_diff, max_length_diff)
+                score = min(score, min_score)
+            pairs[key] = (length_diff, score)
+    return [(t1, t2, d, s) for (t1, t2), (d, s) in sorted(pairs.items())]
+
+
+def can_add_fp_to_track(conn, track_id, fingerprint, length, compare_in_app=False):
+    # type: (FingerprintDB, int, List[int], int, bool) -> bool
+    if compare_in_app:
+        query = sql.select(
+            schema.fingerprint.c.fingerprint,
+            schema.fingerprint.c.length,
+        ).where(schema.fingerprint.c.track_id == track_id)
+        rows = list(conn.execute(query))
+        scores = compare_fingerprints(
+            fingerprint,
+            [row.fingerprint for row in rows],
+            const.TRACK_MAX_OFFSET,
+            signed=True,
+        )
+        results = [(score, row.length) for row, score in zip(rows, scores)]
+    else:
+        query = sql.select(
+            sql.func.acoustid_compare2(
+                schema.fingerprint.c.fingerprint, fingerprint, const.TRACK_MAX_OFFSET
+            ),
+            schema.fingerprint.c.length,
+        ).where(schema.fingerprint.c.track_id == track_id)
+        results = [(fp_score, fp_length) for fp_score, fp_length in conn.execute(query)]
+    for fp_score, fp_length in results:
         if fp_score < const.TRACK_GROUP_MERGE_THRESHOLD:
             return False
         if abs(fp_length - length) > const.FINGERPRINT_MAX_LENGTH_DIFF:
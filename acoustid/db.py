@@ -1,7 +1,9 @@
+import weakref
 import zlib
-from typing import TYPE_CHECKING, Any, Dict, NewType, Optional
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, NewType, Optional
 
-from sqlalchemy import sql
+from sqlalchemy import event, sql
 from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.orm import Session
 
@@ -37,6 +39,21 @@ def pg_advisory_xact_lock(db: Connection, name: str, params: str) -> None:
     )
 
 
+def set_statement_timeout(db: Connection, timeout: Optional[float]) -> None:
+    """Limit statements for the rest of the current transaction."""
+    if timeout is None:
+        return
+    # Zero would turn the limit off, rather than fail right away.
+    timeout_ms = max(1, int(timeout * 1000))
+    db.execute(
+        sql.text("SET LOCAL statement_timeout TO :timeout"), {"timeout": timeout_ms}
+    )
+
+
+def is_statement_timeout(ex: BaseException) -> bool:
+    return "canceling statement due to statement timeout" in str(ex)
+
+
 def get_bind_args(engines):
     # type: (Dict[str, Engine]) -> Dict[str, Any]
     binds = {}
@@ -68,6 +85,51 @@ def get_session_args(script, use_two_phase_commit=None):
     return kwargs
 
 
+# Callbacks waiting for the transaction of a connection to commit.
+_commit_callbacks = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Connection, List[Callable[[], None]]]
+
+
+def run_after_commit(conn, callback):
+    # type: (Connection, Callable[[], None]) -> None
+    """
+    Run the callback once the current transaction of the connection commits,
+    or right away if nothing tracks its commits. A rollback drops it.
+    """
+    callbacks = _commit_callbacks.get(conn)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+def run_commit_callbacks(callbacks):
+    # type: (List[Callable[[], None]]) -> None
+    pending = list(callbacks)
+    del callbacks[:]
+    for callback in pending:
+        callback()
+
+
+@contextmanager
+def track_commits(*conns):
+    # type: (Connection) -> Iterator[List[Callable[[], None]]]
+    """
+    Collect the callbacks of run_after_commit() for connections whose
+    transactions are committed by hand. The caller has to pass the list
+    to run_commit_callbacks() after the commit.
+    """
+    callbacks = []  # type: List[Callable[[], None]]
+    for conn in conns:
+        _commit_callbacks[conn] = callbacks
+    try:
+        yield callbacks
+    finally:
+        for conn in conns:
+            _commit_callbacks.pop(conn, None)
+
+
 class DatabaseContext(object):
     def __init__(self, script, use_two_phase_commit=None):
         # type: (Script, Optional[bool]) -> None
@@ -75,6 +137,17 @@ class DatabaseContext(object):
         self.session = Session(
             **get_session_args(script, use_two_phase_commit=use_two_phase_commit)
         )
+        self.commit_callbacks = []  # type: List[Callable[[], None]]
+        event.listen(self.session, "after_commit", self._after_commit)
+        event.listen(self.session, "after_rollback", self._after_rollback)
+
+    def _after_commit(self, session):
+        # type: (Session) -> None
+        run_commit_callbacks(self.commit_callbacks)
+
+    def _after_rollback(self, session):
+        # type: (Session) -> None
+        del self.commit_callbacks[:]
 
     def connection(self, bind_key, read_only=False):
         # type: (str, bool) -> Connection
@@ -82,7 +155,9 @@ class DatabaseContext(object):
             read_only_bind_key = bind_key + ":ro"
             if read_only_bind_key in self.engines:
                 bind_key = read_only_bind_key
-        return self.session.connection(bind_arguments={"bind": self.engines[bind_key]})
+        conn = self.session.connection(bind_arguments={"bind": self.engines[bind_key]})
+        _commit_callbacks[conn] = self.commit_callbacks
+        return conn
 
     def get_app_db(self, read_only=False):
         # type: (bool) -> AppDB
@@ -0,0 +1,38 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+from typing import Optional
+
+
+class Deadline(object):
+    """Time budget of a single request, shared by all of its stages.
+
+    Each stage asks for the time that is left, optionally capped by its own
+    timeout, and is expected to give up or degrade once the deadline passes.
+    A deadline without a timeout never expires.
+    """
+
+    def __init__(self, timeout: Optional[float] = None) -> None:
+        self.started = time.monotonic()
+        self.expires: Optional[float] = None
+        if timeout:
+            self.expires = self.started + timeout
+
+    def remaining(self) -> Optional[float]:
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeout(self, timeout: Optional[float] = None) -> Optional[float]:
+        """Time left for a stage with its own `timeout`, whichever is shorter."""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(remaining, timeout)
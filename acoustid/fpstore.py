@@ -1,11 +1,23 @@
+import array
+import itertools
 import logging
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Callable, Deque, List, Optional, Self, Sequence, TypeVar
 
+import msgspec
 import requests
+from requests.adapters import HTTPAdapter
+from statsd import StatsClient
 
+from acoustid.circuitbreaker import CircuitBreaker
 from acoustid.config import FpstoreConfig
-from acoustid.tracing import get_trace_id
+from acoustid.deadline import Deadline
+from acoustid.tracing import get_trace_id, initialize_trace_id
 
 logger = logging.getLogger(__name__)
 
@@ -16,33 +28,225 @@ class FpstoreSearchResult:
     score: float
 
 
+class SearchResult(msgspec.Struct):
+    id: int
+    score: float
+
+
+class SearchResponse(msgspec.Struct):
+    results: List[SearchResult] = []
+
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/vnd.msgpack"
+
+# Latency samples kept per replica, and how many are needed before they are
+# used for hedging or ejection decisions.
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+T = TypeVar("T")
+
+
+def with_trace_id(func: Callable[[], T]) -> Callable[[], T]:
+    """Carry the current trace ID into an executor thread."""
+    trace_id = get_trace_id()
+
+    def run() -> T:
+        # Context variables do not follow the work into the executor thread.
+        if trace_id is not None:
+            initialize_trace_id(trace_id)
+        return func()
+
+    return run
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def to_unsigned_hashes(hashes: Sequence[int]) -> "array.array[int]":
+    """Reinterpret the hashes as unsigned 32-bit integers.
+
+    The conversion happens on the array buffer, not per hash in Python.
+    """
+    if isinstance(hashes, array.array):
+        if hashes.typecode == "I":
+            return hashes
+        return array.array("I", hashes.tobytes())
+    try:
+        return array.array("I", array.array("i", hashes).tobytes())
+    except OverflowError:
+        return array.array("I", hashes)
+
+
+def encode_hashes(hashes: Sequence[int]) -> bytes:
+    """The hashes as little-endian unsigned 32-bit integers, for msgpack bin."""
+    unsigned = to_unsigned_hashes(hashes)
+    if sys.byteorder == "big":
+        unsigned = array.array("I", unsigned)
+        unsigned.byteswap()
+    return unsigned.tobytes()
+
+
+class FpstoreReplica:
+    def __init__(self, host: str, port: int) -> None:
+        self.name = f"{host}:{port}"
+        self.base_url = f"http://{host}:{port}/v1/fingerprint"
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def median_latency(self) -> Optional[float]:
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return percentile(self.latencies, 50)
+
+
 class FpstoreClient:
-    def __init__(self, cfg: FpstoreConfig) -> None:
-        self.base_url = f"http://{cfg.host}:{cfg.port}/v1/fingerprint"
+    def __init__(
+        self, cfg: FpstoreConfig, statsd: Optional[StatsClient] = None
+    ) -> None:
+        if cfg.encoding not in ("json", "msgpack"):
+            raise ValueError(f"Unsupported fpstore encoding: {cfg.encoding}")
+        self.replicas = [
+            FpstoreReplica(host, port) for host, port in cfg.get_replicas()
+        ]
+        self.encoding = cfg.encoding
+        self.keep_alive = cfg.keep_alive
+        self.hedge_percentile = cfg.hedge_percentile
+        self.hedge_min_delay = cfg.hedge_min_delay
+        self.eject_failures = cfg.eject_failures
+        self.eject_latency_factor = cfg.eject_latency_factor
+        self.eject_time = cfg.eject_time
+        self.breaker = CircuitBreaker(
+            "fpstore",
+            failure_threshold=cfg.breaker_failures,
+            reset_timeout=cfg.breaker_reset_timeout,
+            statsd=statsd,
+        )
+        self.lock = threading.Lock()
+        self.replica_counter = itertools.count()
         self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=len(self.replicas),
+            pool_maxsize=cfg.pool_size,
+            pool_block=cfg.pool_block,
+        )
+        self.session.mount("http://", adapter)
+        # Shared by all requests in the process, so it bounds how many searches
+        # a single worker can have in flight against fpstore at once, not just
+        # how many one batch lookup can.
+        self.executor = ThreadPoolExecutor(
+            max_workers=cfg.search_concurrency, thread_name_prefix="fpstore"
+        )
+        # Runs the individual attempts of a hedged search. Kept apart from the
+        # executor above, whose threads block waiting on these.
+        self.hedge_executor = ThreadPoolExecutor(
+            max_workers=cfg.pool_size, thread_name_prefix="fpstore-hedge"
+        )
 
-    def __enter__(self) -> "FpstoreClient":
+    def __enter__(self) -> Self:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self.close()
 
     def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.hedge_executor.shutdown(wait=False, cancel_futures=True)
         self.session.close()
 
+    def _pick_replicas(self, count: int) -> List[FpstoreReplica]:
+        """Pick up to `count` distinct replicas, round robin over healthy ones."""
+        now = time.monotonic()
+        healthy = [r for r in self.replicas if not r.is_ejected(now)]
+        if not healthy:
+            healthy = self.replicas
+        start = next(self.replica_counter)
+        return [
+            healthy[(start + i) % len(healthy)] for i in range(min(count, len(healthy)))
+        ]
+
+    def _hedge_delay(self) -> Optional[float]:
+        """How long to wait for a replica before asking another one."""
+        if self.hedge_percentile <= 0:
+            return None
+        latencies: List[float] = []
+        for replica in self.replicas:
+            latencies.extend(replica.latencies)
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, percentile(latencies, self.hedge_percentile))
+
+    def _eject(self, replica: FpstoreReplica, reason: str) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if replica.is_ejected(now):
+                return
+            if all(r.is_ejected(now) for r in self.replicas if r is not replica):
+                # Never eject the last replica standing.
+                return
+            replica.ejected_until = now + self.eject_time
+            replica.consecutive_failures = 0
+            # Start over when it comes back, instead of being judged on the
+            # samples that got it ejected.
+            replica.latencies.clear()
+        logger.warning(
+            "Ejecting fingerprint store replica %s for %ss (%s)",
+            replica.name,
+            self.eject_time,
+            reason,
+        )
+
+    def _record_success(self, replica: FpstoreReplica, latency: float) -> None:
+        replica.consecutive_failures = 0
+        replica.latencies.append(latency)
+        median = replica.median_latency()
+        if median is None or self.eject_latency_factor <= 0:
+            return
+        others = [r.median_latency() for r in self.replicas if r is not replica]
+        baseline = [m for m in others if m is not None]
+        if baseline and median > percentile(baseline, 50) * self.eject_latency_factor:
+            self._eject(replica, f"median latency {median * 1000:.0f}ms")
+
+    def _record_failure(self, replica: FpstoreReplica) -> None:
+        replica.consecutive_failures += 1
+        if self.eject_failures > 0:
+            if replica.consecutive_failures >= self.eject_failures:
+                self._eject(
+                    replica, f"{replica.consecutive_failures} consecutive failures"
+                )
+
     def _build_search_request(
         self,
+        replica: FpstoreReplica,
         query: List[int],
         limit: int,
         fast_mode: bool,
         min_score: float,
         timeout: float,
     ) -> requests.Request:
-        url = f"{self.base_url}/_search"
+        """Build the search request in the configured encoding.
+
+        JSON sends the hashes as an array of numbers. msgpack sends them as
+        a bin of little-endian unsigned 32-bit integers, copied from the
+        array buffer without creating a Python int per hash.
+        """
+        url = f"{replica.base_url}/_search"
+        hashes: object
+        if self.encoding == "msgpack":
+            hashes = encode_hashes(query)
+        else:
+            hashes = to_unsigned_hashes(query).tolist()
         body = {
             "fingerprint": {
                 "version": 1,
-                "hashes": [h & 0xFFFFFFFF for h in query],
+                "hashes": hashes,
             },
             "limit": limit,
             "fast_mode": fast_mode,
@@ -51,10 +255,19 @@ class FpstoreClient:
         headers = {
             "Grpc-Timeout": f"{int(timeout * 1000)}m",
         }
+        if self.encoding == "msgpack":
+            data = msgspec.msgpack.encode(body)
+            headers["Content-Type"] = MSGPACK_CONTENT_TYPE
+            headers["Accept"] = MSGPACK_CONTENT_TYPE
+        else:
+            data = msgspec.json.encode(body)
+            headers["Content-Type"] = JSON_CONTENT_TYPE
+        if not self.keep_alive:
+            headers["Connection"] = "close"
         trace_id = get_trace_id()
         if trace_id is not None:
             headers["Grpc-Metadata-trace_id"] = trace_id
-        return requests.Request("POST", url, json=body, headers=headers)
+        return requests.Request("POST", url, data=data, headers=headers)
 
     def _parse_search_response(
         self, response: requests.Response
@@ -74,28 +287,33 @@ class FpstoreClient:
                 )
                 response.raise_for_status()
 
-        results = []
-        for result in response.json()["results"]:
-            results.append(
-                FpstoreSearchResult(
-                    fingerprint_id=int(result["id"]),
-                    score=float(result["score"]),
-                )
+        # The server may ignore Accept, so go by what it actually sent.
+        # strict=False accepts int64 IDs encoded as strings, as in JSON.
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith(MSGPACK_CONTENT_TYPE):
+            parsed = msgspec.msgpack.decode(
+                response.content, type=SearchResponse, strict=False
             )
-        return results
+        else:
+            parsed = msgspec.json.decode(
+                response.content, type=SearchResponse, strict=False
+            )
+        return [
+            FpstoreSearchResult(fingerprint_id=result.id, score=result.score)
+            for result in parsed.results
+        ]
 
-    def search(
+    def _send_search(
         self,
+        replica: FpstoreReplica,
         query: List[int],
-        limit: int = 10,
-        fast_mode: bool = True,
-        min_score: float = 0.0,
-        timeout: Optional[float] = None,
+        limit: int,
+        fast_mode: bool,
+        min_score: float,
+        timeout: float,
     ) -> List[FpstoreSearchResult]:
-        if timeout is None:
-            timeout = 5.0
         request = self._build_search_request(
-            query, limit, fast_mode, min_score, timeout
+            replica, query, limit, fast_mode, min_score, timeout
         )
         prepared_request = self.session.prepare_request(request)
         try:
@@ -104,3 +322,177 @@ class FpstoreClient:
         except requests.exceptions.ReadTimeout as err:
             logger.warning("HTTP timeout while waiting for fingerprint store response")
             raise TimeoutError from err
+
+    def _search_replica(
+        self,
+        replica: FpstoreReplica,
+        query: List[int],
+        limit: int,
+        fast_mode: bool,
+        min_score: float,
+        timeout: float,
+        count_timeout: bool = True,
+    ) -> List[FpstoreSearchResult]:
+        started = time.monotonic()
+        try:
+            results = self._send_search(
+                replica, query, limit, fast_mode, min_score, timeout
+            )
+        except TimeoutError:
+            if count_timeout:
+                self._record_failure(replica)
+            raise
+        except Exception:
+            self._record_failure(replica)
+            raise
+        self._record_success(replica, time.monotonic() - started)
+        return results
+
+    def search(
+        self,
+        query: List[int],
+        limit: int = 10,
+        fast_mode: bool = True,
+        min_score: float = 0.0,
+        timeout: Optional[float] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> List[FpstoreSearchResult]:
+        """Search one replica, hedging with a second one if it is slow.
+
+        When the first replica has not answered within the configured
+        percentile of recent latencies, or fails, the same search is sent to
+        another replica and whichever answers first wins. With a `deadline`,
+        the timeout is cut to what is left of it, and a search that has no
+        time left raises TimeoutError without being sent. Only timeouts of
+        the whole configured time count as failures of the replicas and of
+        the circuit breaker, a tight deadline says nothing about their health.
+
+        Raises CircuitOpenError without sending anything while the circuit
+        breaker is open, after too many searches failed in a row.
+        """
+        if timeout is None:
+            timeout = 5.0
+        full_timeout = True
+        if deadline is not None:
+            if deadline.expired():
+                raise TimeoutError()
+            cut_timeout = deadline.timeout(timeout)
+            assert cut_timeout is not None
+            full_timeout = cut_timeout >= timeout
+            timeout = cut_timeout
+        self.breaker.check()
+        try:
+            results = self._search_hedged(
+                query, limit, fast_mode, min_score, timeout, deadline, full_timeout
+            )
+        except TimeoutError:
+            if full_timeout and (deadline is None or not deadline.expired()):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_ignored()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return results
+
+    def _search_hedged(
+        self,
+        query: List[int],
+        limit: int,
+        fast_mode: bool,
+        min_score: float,
+        timeout: float,
+        deadline: Optional[Deadline] = None,
+        full_timeout: bool = True,
+    ) -> List[FpstoreSearchResult]:
+        replicas = self._pick_replicas(2)
+        hedge_delay = self._hedge_delay() if len(replicas) > 1 else None
+        if hedge_delay is None:
+            return self._search_replica(
+                replicas[0], query, limit, fast_mode, min_score, timeout, full_timeout
+            )
+
+        def submit(
+            replica: FpstoreReplica, timeout: float, count_timeout: bool
+        ) -> "Future[List[FpstoreSearchResult]]":
+            return self.hedge_executor.submit(
+                with_trace_id(
+                    lambda: self._search_replica(
+                        replica,
+                        query,
+                        limit,
+                        fast_mode,
+                        min_score,
+                        timeout,
+                        count_timeout,
+                    )
+                )
+            )
+
+        # Both attempts share the timeout, the hedged one only gets what is
+        # left of it, and of the request's deadline.
+        expires = time.monotonic() + timeout
+
+        def time_left() -> float:
+            remaining: Optional[float] = expires - time.monotonic()
+            if deadline is not None:
+                remaining = deadline.timeout(remaining)
+            assert remaining is not None
+            return max(0.0, remaining)
+
+        error: Optional[BaseException] = None
+        pending = {submit(replicas[0], timeout, full_timeout)}
+        done, pending = wait(pending, timeout=hedge_delay)
+        for future in done:
+            error = future.exception()
+            if error is None:
+                return future.result()
+
+        remaining = time_left()
+        if remaining > 0:
+            logger.debug("Hedging fingerprint store search to %s", replicas[1].name)
+            # It only gets part of the time, so its timeout is not held
+            # against it.
+            pending.add(submit(replicas[1], remaining, False))
+        while pending:
+            done, pending = wait(
+                pending, timeout=time_left(), return_when=FIRST_COMPLETED
+            )
+            if not done:
+                raise TimeoutError()
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    return future.result()
+        assert error is not None
+        raise error
+
+    def submit_search(
+        self,
+        query: List[int],
+        limit: int = 10,
+        fast_mode: bool = True,
+        min_score: float = 0.0,
+        timeout: Optional[float] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> "Future[List[FpstoreSearchResult]]":
+        """Run search() on the client's executor.
+
+        Exceptions, including TimeoutError, are raised by the future's result().
+        The deadline is checked when the search starts, so time spent waiting
+        for a free thread counts against it.
+        """
+        return self.executor.submit(
+            with_trace_id(
+                lambda: self.search(
+                    query,
+                    limit=limit,
+                    fast_mode=fast_mode,
+                    min_score=min_score,
+                    timeout=timeout,
+                    deadline=deadline,
+                )
+            )
+        )
@@ -1,25 +1,172 @@
+import asyncio
+import logging
+import uuid
+from typing import Annotated, cast
+
 import msgspec
+from acoustid_ext.fingerprint import compare_fingerprints, extract_query
+from msgspec import ValidationError
 from starlette.authentication import requires
 from starlette.requests import Request
 from starlette.responses import Response
 
-from ..utils import MsgspecResponse
+from acoustid import const
+from acoustid.fingerprint import FingerprintError, FingerprintInfo, process_fingerprint
+from acoustid.future.data.db import FingerprintDB
+from acoustid.future.data.fingerprints import (
+    FingerprintCandidate,
+    get_fingerprint_candidates,
+)
+from acoustid.future.fpindex.client import FingerprintIndexClientError
+from acoustid.future.fpindex.client import SearchResult as IndexSearchResult
+
+from ..utils import ErrorResponse, MsgspecResponse, get_ctx
+
+logger = logging.getLogger(__name__)
+
+
+class SearchQuery(msgspec.Struct):
+    fingerprint: str
+    duration: Annotated[float, msgspec.Meta(gt=0)]
 
 
 class SearchRequest(msgspec.Struct):
-    pass
+    queries: Annotated[list[SearchQuery], msgspec.Meta(max_length=20)]
+
+
+class TrackMatch(msgspec.Struct):
+    id: uuid.UUID
+    score: float
+
+
+class SearchResult(msgspec.Struct):
+    tracks: list[TrackMatch] = msgspec.field(default_factory=list)
 
 
 class SearchResponse(msgspec.Struct):
-    pass
+    results: list[SearchResult] = msgspec.field(default_factory=list)
+
+
+ALLOWED_FINGERPRINT_VERSIONS = frozenset({1})
+
+# Same candidate selection as the fast mode of the v2 lookup.
+MAX_CANDIDATES = 10
+MIN_CANDIDATE_SCORE_PCT = 40
+
+
+def decode_fingerprints(queries: list[SearchQuery]) -> list[FingerprintInfo]:
+    fingerprints = []
+    for query in queries:
+        try:
+            fp = process_fingerprint(query.fingerprint)
+        except FingerprintError as e:
+            raise ValidationError("Invalid fingerprint") from e
+
+        if fp.version not in ALLOWED_FINGERPRINT_VERSIONS:
+            raise ValidationError("Unsupported fingerprint version")
+
+        if len(fp.hashes) < 10:
+            raise ValidationError("Fingerprint too short")
+
+        fingerprints.append(fp)
+    return fingerprints
+
+
+def select_candidates(results: list[IndexSearchResult]) -> list[int]:
+    """Keep the best index hits, relative to the top one."""
+    results = sorted(results, key=lambda r: -r.score)[:MAX_CANDIDATES]
+    if not results:
+        return []
+    min_score = results[0].score * MIN_CANDIDATE_SCORE_PCT / 100
+    return [r.id for r in results if r.score > min_score]
+
+
+def score_candidates(
+    fp: FingerprintInfo,
+    duration: float,
+    candidates: list[FingerprintCandidate],
+) -> SearchResult:
+    """Compare the fingerprint to the candidates and rank the matching tracks."""
+    candidates = [
+        c
+        for c in candidates
+        if abs(c["length"] - duration) <= const.FINGERPRINT_MAX_LENGTH_DIFF
+    ]
+    scores = compare_fingerprints(
+        fp.hashes,
+        [c["hashes"] for c in candidates],
+        const.TRACK_MAX_OFFSET,
+        signed=True,
+    )
+    track_scores: dict[uuid.UUID, float] = {}
+    for candidate, score in zip(candidates, scores):
+        if score <= const.TRACK_GROUP_MERGE_THRESHOLD:
+            continue
+        track_gid = candidate["track_gid"]
+        track_scores[track_gid] = max(score, track_scores.get(track_gid, 0.0))
+    tracks = [TrackMatch(id=gid, score=score) for gid, score in track_scores.items()]
+    tracks.sort(key=lambda t: -t.score)
+    return SearchResult(tracks=tracks)
+
+
+def score_all_candidates(
+    queries: list[SearchQuery],
+    fingerprints: list[FingerprintInfo],
+    candidate_ids: list[list[int]],
+    candidates: dict[int, FingerprintCandidate],
+) -> list[SearchResult]:
+    return [
+        score_candidates(
+            fp, query.duration, [candidates[i] for i in ids if i in candidates]
+        )
+        for query, fp, ids in zip(queries, fingerprints, candidate_ids)
+    ]
 
 
 @requires(["app"])
 async def handle_search(request: Request) -> Response:
-    body = await request.body()
-    req = msgspec.json.decode(body, type=SearchRequest)
+    ctx = get_ctx(request)
+    app_ctx = ctx.app_context
+
+    if request.method == "GET":
+        params = dict(request.query_params)
+        query = msgspec.convert(params, type=SearchQuery, strict=False, str_keys=True)
+        req = SearchRequest(queries=[query])
+    else:
+        body = await request.body()
+        req = msgspec.json.decode(body, type=SearchRequest)
+
+    # Decoding is CPU bound, keep it off the event loop.
+    fingerprints = await asyncio.to_thread(decode_fingerprints, req.queries)
+
+    try:
+        index_responses = await asyncio.gather(
+            *(
+                app_ctx.fpindex.search(
+                    app_ctx.config.fpindex.index_name,
+                    extract_query(fp.hashes).tolist(),
+                    limit=MAX_CANDIDATES,
+                )
+                for fp in fingerprints
+            )
+        )
+    except FingerprintIndexClientError:
+        logger.exception("Fingerprint index search failed")
+        return MsgspecResponse(
+            status_code=503, content=ErrorResponse(error="Search is not available")
+        )
+
+    candidate_ids = [select_candidates(r.results) for r in index_responses]
 
-    _ = req
+    candidates: dict[int, FingerprintCandidate] = {}
+    all_candidate_ids = {i for ids in candidate_ids for i in ids}
+    if all_candidate_ids:
+        async with app_ctx.get_fingerprint_db().connect() as db:
+            candidates = await get_fingerprint_candidates(
+                cast(FingerprintDB, db), all_candidate_ids
+            )
 
-    response = SearchResponse()
-    return MsgspecResponse(response)
+    results = await asyncio.to_thread(
+        score_all_candidates, req.queries, fingerprints, candidate_ids, candidates
+    )
+    return MsgspecResponse(SearchResponse(results=results))
@@ -7,6 +7,7 @@ from starlette.requests import Request
 from starlette.responses import Response
 
 from acoustid.config import Config
+from acoustid.future.fpindex.client import FingerprintIndexClient
 
 
 class MsgspecResponse(Response):
@@ -32,6 +33,7 @@ class AppContext:
     def __init__(self, config: Config) -> None:
         self.config = config
         self.database_engines = config.databases.create_async_engines()
+        self.fpindex = FingerprintIndexClient(config.fpindex.url)
 
     def get_fingerprint_db(self) -> AsyncEngine:
         return self.database_engines["fingerprint"]
@@ -43,6 +45,7 @@ class AppContext:
         return self.database_engines["ingest"]
 
     async def aclose(self) -> None:
+        await self.fpindex.close()
         for engine in self.database_engines.values():
             await engine.dispose()
 
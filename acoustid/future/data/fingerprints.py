@@ -0,0 +1,42 @@
+import uuid
+from typing import Iterable, TypedDict
+
+from sqlalchemy import sql
+
+import acoustid.tables as schema
+
+from .db import FingerprintDB
+
+
+class FingerprintCandidate(TypedDict):
+    id: int
+    length: int
+    hashes: list[int]
+    track_gid: uuid.UUID
+
+
+async def get_fingerprint_candidates(
+    db: FingerprintDB, fingerprint_ids: Iterable[int]
+) -> dict[int, FingerprintCandidate]:
+    """Load fingerprints with their track GIDs, keyed by fingerprint ID."""
+    stmt = (
+        sql.select(
+            schema.fingerprint.c.id,
+            schema.fingerprint.c.length,
+            schema.fingerprint.c.fingerprint,
+            schema.track.c.gid,
+        )
+        .select_from(schema.fingerprint)
+        .join(schema.track, schema.track.c.id == schema.fingerprint.c.track_id)
+        .where(schema.fingerprint.c.id.in_(list(fingerprint_ids)))
+    )
+    rows = await db.execute(stmt)
+    return {
+        row.id: FingerprintCandidate(
+            id=row.id,
+            length=row.length,
+            hashes=row.fingerprint,
+            track_gid=row.gid,
+        )
+        for row in rows
+    }
@@ -8,7 +8,9 @@ import socket
 import threading
 import time
 from collections import deque, namedtuple
-from typing import Any, List
+from typing import Any, List, Optional
+
+from acoustid.circuitbreaker import CircuitBreaker, CircuitOpenError
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +40,12 @@ class IndexClientConnectError(IndexClientError):
     pass
 
 
+class IndexClientUnavailableError(IndexClientError):
+    """The circuit breaker is open, the index server was not contacted."""
+
+    pass
+
+
 class Index(object):
     def begin(self):
         # type: () -> None
@@ -247,8 +255,10 @@ class IndexClientWrapper(Index):
     def __init__(self, pool=None, client=None):
         self._pool = pool
         self._client = client
+        # Whether this checkout has been counted by the circuit breaker yet
+        self._recorded = False
         self.ping = self._client.ping  # type: ignore
-        self.search = self._client.search  # type: ignore
+        self.search = self._search  # type: ignore
         self.begin = self._client.begin  # type: ignore
         self.commit = self._client.commit  # type: ignore
         self.rollback = self._client.rollback  # type: ignore
@@ -256,18 +266,38 @@ class IndexClientWrapper(Index):
         self.get_attribute = self._client.get_attribute  # type: ignore
         self.set_attribute = self._client.set_attribute  # type: ignore
 
+    def _search(self, fingerprint):
+        # type: (List[int]) -> List[Result]
+        self._recorded = True
+        try:
+            results = self._client.search(fingerprint)
+        except IndexClientError:
+            self._pool._record_failure()
+            raise
+        self._pool._record_success()
+        return results
+
     def __enter__(self):
         # type: () -> IndexClientWrapper
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # type: (Any, Any, Any) -> None
+        if exc_type is not None and issubclass(exc_type, IndexClientError):
+            if not self._recorded:
+                self._recorded = True
+                self._pool._record_failure()
         self.close()
 
     def __str__(self):
         return str(self._client)
 
     def close(self):
+        # A checkout without searches still tells the breaker that the
+        # server is reachable, and it ends the probe if it was one.
+        if not self._recorded:
+            self._recorded = True
+            self._pool._record_success()
         try:
             if self._client.in_transaction:
                 self._client.rollback()
@@ -279,10 +309,16 @@ class IndexClientWrapper(Index):
 
 class IndexClientPool(object):
     def __init__(
-        self, max_idle_clients: int = 5, recycle: int = -1, **kwargs: Any
+        self,
+        max_idle_clients: int = 5,
+        recycle: int = -1,
+        breaker: Optional[CircuitBreaker] = None,
+        **kwargs: Any,
     ) -> None:
         self.max_idle_clients = max_idle_clients
         self.recycle = recycle
+        # Connecting and searching count towards it, other requests do not.
+        self.breaker = breaker
         self.clients: deque[IndexClient] = deque()
         self.args = kwargs
         # Held only across the deque operations, never while talking to the
@@ -311,7 +347,20 @@ class IndexClientPool(object):
         logger.debug("Too many idle connections, closing %s", client)
         client.close()
 
+    def _record_success(self) -> None:
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    def _record_failure(self) -> None:
+        if self.breaker is not None:
+            self.breaker.record_failure()
+
     def connect(self) -> IndexClientWrapper:
+        if self.breaker is not None:
+            try:
+                self.breaker.check()
+            except CircuitOpenError as e:
+                raise IndexClientUnavailableError(str(e)) from e
         client: IndexClient | None = None
         with self.lock:
             if self.clients:
@@ -329,6 +378,10 @@ class IndexClientPool(object):
                 client.close()
                 client = None
         if client is None:
-            client = IndexClient(**self.args)
+            try:
+                client = IndexClient(**self.args)
+            except IndexClientError:
+                self._record_failure()
+                raise
         logger.debug("Checking out connection %s", client)
         return IndexClientWrapper(self, client)
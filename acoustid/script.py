@@ -14,7 +14,16 @@ from redis.sentinel import Sentinel as RedisSentinel
 from statsd import StatsClient
 
 from acoustid._release import GIT_RELEASE
+from acoustid.circuitbreaker import CircuitBreaker
 from acoustid.config import Config
+from acoustid.data.fingerprint import (
+    LookupCache,
+    LookupMissCache,
+    create_lookup_cache,
+    create_lookup_miss_cache,
+)
+from acoustid.data.musicbrainz import MetadataCache, create_metadata_cache
+from acoustid.data.track import TrackMappingCache, create_track_mapping_cache
 from acoustid.db import DatabaseContext
 from acoustid.fpstore import FpstoreClient
 from acoustid.indexclient import IndexClientPool
@@ -32,6 +41,10 @@ class ScriptContext(object):
         index: IndexClientPool,
         statsd: Optional[StatsClient],
         fpstore: Optional[FpstoreClient],
+        lookup_cache: Optional[LookupCache] = None,
+        lookup_miss_cache: Optional[LookupMissCache] = None,
+        metadata_cache: Optional[MetadataCache] = None,
+        track_mapping_cache: Optional[TrackMappingCache] = None,
     ) -> None:
         self.config = config
         self.db = db
@@ -39,6 +52,10 @@ class ScriptContext(object):
         self.index = index
         self.statsd = statsd
         self.fpstore = fpstore
+        self.lookup_cache = lookup_cache
+        self.lookup_miss_cache = lookup_miss_cache
+        self.metadata_cache = metadata_cache
+        self.track_mapping_cache = track_mapping_cache
 
     def __enter__(self):
         # type: () -> ScriptContext
@@ -69,7 +86,15 @@ class Script(object):
             self.statsd = None
 
         self.index = IndexClientPool(
-            host=self.config.index.host, port=self.config.index.port, recycle=60
+            host=self.config.index.host,
+            port=self.config.index.port,
+            recycle=60,
+            breaker=CircuitBreaker(
+                "index",
+                failure_threshold=self.config.index.breaker_failures,
+                reset_timeout=self.config.index.breaker_reset_timeout,
+                statsd=self.statsd,
+            ),
         )
 
         self.redis = None
@@ -92,11 +117,38 @@ class Script(object):
             )
 
         self.fpstore = (
-            FpstoreClient(self.config.fpstore)
+            FpstoreClient(self.config.fpstore, statsd=self.statsd)
             if self.config.fpstore.is_enabled()
             else None
         )
 
+        self.lookup_cache = None  # type: Optional[LookupCache]
+        if self.config.cache.lookup_ttl > 0:
+            self.lookup_cache = create_lookup_cache(
+                self.config.cache, self.get_redis(), self.statsd
+            )
+
+        self.lookup_miss_cache = None  # type: Optional[LookupMissCache]
+        if self.config.cache.lookup_miss_ttl > 0:
+            self.lookup_miss_cache = create_lookup_miss_cache(
+                self.config.cache, self.get_redis(), self.statsd
+            )
+
+        self.metadata_cache = None  # type: Optional[MetadataCache]
+        if (
+            self.config.cache.metadata_ttl > 0
+            or self.config.cache.metadata_dimension_size > 0
+        ):
+            self.metadata_cache = create_metadata_cache(
+                self.config.cache, self.get_redis(), self.statsd
+            )
+
+        self.track_mapping_cache = None  # type: Optional[TrackMappingCache]
+        if self.config.cache.track_mapping_ttl > 0:
+            self.track_mapping_cache = create_track_mapping_cache(
+                self.config.cache, self.get_redis(), self.statsd
+            )
+
         self._console_logging_configured = False
         if not tests:
             self.setup_logging()
@@ -145,6 +197,10 @@ class Script(object):
             index=self.index,
             statsd=self.statsd,
             fpstore=self.fpstore,
+            lookup_cache=self.lookup_cache,
+            lookup_miss_cache=self.lookup_miss_cache,
+            metadata_cache=self.metadata_cache,
+            track_mapping_cache=self.track_mapping_cache,
         )
 
 
@@ -4,12 +4,14 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import logging
+from typing import List, Optional
 
 from sqlalchemy import select, sql
 from sqlalchemy.dialects import postgresql as pg
 
 from acoustid import tables
 from acoustid.data.meta import generate_meta_gid
+from acoustid.data.track import TrackMappingCache
 from acoustid.db import FingerprintDB, IngestDB
 
 logger = logging.getLogger(__name__)
@@ -35,8 +37,9 @@ def update_last_meta_id(fingerprint_db, last_meta_id):
     fingerprint_db.execute(upsert_stmt)
 
 
-def backfill_meta_gid(fingerprint_db, ingest_db, last_meta_id, limit):
-    # type: (FingerprintDB, IngestDB, int, int) -> int
+def backfill_meta_gid(fingerprint_db, ingest_db, last_meta_id, limit, cache=None):
+    # type: (FingerprintDB, IngestDB, int, int, Optional[TrackMappingCache]) -> int
+    changed_track_ids = []  # type: List[int]
     query = (
         select(tables.meta)
         .where(tables.meta.c.id >= last_meta_id)
@@ -76,6 +79,7 @@ def backfill_meta_gid(fingerprint_db, ingest_db, last_meta_id, limit):
             track_ids_with_duplicates = [
                 row[0] for row in fingerprint_db.execute(query).all()
             ]
+            changed_track_ids.extend(track_ids_with_duplicates)
 
             for track_id in track_ids_with_duplicates:
                 query = (
@@ -131,8 +135,10 @@ def backfill_meta_gid(fingerprint_db, ingest_db, last_meta_id, limit):
                 tables.track_meta.update()
                 .where(tables.track_meta.c.meta_id == meta_id)
                 .values({"meta_id": new_meta_id})
+                .returning(tables.track_meta.c.track_id)
             )
-            fingerprint_db.execute(update_stmt)
+            result = fingerprint_db.execute(update_stmt)
+            changed_track_ids.extend(row[0] for row in result)
 
             insert_stmt = tables.meta_id_history.insert().values(
                 {"id": meta_id, "gid": meta_gid}
@@ -155,6 +161,8 @@ def backfill_meta_gid(fingerprint_db, ingest_db, last_meta_id, limit):
                 .values({"meta_gid": meta_gid})
             )
             ingest_db.execute(update_stmt)
+    if cache is not None and changed_track_ids:
+        cache.invalidate_after_commit(fingerprint_db, changed_track_ids)
     return last_meta_id
 
 
@@ -170,7 +178,11 @@ def run_backfill_meta_gid(script, opts, args):
             last_meta_id = get_last_meta_id(fingerprint_db)
             logging.info("Procesing meta from ID %s", last_meta_id)
             new_last_meta_id = backfill_meta_gid(
-                fingerprint_db, ingest_db, last_meta_id, 1000
+                fingerprint_db,
+                ingest_db,
+                last_meta_id,
+                1000,
+                cache=script.track_mapping_cache,
             )
             if last_meta_id == new_last_meta_id:
                 break
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+"""Time the JSON encoders on a large synthetic lookup response.
+
+The response has the shape of a batch lookup with
+meta=recordings+releasegroups+releases+tracks. It is encoded once as is,
+with many non-ASCII titles, and once with only ASCII text.
+
+    python manage.py run script benchmark_json_encoders
+"""
+
+import logging
+import time
+from typing import Any, Dict
+
+from acoustid.api import JSON_ENCODERS
+from acoustid.script import Script
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_COUNT = 20
+RECORDINGS_PER_RESULT = 5
+RELEASE_GROUPS_PER_RECORDING = 3
+RELEASES_PER_RELEASE_GROUP = 4
+REPEAT = 20
+
+
+def create_artists(i: int) -> list[Dict[str, Any]]:
+    return [
+        {"id": f"artist-{i}", "name": "Sigur Rós", "joinphrase": " & "},
+        {"id": f"artist-{i + 1}", "name": "Björk"},
+    ]
+
+
+def create_release(i: int, j: int) -> Dict[str, Any]:
+    date = {"year": 2001, "month": 5, "day": 22}
+    return {
+        "id": f"release-{i}-{j}",
+        "title": "Ágætis byrjun",
+        "country": "IS",
+        "date": date,
+        "releaseevents": [{"country": "IS", "date": date}],
+        "medium_count": 1,
+        "track_count": 10,
+        "mediums": [
+            {
+                "position": 1,
+                "format": "CD",
+                "track_count": 10,
+                "tracks": [
+                    {
+                        "id": f"track-{i}-{j}",
+                        "position": 3,
+                        "title": "Starálfur",
+                        "artists": create_artists(i),
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def create_recording(i: int) -> Dict[str, Any]:
+    return {
+        "id": f"recording-{i}",
+        "title": "Starálfur",
+        "duration": 406,
+        "artists": create_artists(i),
+        "releasegroups": [
+            {
+                "id": f"release-group-{i}-{j}",
+                "title": "Ágætis byrjun",
+                "type": "Album",
+                "secondarytypes": ["Compilation"],
+                "artists": create_artists(i),
+                "releases": [
+                    create_release(i, j * RELEASES_PER_RELEASE_GROUP + k)
+                    for k in range(RELEASES_PER_RELEASE_GROUP)
+                ],
+            }
+            for j in range(RELEASE_GROUPS_PER_RECORDING)
+        ],
+    }
+
+
+def create_response() -> Dict[str, Any]:
+    return {
+        "status": "ok",
+        "fingerprints": [
+            {
+                "index": str(n),
+                "results": [
+                    {
+                        "id": f"result-{n}",
+                        "score": 0.987654,
+                        "recordings": [
+                            create_recording(n * RECORDINGS_PER_RESULT + i)
+                            for i in range(RECORDINGS_PER_RESULT)
+                        ],
+                    }
+                ],
+            }
+            for n in range(FINGERPRINT_COUNT)
+        ],
+    }
+
+
+def strip_non_ascii(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: strip_non_ascii(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [strip_non_ascii(v) for v in value]
+    if isinstance(value, str):
+        return value.encode("ascii", "ignore").decode("ascii")
+    return value
+
+
+def benchmark(label: str, data: Dict[str, Any]) -> None:
+    expected = JSON_ENCODERS["json"](data)
+    baseline = None
+    for name, encode in JSON_ENCODERS.items():
+        best = float("inf")
+        for i in range(REPEAT):
+            t0 = time.perf_counter()
+            res = encode(data)
+            best = min(best, time.perf_counter() - t0)
+        if baseline is None:
+            baseline = best
+        logger.info(
+            "%s, encoder %s: %.1fms (%.1fx), %d bytes, %s",
+            label,
+            name,
+            1000 * best,
+            baseline / best,
+            len(res),
+            "same bytes" if res == expected else "different bytes",
+        )
+
+
+def run_benchmark_json_encoders(script: Script, opts, args) -> None:
+    data = create_response()
+    benchmark("Non-ASCII text", data)
+    benchmark("ASCII text", strip_non_ascii(data))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+"""Time the grouping of metadata rows by track on a large synthetic batch.
+
+Compares the grouping the lookup handler uses with a scan of all rows for
+every track, which is what it used to do.
+
+    python manage.py run script benchmark_metadata_grouping
+"""
+
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+
+from acoustid.api.v2 import LookupHandler
+from acoustid.script import Script
+
+logger = logging.getLogger(__name__)
+
+TRACK_COUNT = 1000
+RECORDINGS_PER_TRACK = 3
+ROWS_PER_RECORDING = 20
+REPEAT = 3
+
+
+def create_batch() -> Tuple[List[Dict[str, Any]], Dict[int, List[str]]]:
+    metadata = []
+    track_mbid_map = {}
+    for track_id in range(TRACK_COUNT):
+        mbids = []
+        for i in range(RECORDINGS_PER_TRACK):
+            mbid = f"recording-{track_id}-{i}"
+            mbids.append(mbid)
+            for j in range(ROWS_PER_RECORDING):
+                metadata.append({"recording_id": mbid, "release_id": f"release-{j}"})
+        track_mbid_map[track_id] = mbids
+    return metadata, track_mbid_map
+
+
+def scan_group_metadata(
+    metadata: List[Dict[str, Any]], track_mbid_map: Dict[int, List[str]]
+) -> Dict[int, List[Dict[str, Any]]]:
+    results: Dict[int, List[Dict[str, Any]]] = {}
+    for track_id, mbids in track_mbid_map.items():
+        mbids_set = set(mbids)
+        results[track_id] = [
+            item for item in metadata if item["recording_id"] in mbids_set
+        ]
+    return results
+
+
+def run_benchmark_metadata_grouping(script: Script, opts, args) -> None:
+    metadata, track_mbid_map = create_batch()
+    with script.context() as ctx:
+        handler = LookupHandler(ctx)
+        scan_time = index_time = float("inf")
+        for i in range(REPEAT):
+            t0 = time.perf_counter()
+            expected = scan_group_metadata(metadata, track_mbid_map)
+            scan_time = min(scan_time, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            groups = dict(handler._group_metadata(metadata, track_mbid_map))
+            index_time = min(index_time, time.perf_counter() - t0)
+
+    assert groups == expected
+    logger.info(
+        "Grouped %d rows for %d tracks: scan %.1fms, index %.1fms (%.0fx)",
+        len(metadata),
+        len(track_mbid_map),
+        1000 * scan_time,
+        1000 * index_time,
+        scan_time / index_time,
+    )
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+"""Compare lookups with the simhash prefilter to the full search.
+
+The queries are stored fingerprints with a little noise added, like a
+re-lookup of a known file. For each prefilter radius it reports how many
+queries the prefilter answers, how often its best track is the best track
+of the full search, and the latency of both.
+
+    python manage.py run script benchmark_simhash_prefilter
+"""
+
+import logging
+import random
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from acoustid import tables as schema
+from acoustid.data.fingerprint import (
+    SIMHASH_PREFILTER_MAX_RADIUS,
+    FingerprintMatch,
+    FingerprintSearcher,
+)
+from acoustid.script import Script, ScriptContext
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 200
+
+# Fraction of hashes that get a few low bits flipped.
+NOISE_RATE = 0.05
+
+
+def add_noise(fp: List[int], rate: float) -> List[int]:
+    result = []
+    for h in fp:
+        if random.random() < rate:
+            h ^= random.getrandbits(2) << random.randint(0, 20)
+        result.append(h)
+    return result
+
+
+def percentile(values: List[float], pct: int) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * pct // 100)]
+
+
+def sample_queries(ctx: ScriptContext, size: int) -> List[Tuple[List[int], int]]:
+    db = ctx.db.get_fingerprint_db(read_only=True)
+    min_id, max_id = db.execute(
+        select(func.min(schema.fingerprint.c.id), func.max(schema.fingerprint.c.id))
+    ).one()
+    queries: List[Tuple[List[int], int]] = []
+    if min_id is None:
+        return queries
+    for i in range(size * 10):
+        if len(queries) >= size:
+            break
+        row = db.execute(
+            select(schema.fingerprint.c.fingerprint, schema.fingerprint.c.length).where(
+                schema.fingerprint.c.id == random.randint(min_id, max_id)
+            )
+        ).first()
+        if row is not None:
+            queries.append((add_noise(list(row.fingerprint), NOISE_RATE), row.length))
+    return queries
+
+
+def timed_search(
+    searcher: FingerprintSearcher, fp: List[int], length: int
+) -> Tuple[Optional[List[FingerprintMatch]], float]:
+    t0 = time.perf_counter()
+    matches = searcher._search_many([(fp, length)])[0]
+    return matches, time.perf_counter() - t0
+
+
+def run_benchmark_simhash_prefilter(script: Script, opts, args) -> None:
+    with script.context() as ctx:
+        queries = sample_queries(ctx, SAMPLE_SIZE)
+        logger.info("Sampled %d queries", len(queries))
+
+        def create_searcher(
+            simhash_radius: Optional[int] = None,
+        ) -> FingerprintSearcher:
+            return FingerprintSearcher(
+                db=ctx.db.get_fingerprint_db(read_only=True),
+                index_pool=ctx.index,
+                fpstore=ctx.fpstore,
+                timeout=script.config.website.search_timeout,
+                compare_in_app=script.config.website.compare_in_app,
+                simhash_radius=simhash_radius,
+            )
+
+        full_searcher = create_searcher()
+        full_results = []
+        full_latencies = []
+        for fp, length in queries:
+            matches, latency = timed_search(full_searcher, fp, length)
+            full_results.append(matches)
+            full_latencies.append(latency)
+        logger.info(
+            "Full search: p50 %.1fms, p95 %.1fms",
+            1000 * percentile(full_latencies, 50),
+            1000 * percentile(full_latencies, 95),
+        )
+
+        for radius in range(SIMHASH_PREFILTER_MAX_RADIUS + 1):
+            searcher = create_searcher(radius)
+            hits = 0
+            agreed = 0
+            prefilter_latencies = []
+            latencies = []
+            for (fp, length), full_matches in zip(queries, full_results):
+                t0 = time.perf_counter()
+                (prefilter_matches,) = searcher._search_simhash_prefilter(
+                    [(fp, length)]
+                )
+                prefilter_latencies.append(time.perf_counter() - t0)
+                matches, latency = timed_search(searcher, fp, length)
+                latencies.append(latency)
+                if prefilter_matches is None:
+                    continue
+                hits += 1
+                if full_matches and (
+                    matches and matches[0].track_id == full_matches[0].track_id
+                ):
+                    agreed += 1
+            logger.info(
+                "Radius %d: answered %d/%d, same best track %d/%d, "
+                "prefilter p50 %.1fms p95 %.1fms, lookup p50 %.1fms p95 %.1fms",
+                radius,
+                hits,
+                len(queries),
+                agreed,
+                hits,
+                1000 * percentile(prefilter_latencies, 50),
+                1000 * percentile(prefilter_latencies, 95),
+                1000 * percentile(latencies, 50),
+                1000 * percentile(latencies, 95),
+            )
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+"""Compare the staged database search to the full query search.
+
+Uses the same noisy re-lookups as the simhash prefilter benchmark. It
+reports how many queries finish on the first stage, how often the staged
+search finds the best track of the full search, and the latency of both.
+
+    python manage.py run script benchmark_staged_search
+"""
+
+import logging
+import time
+
+from acoustid.data.fingerprint import FingerprintSearcher
+from acoustid.script import Script
+from acoustid.scripts.benchmark_simhash_prefilter import (
+    SAMPLE_SIZE,
+    percentile,
+    sample_queries,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def run_benchmark_staged_search(script: Script, opts, args) -> None:
+    with script.context() as ctx:
+        queries = sample_queries(ctx, SAMPLE_SIZE)
+        logger.info("Sampled %d queries", len(queries))
+
+        def create_searcher(staged: bool) -> FingerprintSearcher:
+            return FingerprintSearcher(
+                db=ctx.db.get_fingerprint_db(read_only=True),
+                index_pool=ctx.index,
+                fast=False,
+                timeout=script.config.website.search_timeout,
+                compare_in_app=script.config.website.compare_in_app,
+                staged=staged,
+            )
+
+        full_searcher = create_searcher(False)
+        staged_searcher = create_searcher(True)
+        first_stage = 0
+        found = 0
+        agreed = 0
+        full_latencies = []
+        staged_latencies = []
+        for fp, length in queries:
+            t0 = time.perf_counter()
+            full_matches = full_searcher._search_directly(fp, length)
+            t1 = time.perf_counter()
+            staged_matches = staged_searcher._search_directly(fp, length)
+            t2 = time.perf_counter()
+            full_latencies.append(t1 - t0)
+            staged_latencies.append(t2 - t1)
+            if staged_searcher._search_first_part(fp, length, [], 0, None):
+                first_stage += 1
+            if full_matches:
+                found += 1
+                if (
+                    staged_matches
+                    and staged_matches[0].track_id == full_matches[0].track_id
+                ):
+                    agreed += 1
+
+        logger.info(
+            "Finished on the first stage %d/%d, same best track %d/%d, "
+            "full p50 %.1fms p95 %.1fms, staged p50 %.1fms p95 %.1fms",
+            first_stage,
+            len(queries),
+            agreed,
+            found,
+            1000 * percentile(full_latencies, 50),
+            1000 * percentile(full_latencies, 95),
+            1000 * percentile(staged_latencies, 50),
+            1000 * percentile(staged_latencies, 95),
+        )
@@ -0,0 +1,159 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import datetime
+import logging
+from typing import Tuple
+
+from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql as pg
+
+from acoustid import tables as schema
+from acoustid.data.musicbrainz import (
+    RECORDING_DOCUMENT_MAX_AGE,
+    build_recording_documents,
+    get_last_replication_date,
+    save_recording_documents,
+)
+from acoustid.db import FingerprintDB, MusicBrainzDB
+from acoustid.script import Script, ScriptContext
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_BATCHES_PER_RUN = 20
+
+# Documents are rebuilt, oldest first, once they are this much behind the
+# last replication. That keeps them within RECORDING_DOCUMENT_MAX_AGE, and
+# so in use, as long as the runs in between get through all of them.
+REFRESH_AGE = RECORDING_DOCUMENT_MAX_AGE / 2
+MAX_REFRESH_BATCHES_PER_RUN = 40
+
+
+def get_status(db: FingerprintDB) -> int:
+    query = sql.select(schema.recording_metadata_status.c.last_track_mbid_id)
+    return db.execute(query).scalar() or 0
+
+
+def update_status(db: FingerprintDB, last_track_mbid_id: int) -> None:
+    values = {"last_track_mbid_id": last_track_mbid_id}
+    insert_stmt = pg.insert(schema.recording_metadata_status).values(
+        {"id": 1, **values}
+    )
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[schema.recording_metadata_status.c.id], set_=values
+    )
+    db.execute(upsert_stmt)
+
+
+def find_new_recordings(
+    db: FingerprintDB, last_track_mbid_id: int, limit: int
+) -> Tuple[list[str], int]:
+    """MBIDs of track_mbid rows added after the given one, that have no document."""
+    query = (
+        sql.select(schema.track_mbid.c.id, schema.track_mbid.c.mbid)
+        .where(schema.track_mbid.c.id > last_track_mbid_id)
+        .order_by(schema.track_mbid.c.id)
+        .limit(limit)
+    )
+    mbids = []
+    for row in db.execute(query):
+        mbids.append(str(row.mbid))
+        last_track_mbid_id = row.id
+    return filter_recordings(db, mbids, has_document=False), last_track_mbid_id
+
+
+def filter_recordings(
+    db: FingerprintDB, recording_ids: list[str], has_document: bool
+) -> list[str]:
+    recording_ids = list(dict.fromkeys(recording_ids))
+    if not recording_ids:
+        return []
+    query = sql.select(schema.recording_metadata.c.mbid).where(
+        schema.recording_metadata.c.mbid.in_(recording_ids)
+    )
+    with_document = {str(mbid) for mbid in db.execute(query).scalars()}
+    return [id for id in recording_ids if (id in with_document) == has_document]
+
+
+def build_documents(
+    ctx: ScriptContext,
+    musicbrainz_db: MusicBrainzDB,
+    recording_ids: list[str],
+    replication_date: datetime.datetime,
+) -> int:
+    documents = build_recording_documents(musicbrainz_db, recording_ids)
+    save_recording_documents(ctx.db.get_fingerprint_db(), documents, replication_date)
+    return len(documents)
+
+
+def find_stale_documents(
+    db: FingerprintDB, replication_date: datetime.datetime, limit: int
+) -> list[str]:
+    """MBIDs of documents due for a rebuild, oldest first."""
+    query = (
+        sql.select(schema.recording_metadata.c.mbid)
+        .where(
+            schema.recording_metadata.c.replication_date
+            < replication_date - REFRESH_AGE
+        )
+        .order_by(schema.recording_metadata.c.replication_date)
+        .limit(limit)
+    )
+    return [str(mbid) for mbid in db.execute(query).scalars()]
+
+
+def run_build_recording_documents(script: Script) -> None:
+    """Build documents for the new recordings and rebuild the oldest ones.
+
+    MusicBrainz edits are not followed one by one, the periodic rebuild
+    also picks up deleted ISRCs and changed release events.
+    """
+    if script.config.cluster.role != "master":
+        logger.info("Not running build_recording_documents in replica mode")
+        return
+
+    with script.context() as ctx:
+        musicbrainz_db = ctx.db.get_musicbrainz_db(read_only=True)
+        replication_date = get_last_replication_date(musicbrainz_db)
+        last_track_mbid_id = get_status(ctx.db.get_fingerprint_db())
+
+        built = 0
+        for i in range(MAX_BATCHES_PER_RUN):
+            fingerprint_db = ctx.db.get_fingerprint_db()
+            recording_ids, new_last_track_mbid_id = find_new_recordings(
+                fingerprint_db, last_track_mbid_id, BATCH_SIZE
+            )
+            if new_last_track_mbid_id == last_track_mbid_id:
+                break
+            if recording_ids:
+                built += build_documents(
+                    ctx, musicbrainz_db, recording_ids, replication_date
+                )
+            last_track_mbid_id = new_last_track_mbid_id
+            update_status(fingerprint_db, last_track_mbid_id)
+            ctx.db.session.commit()
+        if built:
+            logger.info(
+                "Built %d recording documents from replication %s",
+                built,
+                replication_date,
+            )
+
+        rebuilt = 0
+        for i in range(MAX_REFRESH_BATCHES_PER_RUN):
+            recording_ids = find_stale_documents(
+                ctx.db.get_fingerprint_db(), replication_date, BATCH_SIZE
+            )
+            if not recording_ids:
+                break
+            rebuilt += build_documents(
+                ctx, musicbrainz_db, recording_ids, replication_date
+            )
+            ctx.db.session.commit()
+        if rebuilt:
+            logger.info(
+                "Rebuilt %d recording documents from replication %s",
+                rebuilt,
+                replication_date,
+            )
@@ -68,7 +68,14 @@ def do_import(script: Script, limit: int = 100) -> int:
             )
 
             count = import_queued_submissions(
-                ingest_db, app_db, fingerprint_db, ctx.index, limit=1
+                ingest_db,
+                app_db,
+                fingerprint_db,
+                ctx.index,
+                limit=1,
+                compare_in_app=ctx.config.website.compare_in_app,
+                lookup_miss_cache=ctx.lookup_miss_cache,
+                track_mapping_cache=ctx.track_mapping_cache,
             )
             ctx.db.session.commit()
 
@@ -18,6 +18,8 @@ from acoustid.db import (
     IngestDB,
     MusicBrainzDB,
     pg_try_advisory_xact_lock,
+    run_commit_callbacks,
+    track_commits,
 )
 from acoustid.script import Script
 
@@ -51,6 +53,8 @@ def run_merge_missing_mbid(script: Script, mbid: str) -> None:
         app_db_conn = stack.enter_context(script.db_engines["app"].connect())
         app_db = cast(AppDB, app_db_conn)
 
+        commit_callbacks = stack.enter_context(track_commits(fingerprint_db))
+
         if not pg_try_advisory_xact_lock(fingerprint_db, "merge_missing_mbid", mbid):
             logger.info("MBID %s is already being merged", mbid)
             return
@@ -60,12 +64,14 @@ def run_merge_missing_mbid(script: Script, mbid: str) -> None:
             ingest_db=ingest_db,
             musicbrainz_db=musicbrainz_db,
             old_mbid=UUID(mbid),
+            cache=script.track_mapping_cache,
         )
         if handled:
             fingerprint_db_txn.prepare()
             ingest_db_txn.prepare()
             fingerprint_db_txn.commit()
             ingest_db_txn.commit()
+            run_commit_callbacks(commit_callbacks)
             return
 
         unknown_since: datetime.datetime | None = None
@@ -99,8 +105,10 @@ def run_merge_missing_mbid(script: Script, mbid: str) -> None:
             mbid=mbid,
             account_id=acoustid_bot_id,
             note="MBID has been unknown for too long",
+            cache=script.track_mapping_cache,
         )
         fingerprint_db_txn.prepare()
         ingest_db_txn.prepare()
         fingerprint_db_txn.commit()
         ingest_db_txn.commit()
+        run_commit_callbacks(commit_callbacks)
@@ -0,0 +1,73 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import logging
+
+from sqlalchemy import sql
+
+from acoustid import tables as schema
+from acoustid.db import FingerprintDB
+from acoustid.script import Script
+
+logger = logging.getLogger(__name__)
+
+# The most submitted recordings stand in for the most looked up ones.
+WARM_UP_RECORDING_COUNT = 10000
+WARM_UP_BATCH_SIZE = 500
+
+# (load_releases, load_release_groups, load_isrcs) as the lookup handler
+# asks for them for meta=recordings, meta=releases and meta=releasegroups.
+WARM_UP_FLAGS = [
+    (False, False, False),
+    (True, False, False),
+    (True, True, False),
+]
+
+WARMED_GENERATION_KEY = "metadata_cache:warmed_generation"
+
+
+def find_popular_recordings(db: FingerprintDB, limit: int) -> list[str]:
+    query = (
+        sql.select(schema.track_mbid.c.mbid)
+        .where(schema.track_mbid.c.disabled.is_(False))
+        .order_by(schema.track_mbid.c.submission_count.desc())
+        .limit(limit)
+    )
+    # The same recording can be linked to several tracks.
+    return list(dict.fromkeys(str(mbid) for mbid in db.execute(query).scalars()))
+
+
+def run_warm_metadata_cache(script: Script) -> None:
+    """Load metadata of the popular recordings after each replication."""
+    with script.context() as ctx:
+        metadata_cache = ctx.metadata_cache
+        # The dimension caches live in the API processes, only the shared
+        # recording cache can be warmed from here.
+        if metadata_cache is None or metadata_cache.cache is None:
+            return
+        musicbrainz_db = ctx.db.get_musicbrainz_db(read_only=True)
+        generation = metadata_cache.get_generation(musicbrainz_db)
+        warmed_generation = ctx.redis.get(WARMED_GENERATION_KEY)
+        if warmed_generation is not None and warmed_generation.decode() == generation:
+            logger.debug("Metadata cache is already warm for %s", generation)
+            return
+
+        recording_ids = find_popular_recordings(
+            ctx.db.get_fingerprint_db(read_only=True), WARM_UP_RECORDING_COUNT
+        )
+        for i in range(0, len(recording_ids), WARM_UP_BATCH_SIZE):
+            batch = recording_ids[i:][:WARM_UP_BATCH_SIZE]
+            for load_releases, load_release_groups, load_isrcs in WARM_UP_FLAGS:
+                metadata_cache.lookup_metadata(
+                    musicbrainz_db,
+                    batch,
+                    load_releases=load_releases,
+                    load_release_groups=load_release_groups,
+                    load_isrcs=load_isrcs,
+                )
+        ctx.redis.set(WARMED_GENERATION_KEY, generation)
+        logger.info(
+            "Warmed up the metadata cache with %d recordings for %s",
+            len(recording_ids),
+            generation,
+        )
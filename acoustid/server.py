@@ -4,12 +4,27 @@
 from __future__ import annotations
 
 import gzip
+import itertools
 import os
-from typing import TYPE_CHECKING, Any, Callable, Iterable, List, Optional, Tuple
+import time
+import zlib
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
+import zstd
 from sentry_sdk.integrations.wsgi import SentryWsgiMiddleware
 from six import BytesIO
+from statsd import StatsClient
 from werkzeug.exceptions import BadRequest, ClientDisconnected, HTTPException
+from werkzeug.http import parse_accept_header
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.routing import Map, Rule, RuleFactory, Submount
 from werkzeug.wrappers import Request
@@ -170,6 +185,204 @@ class GzipRequestMiddleware(object):
         return self.app(environ, start_response)
 
 
+COMPRESSIBLE_CONTENT_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+)
+
+
+class ResponseCompressionMiddleware(object):
+    """WSGI middleware to compress HTTP response bodies
+
+    Bodies of at least `min_size` bytes are compressed with zstd or gzip,
+    depending on the client's Accept-Encoding header. zstd is only offered
+    if `zstd_level` is set and it needs the whole body, gzip is streamed.
+
+    :param app: a WSGI application
+    """
+
+    def __init__(
+        self,
+        app: WSGIApplication,
+        min_size: int = 1024,
+        gzip_level: int = 6,
+        zstd_level: int = 0,
+        statsd: Optional[StatsClient] = None,
+    ) -> None:
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+        self.statsd = statsd
+
+    def choose_encoding(self, environ: WSGIEnvironment) -> Optional[str]:
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING"))
+        gzip_quality = accept.quality("gzip")
+        if self.zstd_level > 0:
+            zstd_quality = accept.quality("zstd")
+            if zstd_quality > 0 and zstd_quality >= gzip_quality:
+                return "zstd"
+        if gzip_quality > 0:
+            return "gzip"
+        return None
+
+    def __call__(
+        self, environ: WSGIEnvironment, start_response: StartResponse
+    ) -> Iterable[bytes]:
+        encoding = self.choose_encoding(environ)
+        if encoding is None:
+
+            def start_response_with_vary(
+                status: str,
+                headers: List[Tuple[str, str]],
+                exc_info: Optional[Any] = None,
+            ) -> Callable[[bytes], object]:
+                if self.is_compressible(headers):
+                    headers = add_vary_header(headers, "Accept-Encoding")
+                return start_response(status, headers, exc_info)
+
+            return self.app(environ, start_response_with_vary)
+
+        response = []  # type: List[Any]
+        written = []  # type: List[bytes]
+
+        def delayed_start_response(
+            status: str, headers: List[Tuple[str, str]], exc_info: Optional[Any] = None
+        ) -> Callable[[bytes], object]:
+            response[:] = [status, headers, exc_info]
+            return written.append
+
+        app_iter = self.app(environ, delayed_start_response)
+        return self.iter_response(encoding, app_iter, response, written, start_response)
+
+    def iter_response(
+        self,
+        encoding: str,
+        app_iter: Iterable[bytes],
+        response: List[Any],
+        written: List[bytes],
+        start_response: StartResponse,
+    ) -> Iterator[bytes]:
+        try:
+            body = iter(app_iter)
+            chunks = written
+            size = sum(len(chunk) for chunk in chunks)
+            for chunk in body:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+
+            status, headers, exc_info = response
+            compressible = self.is_compressible(headers)
+            if compressible:
+                headers = add_vary_header(headers, "Accept-Encoding")
+            if not compressible or size < self.min_size:
+                start_response(status, headers, exc_info)
+                yield from chunks
+                yield from body
+                return
+
+            # Streamed bodies have no length, those are compressed as they
+            # are produced, unless zstd is used
+            complete = False
+            other_headers = []
+            for name, value in headers:
+                if name.lower() == "content-length":
+                    complete = value == str(size)
+                else:
+                    other_headers.append((name, value))
+            headers = other_headers
+            headers.append(("Content-Encoding", encoding))
+
+            if complete or encoding == "zstd":
+                chunks.extend(body)
+                data = b"".join(chunks)
+                t0 = time.perf_counter()
+                if encoding == "zstd":
+                    compressed = zstd.compress(data, self.zstd_level)
+                else:
+                    compressed = gzip.compress(data, self.gzip_level, mtime=0)
+                duration = time.perf_counter() - t0
+                self.report(encoding, len(data), len(compressed), duration)
+                headers.append(("Content-Length", str(len(compressed))))
+                start_response(status, headers, exc_info)
+                yield compressed
+                return
+
+            start_response(status, headers, exc_info)
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            input_size = output_size = 0
+            duration = 0.0
+            for chunk in itertools.chain(chunks, body):
+                t0 = time.perf_counter()
+                compressed = compressor.compress(chunk)
+                duration += time.perf_counter() - t0
+                input_size += len(chunk)
+                output_size += len(compressed)
+                if compressed:
+                    yield compressed
+            t0 = time.perf_counter()
+            compressed = compressor.flush()
+            duration += time.perf_counter() - t0
+            output_size += len(compressed)
+            self.report(encoding, input_size, output_size, duration)
+            yield compressed
+        finally:
+            close = getattr(app_iter, "close", None)
+            if close is not None:
+                close()
+
+    def is_compressible(self, headers: List[Tuple[str, str]]) -> bool:
+        content_type = ""
+        for name, value in headers:
+            name = name.lower()
+            if name == "content-encoding":
+                return False
+            if name == "content-type":
+                content_type = value.lower()
+        return content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+
+    def report(
+        self, encoding: str, input_size: int, output_size: int, duration: float
+    ) -> None:
+        """Send the compression time and sizes, the ratio is output/input."""
+        if self.statsd is None:
+            return
+        statsd = self.statsd.pipeline()
+        statsd.timing(
+            f"api.response_compression_duration_seconds,encoding={encoding}",
+            1000 * duration,
+        )
+        statsd.incr(
+            f"api.response_compression_input_bytes_total,encoding={encoding}",
+            input_size,
+        )
+        statsd.incr(
+            f"api.response_compression_output_bytes_total,encoding={encoding}",
+            output_size,
+        )
+        statsd.send()
+
+
+def add_vary_header(
+    headers: List[Tuple[str, str]], value: str
+) -> List[Tuple[str, str]]:
+    result = []
+    found = False
+    for name, current in headers:
+        if name.lower() == "vary":
+            found = True
+            if value.lower() not in current.lower():
+                current = f"{current}, {value}"
+        result.append((name, current))
+    if not found:
+        result.append(("Vary", value))
+    return result
+
+
 def replace_double_slashes(app):
     # type: (WSGIApplication) -> WSGIApplication
     def wrapped_app(environ, start_response):
@@ -207,6 +420,14 @@ def make_application(config_path=None):
     server = Server(config_path)
     server.setup_sentry(component="api")
     server.wsgi_app = SentryWsgiMiddleware(server.wsgi_app)  # type: ignore
+    if server.config.website.response_compression:
+        server.wsgi_app = ResponseCompressionMiddleware(  # type: ignore
+            server.wsgi_app,
+            min_size=server.config.website.response_compression_min_size,
+            gzip_level=server.config.website.response_compression_gzip_level,
+            zstd_level=server.config.website.response_compression_zstd_level,
+            statsd=server.statsd,
+        )
     server.wsgi_app = GzipRequestMiddleware(server.wsgi_app)  # type: ignore
     server.wsgi_app = replace_double_slashes(server.wsgi_app)  # type: ignore
     server.wsgi_app = add_cors_headers(server.wsgi_app)  # type: ignore
@@ -658,6 +658,34 @@ track_mbid_change = Table(
     info={"bind_key": "ingest"},
 )
 
+# Everything lookup_metadata can load for a MusicBrainz recording, kept next to
+# track_mbid and rebuilt by the build_recording_documents task.
+recording_metadata = Table(
+    "recording_metadata",
+    metadata,
+    Column("mbid", UUID, primary_key=True),
+    Column("document", LargeBinary, nullable=False),
+    # MusicBrainz replication the document was built from
+    Column("replication_date", DateTime(timezone=True), nullable=False, index=True),
+    Column(
+        "updated",
+        DateTime(timezone=True),
+        server_default=sql.func.current_timestamp(),
+        nullable=False,
+    ),
+    info={"bind_key": "fingerprint"},
+)
+
+# Progress of the build_recording_documents task, the last track_mbid row it
+# has built documents for.
+recording_metadata_status = Table(
+    "recording_metadata_status",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("last_track_mbid_id", Integer, nullable=False),
+    info={"bind_key": "fingerprint"},
+)
+
 track_puid = Table(
     "track_puid",
     metadata,
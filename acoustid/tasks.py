@@ -1,10 +1,11 @@
 # Copyright (C) 2023 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import hashlib
 import json
 import random
 import time
-from typing import Dict, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 
 from acoustid.script import ScriptContext
 
@@ -12,18 +13,33 @@ NUM_QUEUES = 256
 
 
 def enqueue_task(
-    ctx: ScriptContext, name: str, kwargs: Dict[str, Union[str, int, float]]
-) -> None:
+    ctx: ScriptContext,
+    name: str,
+    kwargs: Dict[str, Union[str, int, float]],
+    dedup_ttl: Optional[int] = None,
+) -> bool:
+    """Add a task to one of the task queues.
+
+    With `dedup_ttl`, the same task with the same arguments is only enqueued
+    once per that many seconds. Returns False if it was skipped.
+    """
     data = {
         "name": name,
         "kwargs": kwargs,
     }
-    encoded_data = json.dumps(data).encode("utf-8")
+    encoded_data = json.dumps(data, sort_keys=True).encode("utf-8")
+    if dedup_ttl:
+        digest = hashlib.sha1(encoded_data).hexdigest()
+        if not ctx.redis.set(f"tasks:dedup:{digest}", 1, nx=True, ex=dedup_ttl):
+            if ctx.statsd is not None:
+                ctx.statsd.incr(f"tasks_deduplicated_total,task={name}")
+            return False
     queue = hash(encoded_data) % NUM_QUEUES
     key = f"tasks:{queue:02x}".encode("ascii")
     ctx.redis.rpush(key, encoded_data)
     if ctx.statsd is not None:
         ctx.statsd.incr(f"tasks_enqueued_total,task={name}")
+    return True
 
 
 def dequeue_task(
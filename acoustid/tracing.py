@@ -1,10 +1,14 @@
 import base64
+import time
 import uuid
+from contextlib import contextmanager
 from contextvars import ContextVar
-from typing import Optional
+from typing import Dict, Iterator, Optional
 
 trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
 
+spans: ContextVar[Optional[Dict[str, float]]] = ContextVar("spans", default=None)
+
 
 def generate_trace_id() -> str:
     raw_trace_id = uuid.uuid4().bytes
@@ -20,3 +24,33 @@ def initialize_trace_id(value: Optional[str] = None) -> str:
         value = generate_trace_id()
     trace_id.set(value)
     return value
+
+
+def initialize_spans() -> Dict[str, float]:
+    """Start collecting span durations in the current context."""
+    value: Dict[str, float] = {}
+    spans.set(value)
+    return value
+
+
+def get_spans() -> Optional[Dict[str, float]]:
+    return spans.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the `name` stage, in seconds.
+
+    Does nothing when spans are not being collected. Spans with the same name
+    add up and nested spans are counted in both.
+    """
+    durations = spans.get()
+    if durations is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        durations[name] = durations.get(name, 0.0) + elapsed
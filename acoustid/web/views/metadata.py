@@ -1,7 +1,16 @@
 import logging
 from typing import Any
 
-from flask import Blueprint, abort, redirect, render_template, request, session, url_for
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from sqlalchemy import sql
 from sqlalchemy.orm import load_only
 from werkzeug.wrappers.response import Response
@@ -284,6 +293,9 @@ def toggle_track_mbid() -> str | Response:
         )
         ingest_db.execute(insert_stmt)
         db.session.commit()
+        track_mapping_cache = current_app.acoustid_script.track_mapping_cache  # type: ignore
+        if track_mapping_cache is not None:
+            track_mapping_cache.invalidate([track_id])
         return redirect(url_for(".track", track_id_or_gid=track_id))
     if state:
         title = "Unlink MBID"
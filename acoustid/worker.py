@@ -10,6 +10,7 @@ import sentry_sdk
 import sentry_sdk.consts
 
 from acoustid.script import Script
+from acoustid.scripts.build_recording_documents import run_build_recording_documents
 from acoustid.scripts.fpindex_changelog import run_manage_fpindex_changelog
 from acoustid.scripts.merge_missing_mbids import run_merge_missing_mbid
 from acoustid.scripts.update_lookup_stats import (
@@ -21,6 +22,7 @@ from acoustid.scripts.update_user_agent_stats import (
     run_update_all_user_agent_stats,
     run_update_user_agent_stats,
 )
+from acoustid.scripts.warm_metadata_cache import run_warm_metadata_cache
 from acoustid.tasks import dequeue_task
 from acoustid.tracing import initialize_trace_id
 
@@ -37,6 +39,8 @@ TASKS: Dict[str, TaskFunc] = {
     "update_all_user_agent_stats": run_update_all_user_agent_stats,
     "merge_missing_mbid": run_merge_missing_mbid,
     "manage_fpindex_changelog": run_manage_fpindex_changelog,
+    "warm_metadata_cache": run_warm_metadata_cache,
+    "build_recording_documents": run_build_recording_documents,
 }
 
 
@@ -0,0 +1,51 @@
+"""drop recording_metadata_status.replication_date
+
+Revision ID: a4f0d7c2b918
+Revises: e7b41c9d2a53
+Create Date: 2026-10-18 21:40:00.000000
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a4f0d7c2b918"
+down_revision = "e7b41c9d2a53"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_app():
+    pass
+
+
+def downgrade_app():
+    pass
+
+
+def upgrade_ingest():
+    pass
+
+
+def downgrade_ingest():
+    pass
+
+
+def upgrade_fingerprint():
+    op.drop_column("recording_metadata_status", "replication_date")
+
+
+def downgrade_fingerprint():
+    op.add_column(
+        "recording_metadata_status",
+        sa.Column("replication_date", sa.DateTime(timezone=True), nullable=True),
+    )
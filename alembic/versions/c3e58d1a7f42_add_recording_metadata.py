@@ -0,0 +1,71 @@
+"""add recording_metadata
+
+Revision ID: c3e58d1a7f42
+Revises: a1f4c72b90de
+Create Date: 2026-10-18 11:42:00.000000
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c3e58d1a7f42"
+down_revision = "a1f4c72b90de"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_app():
+    pass
+
+
+def downgrade_app():
+    pass
+
+
+def upgrade_ingest():
+    pass
+
+
+def downgrade_ingest():
+    pass
+
+
+def upgrade_fingerprint():
+    op.create_table(
+        "recording_metadata",
+        sa.Column("mbid", sa.UUID(), nullable=False),
+        sa.Column("document", sa.LargeBinary(), nullable=False),
+        sa.Column("replication_date", sa.DateTime(timezone=True), nullable=False),
+        sa.Column(
+            "updated",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("mbid", name=op.f("recording_metadata_pkey")),
+        info={"bind_key": "fingerprint"},
+    )
+    op.create_index(
+        op.f("recording_metadata_idx_replication_date"),
+        "recording_metadata",
+        ["replication_date"],
+        unique=False,
+    )
+
+
+def downgrade_fingerprint():
+    op.drop_index(
+        op.f("recording_metadata_idx_replication_date"),
+        table_name="recording_metadata",
+    )
+    op.drop_table("recording_metadata")
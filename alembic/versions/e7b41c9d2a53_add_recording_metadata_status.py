@@ -0,0 +1,55 @@
+"""add recording_metadata_status
+
+Revision ID: e7b41c9d2a53
+Revises: c3e58d1a7f42
+Create Date: 2026-10-18 15:20:00.000000
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e7b41c9d2a53"
+down_revision = "c3e58d1a7f42"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_app():
+    pass
+
+
+def downgrade_app():
+    pass
+
+
+def upgrade_ingest():
+    pass
+
+
+def downgrade_ingest():
+    pass
+
+
+def upgrade_fingerprint():
+    op.create_table(
+        "recording_metadata_status",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("last_track_mbid_id", sa.Integer(), nullable=False),
+        sa.Column("replication_date", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("id", name=op.f("recording_metadata_status_pkey")),
+        info={"bind_key": "fingerprint"},
+    )
+
+
+def downgrade_fingerprint():
+    op.drop_table("recording_metadata_status")
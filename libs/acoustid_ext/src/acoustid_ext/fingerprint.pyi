@@ -1,7 +1,7 @@
 # fmt: off
 
 import array
-from typing import Literal, NamedTuple, overload
+from typing import Literal, NamedTuple, Sequence, overload
 
 class Fingerprint(NamedTuple):
     hashes: array.array[int]
@@ -68,4 +68,28 @@ def compute_shingled_simhashes(
 ) -> array.array[int]: ...
 
 
+def extract_query(
+    hashes: list[int] | array.array[int],
+    size: int = 120,
+    start: int = 80,
+    signed: bool = False,
+) -> array.array[int]: ...
+
+
+def compare_fingerprints(
+    query: list[int] | array.array[int],
+    candidates: Sequence[list[int] | array.array[int]],
+    max_offset: int = 0,
+    signed: bool = False,
+) -> array.array[float]: ...
+
+
+def compare_fingerprint(
+    a: list[int] | array.array[int],
+    b: list[int] | array.array[int],
+    max_offset: int = 0,
+    signed: bool = False,
+) -> float: ...
+
+
 def decode_postgres_array(data: str | bytes, *, signed: bool = True) -> array.array[int]: ...
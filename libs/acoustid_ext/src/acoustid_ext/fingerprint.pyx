@@ -3,8 +3,10 @@ import cython
 from cpython cimport array
 from cpython.bytes cimport PyBytes_AsString, PyBytes_FromStringAndSize
 from cpython.unicode cimport PyUnicode_AsUTF8String, PyUnicode_FromStringAndSize
-from libc.math cimport abs
-from libc.stdint cimport int32_t, uint8_t, uint32_t, uint64_t
+from libc.math cimport abs, pow
+from libc.stdint cimport int32_t, uint8_t, uint16_t, uint32_t, uint64_t
+from libc.stdlib cimport free, malloc
+from libc.string cimport memset
 
 import array
 from typing import NamedTuple
@@ -442,6 +444,263 @@ def compute_shingled_simhashes(array.array hashes, int shingle_size, int step, b
     return result
 
 
+cdef uint32_t QUERY_SILENCE_HASH = 627964279
+cdef uint32_t QUERY_BIT_MASK = 0xFFFFFFF0  # top 28 bits
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def extract_query(object hashes, int size=120, int start=80, bint signed=False):
+    """Extract the terms used to search for a fingerprint in the index.
+
+    Bit-exact port of the acoustid_extract_query() SQL function. Silence
+    hashes are skipped, the remaining ones are masked to their top 28 bits
+    and duplicates are dropped.
+
+    Args:
+        hashes: List or array.array of integer hash values
+        size: Maximum number of terms in the query
+        start: Index of the first hash to use, moved back for short fingerprints
+        signed: Whether the hash values are signed integers
+
+    Returns:
+        array.array with the query terms
+    """
+
+    cdef array.array hashes_as_array
+
+    if isinstance(hashes, list):
+        if signed:
+            hashes_as_array = array.array('i', hashes)
+        else:
+            hashes_as_array = array.array('I', hashes)
+    elif isinstance(hashes, array.array):
+        if hashes.itemsize != 4 or hashes.typecode not in ('i', 'I'):
+            raise TypeError("hashes array must have typecode 'i' or 'I'")
+        hashes_as_array = hashes
+    else:
+        raise TypeError("Invalid hashes, must be list or array.array")
+
+    cdef array.array query = array.array('i' if signed else 'I', [])
+    if size <= 0:
+        return query
+    array.resize(query, size)
+
+    cdef uint32_t* data = hashes_as_array.data.as_uints
+    cdef uint32_t* terms = query.data.as_uints
+    cdef int num_hashes = len(hashes_as_array)
+    cdef int clean_size = 0, query_size = 0
+    cdef int i, j
+    cdef uint32_t hash
+    cdef bint seen
+
+    with nogil:
+        for i in range(num_hashes):
+            if data[i] != QUERY_SILENCE_HASH:
+                clean_size += 1
+
+        if clean_size > 0:
+            i = clean_size - size
+            if i > start:
+                i = start
+            if i < 0:
+                i = 0
+            while i < num_hashes and query_size < size:
+                hash = data[i]
+                i += 1
+                if hash == QUERY_SILENCE_HASH:
+                    continue
+                hash &= QUERY_BIT_MASK
+                seen = False
+                for j in range(query_size):
+                    if terms[j] == hash:
+                        seen = True
+                        break
+                if not seen:
+                    terms[query_size] = hash
+                    query_size += 1
+
+    array.resize(query, query_size)
+    return query
+
+
+cdef array.array as_hash_array(object hashes, bint signed):
+    if isinstance(hashes, list):
+        if signed:
+            return array.array('i', hashes)
+        else:
+            return array.array('I', hashes)
+    elif isinstance(hashes, array.array):
+        if hashes.itemsize != 4 or hashes.typecode not in ('i', 'I'):
+            raise TypeError("hashes array must have typecode 'i' or 'I'")
+        return hashes
+    else:
+        raise TypeError("Invalid hashes, must be list or array.array")
+
+
+# The constants and quirks below follow acoustid_compare2() in the
+# PostgreSQL extension, so that scores match the database bit for bit.
+# Notably the uniqueness counts use MATCH_BITS rather than 16 bits, and
+# the top bucket and hashes at position 0 never contribute to the
+# offset histogram.
+cdef extern from *:
+    """
+    #define COMPARE_MATCH_BITS 14
+    #define COMPARE_MATCH_MASK ((1 << COMPARE_MATCH_BITS) - 1)
+    #define COMPARE_MATCH_STRIP(x) ((uint32_t)(x) >> (32 - COMPARE_MATCH_BITS))
+    #define COMPARE_POPCOUNT(x) __builtin_popcount(x)
+    """
+    int COMPARE_MATCH_MASK
+    uint32_t COMPARE_MATCH_STRIP(uint32_t x) noexcept nogil
+    int COMPARE_POPCOUNT(uint32_t x) noexcept nogil
+
+
+cdef int index_hashes(const uint32_t* hashes, int size, uint16_t* offsets, uint16_t* counts) noexcept nogil:
+    cdef int i, uniq = 0
+    cdef uint32_t key
+    memset(offsets, 0, sizeof(uint16_t) * (COMPARE_MATCH_MASK + 1))
+    memset(counts, 0, sizeof(uint16_t) * (COMPARE_MATCH_MASK + 1))
+    for i in range(size):
+        key = COMPARE_MATCH_STRIP(hashes[i])
+        offsets[key] = <uint16_t>i
+        counts[key] += 1
+    for i in range(COMPARE_MATCH_MASK):
+        if counts[i] > 0:
+            uniq += 1
+    return uniq
+
+
+@cython.cdivision(True)
+cdef float compare_indexed_hashes(
+    const uint32_t* a, int asize, const uint16_t* aoffsets, int auniq,
+    const uint32_t* b, int bsize, const uint16_t* boffsets, int buniq,
+    int max_offset, int* counts,
+) noexcept nogil:
+    cdef int i, offset, size, minsize, biterror
+    cdef int topcount = 0, topoffset = 0
+    cdef float score, diversity
+    cdef double adiversity, bdiversity
+
+    memset(counts, 0, sizeof(int) * (asize + bsize + 1))
+    for i in range(COMPARE_MATCH_MASK):
+        if aoffsets[i] and boffsets[i]:
+            offset = <int>aoffsets[i] - <int>boffsets[i]
+            if max_offset == 0 or (-max_offset <= offset and offset <= max_offset):
+                offset += bsize
+                counts[offset] += 1
+                if counts[offset] > topcount:
+                    topcount = counts[offset]
+                    topoffset = offset
+    topoffset -= bsize
+
+    minsize = min(asize, bsize) & ~1
+    if topoffset < 0:
+        b -= topoffset
+        bsize = max(0, bsize + topoffset)
+    else:
+        a += topoffset
+        asize = max(0, asize - topoffset)
+
+    size = min(asize, bsize) // 2
+    if size == 0 or minsize == 0:
+        return 0.0
+
+    adiversity = min(1.0, <float>(auniq + 10) / asize + 0.5)
+    bdiversity = min(1.0, <float>(buniq + 10) / bsize + 0.5)
+    diversity = <float>min(adiversity, bdiversity)
+
+    if topcount < max(auniq, buniq) * 0.02:
+        return 0.0
+
+    biterror = 0
+    for i in range(size * 2):
+        biterror += COMPARE_POPCOUNT(a[i] ^ b[i])
+
+    score = <float>((size * 2.0 / minsize) * (1.0 - 2.0 * <float>biterror / (64 * size)))
+    if score < 0.0:
+        score = 0.0
+    if diversity < 1.0:
+        score = <float>pow(score, 8.0 - 7.0 * diversity)
+    return score
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def compare_fingerprints(object query, object candidates, int max_offset=0, bint signed=False):
+    """Score a query fingerprint against a batch of candidate fingerprints.
+
+    Scores are the same as acoustid_compare2(candidate, query, max_offset)
+    in the database. The query is indexed only once for the whole batch and
+    the scoring runs without holding the GIL.
+
+    Args:
+        query: List or array.array of integer hash values
+        candidates: Sequence of lists or array.arrays of integer hash values
+        max_offset: Maximum alignment offset to consider, 0 for any
+        signed: Whether the hash values are signed integers
+
+    Returns:
+        array.array of float scores, one per candidate
+    """
+
+    cdef array.array query_hashes = as_hash_array(query, signed)
+    cdef list candidate_hashes = [as_hash_array(c, signed) for c in candidates]
+    cdef int num_candidates = len(candidate_hashes)
+
+    cdef array.array scores = array.array('f', [])
+    array.resize(scores, num_candidates)
+    if num_candidates == 0:
+        return scores
+
+    cdef int query_size = len(query_hashes)
+    cdef int max_candidate_size = max([len(c) for c in candidate_hashes])
+    cdef const uint32_t** candidate_ptrs = NULL
+    cdef int* candidate_sizes = NULL
+    cdef uint16_t* tables = NULL
+    cdef int* counts = NULL
+    cdef int i, query_uniq, candidate_uniq
+    cdef int table_size = COMPARE_MATCH_MASK + 1
+
+    try:
+        candidate_ptrs = <const uint32_t**>malloc(sizeof(uint32_t*) * num_candidates)
+        candidate_sizes = <int*>malloc(sizeof(int) * num_candidates)
+        tables = <uint16_t*>malloc(sizeof(uint16_t) * table_size * 4)
+        counts = <int*>malloc(sizeof(int) * (query_size + max_candidate_size + 1))
+        if not candidate_ptrs or not candidate_sizes or not tables or not counts:
+            raise MemoryError()
+
+        for i in range(num_candidates):
+            candidate_ptrs[i] = (<array.array>candidate_hashes[i]).data.as_uints
+            candidate_sizes[i] = len(candidate_hashes[i])
+
+        with nogil:
+            query_uniq = index_hashes(
+                query_hashes.data.as_uints, query_size, tables, tables + table_size
+            )
+            for i in range(num_candidates):
+                candidate_uniq = index_hashes(
+                    candidate_ptrs[i], candidate_sizes[i],
+                    tables + 2 * table_size, tables + 3 * table_size,
+                )
+                scores.data.as_floats[i] = compare_indexed_hashes(
+                    candidate_ptrs[i], candidate_sizes[i], tables + 2 * table_size, candidate_uniq,
+                    query_hashes.data.as_uints, query_size, tables, query_uniq,
+                    max_offset, counts,
+                )
+    finally:
+        free(candidate_ptrs)
+        free(candidate_sizes)
+        free(tables)
+        free(counts)
+
+    return scores
+
+
+def compare_fingerprint(object a, object b, int max_offset=0, bint signed=False):
+    """Score two fingerprints, same as acoustid_compare2(a, b, max_offset)."""
+    return compare_fingerprints(b, [a], max_offset, signed)[0]
+
+
 cdef extern from *:
     """
     enum {
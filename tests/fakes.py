@@ -0,0 +1,204 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import redis
+import requests
+
+from acoustid.circuitbreaker import CircuitOpenError
+from acoustid.config import FpstoreConfig
+from acoustid.fpstore import FpstoreClient, FpstoreReplica, FpstoreSearchResult
+from acoustid.indexclient import IndexClientUnavailableError
+
+
+class FakeFpstore:
+    """Answers with the first hash as the fingerprint ID, once all searches are in flight."""
+
+    def __init__(self, num_searches: int, timeout_on: int | None = None) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=num_searches)
+        self.barrier = threading.Barrier(num_searches, timeout=5)
+        self.timeout_on = timeout_on
+
+    def search(self, query: List[int], **kwargs: Any) -> List[FpstoreSearchResult]:
+        self.barrier.wait()
+        if query[0] == self.timeout_on:
+            raise TimeoutError()
+        return [FpstoreSearchResult(fingerprint_id=query[0], score=0.9)]
+
+    def submit_search(
+        self, query: List[int], **kwargs: Any
+    ) -> "Future[List[FpstoreSearchResult]]":
+        return self.executor.submit(self.search, query, **kwargs)
+
+
+class FakeFingerprintDB:
+    """Returns the same rows for every statement and records the statements."""
+
+    def __init__(self, rows: List[Any]) -> None:
+        self.rows = rows
+        self.statements: List[Any] = []
+
+    def execute(self, statement: Any) -> List[Any]:
+        self.statements.append(statement)
+        return self.rows
+
+
+class FakeStatsClient(object):
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = {}
+        self.timings: List[Tuple[str, float]] = []
+
+    def incr(self, name: str, count: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def timing(self, name: str, value: float) -> None:
+        self.timings.append((name, value))
+
+    def gauge(self, name: str, value: float) -> None:
+        pass
+
+    def pipeline(self) -> "FakeStatsPipeline":
+        return FakeStatsPipeline(self)
+
+
+class FakeStatsPipeline(object):
+    """Passes the stats on to the client when they are sent."""
+
+    def __init__(self, client: FakeStatsClient) -> None:
+        self.client = client
+        self.commands: List[Callable[[], None]] = []
+
+    def incr(self, name: str, count: int = 1) -> None:
+        self.commands.append(lambda: self.client.incr(name, count))
+
+    def timing(self, name: str, value: float) -> None:
+        self.commands.append(lambda: self.client.timing(name, value))
+
+    def send(self) -> None:
+        for command in self.commands:
+            command()
+        self.commands = []
+
+
+class FakePipeline(object):
+    def __init__(self, redis: "FakeRedis") -> None:
+        self.redis = redis
+        self.commands: List[Callable[[], Any]] = []
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        self.commands.append(lambda: self.redis.data.__setitem__(key, value))
+
+    def getbit(self, key: str, offset: int) -> None:
+        self.commands.append(lambda: int(offset in self.redis.bits.get(key, set())))
+
+    def setbit(self, key: str, offset: int, value: int) -> None:
+        self.commands.append(lambda: self.redis.bits.setdefault(key, set()).add(offset))
+
+    def expire(self, key: str, time: int) -> None:
+        self.commands.append(lambda: self.redis.expires.__setitem__(key, time))
+
+    def execute(self) -> List[Any]:
+        return [command() for command in self.commands]
+
+
+class FakeRedis(object):
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = {}
+        self.bits: Dict[str, Set[int]] = {}
+        self.lists: Dict[bytes, List[bytes]] = {}
+        self.expires: Dict[str, int] = {}
+        self.broken = False
+
+    def set(
+        self, key: str, value: Any, nx: bool = False, ex: Optional[int] = None
+    ) -> Optional[bool]:
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        if ex is not None:
+            self.expires[key] = ex
+        return True
+
+    def rpush(self, key: bytes, value: bytes) -> None:
+        self.lists.setdefault(key, []).append(value)
+
+    def lpop(self, key: bytes) -> Optional[bytes]:
+        items = self.lists.get(key)
+        if not items:
+            return None
+        return items.pop(0)
+
+    def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        if self.broken:
+            raise redis.ConnectionError("down")
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        if self.broken:
+            raise redis.ConnectionError("down")
+        return FakePipeline(self)
+
+    def delete(self, *keys: str) -> int:
+        if self.broken:
+            raise redis.ConnectionError("down")
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+
+class FakeTaskContext(object):
+    """Enough of a ScriptContext for enqueue_task and dequeue_task."""
+
+    def __init__(self) -> None:
+        self.redis = FakeRedis()
+        self.statsd = FakeStatsClient()
+
+
+class UnavailableFpstore:
+    """A fingerprint store behind an open circuit breaker."""
+
+    def search(self, query: List[int], **kwargs: Any) -> List[FpstoreSearchResult]:
+        raise CircuitOpenError("fpstore")
+
+
+class UnavailableIndexPool:
+    """An index pool behind an open circuit breaker."""
+
+    def __init__(self) -> None:
+        self.connects = 0
+
+    def connect(self) -> Any:
+        self.connects += 1
+        raise IndexClientUnavailableError("index")
+
+
+class FakeReplicasClient(FpstoreClient):
+    """Answers searches with the replica's name after a per-replica delay."""
+
+    def __init__(self, cfg: FpstoreConfig) -> None:
+        super().__init__(cfg)
+        self.delays: Dict[str, float] = {}
+        self.failing: List[str] = []
+        self.timing_out: List[str] = []
+        self.calls: List[str] = []
+        self.timeouts: List[float] = []
+
+    def _send_search(
+        self,
+        replica: FpstoreReplica,
+        query: List[int],
+        limit: int,
+        fast_mode: bool,
+        min_score: float,
+        timeout: float,
+    ) -> List[FpstoreSearchResult]:
+        self.calls.append(replica.name)
+        self.timeouts.append(timeout)
+        time.sleep(self.delays.get(replica.name, 0.0))
+        if replica.name in self.failing:
+            raise requests.ConnectionError(replica.name)
+        if replica.name in self.timing_out:
+            raise TimeoutError()
+        return [FpstoreSearchResult(self.replicas.index(replica), 1.0)]
@@ -1,13 +1,125 @@
+import uuid
+
 from starlette.testclient import TestClient
 
+from acoustid.fingerprint import process_fingerprint
+from acoustid.future.api.handlers.search import (
+    SearchResult,
+    TrackMatch,
+    score_candidates,
+    select_candidates,
+)
+from acoustid.future.data.fingerprints import FingerprintCandidate
+from acoustid.future.fpindex.client import SearchResponse
+from acoustid.future.fpindex.client import SearchResult as IndexSearchResult
+from tests import TEST_1A_FP, TEST_1A_LENGTH, TEST_1B_FP_RAW, TEST_2_FP_RAW
+
+from .test_submit import TEST_FINGERPRINT
+
+
+class FakeFingerprintIndex:
+    def __init__(self, results: list[IndexSearchResult] | None = None) -> None:
+        self.results = results or []
+        self.queries: list[list[int]] = []
+
+    async def search(
+        self,
+        index_name: str,
+        query: list[int],
+        timeout: int | None = None,
+        limit: int | None = None,
+    ) -> SearchResponse:
+        self.queries.append(query)
+        return SearchResponse(results=self.results)
 
-def test_search(client: TestClient) -> None:
+    async def close(self) -> None:
+        pass
+
+
+def test_search_no_matches(client: TestClient) -> None:
+    fpindex = FakeFingerprintIndex()
+    client.app.state.app_ctx.fpindex = fpindex  # type: ignore[attr-defined]
     response = client.post(
         "/v3/search",
         headers={
             "X-App-Key": "test",
         },
-        json={},
+        json={"queries": [{"fingerprint": TEST_FINGERPRINT, "duration": 10}]},
     )
     assert response.status_code == 200, response.text
-    assert response.json() == {}
+    assert response.json() == {"results": [{"tracks": []}]}
+    assert len(fpindex.queries) == 1
+    assert all(0 <= h < 2**32 for h in fpindex.queries[0])
+
+
+def test_search_unknown_candidate(client: TestClient) -> None:
+    fpindex = FakeFingerprintIndex([IndexSearchResult(id=123456, score=100)])
+    client.app.state.app_ctx.fpindex = fpindex  # type: ignore[attr-defined]
+    response = client.post(
+        "/v3/search",
+        headers={
+            "X-App-Key": "test",
+        },
+        json={"queries": [{"fingerprint": TEST_FINGERPRINT, "duration": 10}]},
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {"results": [{"tracks": []}]}
+
+
+def test_search_get(client: TestClient) -> None:
+    client.app.state.app_ctx.fpindex = FakeFingerprintIndex()  # type: ignore[attr-defined]
+    response = client.get(
+        "/v3/search",
+        headers={
+            "X-App-Key": "test",
+        },
+        params={"fingerprint": TEST_FINGERPRINT, "duration": "10"},
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {"results": [{"tracks": []}]}
+
+
+def test_search_invalid_fingerprint(client: TestClient) -> None:
+    response = client.post(
+        "/v3/search",
+        headers={
+            "X-App-Key": "test",
+        },
+        json={"queries": [{"fingerprint": "xxx", "duration": 10}]},
+    )
+    assert response.status_code == 400, response.text
+
+
+def test_select_candidates() -> None:
+    results = [
+        IndexSearchResult(id=1, score=10),
+        IndexSearchResult(id=2, score=50),
+        IndexSearchResult(id=3, score=30),
+    ]
+    assert select_candidates(results) == [2, 3]
+    assert select_candidates([]) == []
+
+
+def test_score_candidates() -> None:
+    fp = process_fingerprint(TEST_1A_FP)
+    track_1 = uuid.UUID("3dbf7643-cba5-4e6c-a62b-2dc5b2300666")
+    track_2 = uuid.UUID("b2a4e9f6-2b27-4aef-9e2b-0d1e06d7a3a5")
+    candidates = [
+        FingerprintCandidate(
+            id=1, length=TEST_1A_LENGTH, hashes=TEST_1B_FP_RAW, track_gid=track_1
+        ),
+        FingerprintCandidate(
+            id=2, length=TEST_1A_LENGTH, hashes=TEST_2_FP_RAW, track_gid=track_2
+        ),
+        FingerprintCandidate(
+            id=3,
+            length=TEST_1A_LENGTH + 100,
+            hashes=fp.hashes.tolist(),
+            track_gid=track_2,
+        ),
+    ]
+    result = score_candidates(fp, TEST_1A_LENGTH, candidates)
+    assert result == SearchResult(
+        tracks=[TrackMatch(id=track_1, score=result.tracks[0].score)]
+    )
+    assert result.tracks[0].score > 0.9
@@ -1,7 +1,15 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
-from acoustid.api import serialize_response
+import json
+import os
+from typing import Any, Dict
+
+import pytest
+
+from acoustid.api import JSON_ENCODERS, serialize_response
+from acoustid.config import WebSiteConfig
+from acoustid.const import JSON_ENCODER_NAMES
 
 
 def test_serialize_json():
@@ -46,9 +54,76 @@ def test_serialize_xml():
     assert expected == resp.data
 
 
+XML_GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "data", "serialize_xml")
+
+
+@pytest.mark.parametrize(
+    "name", ["v1_lookup", "v1_error", "v2_lookup_meta", "escaping"]
+)
+def test_serialize_xml_golden(name):
+    with open(os.path.join(XML_GOLDEN_DIR, name + ".json"), encoding="utf-8") as f:
+        data = json.load(f)
+    with open(os.path.join(XML_GOLDEN_DIR, name + ".xml"), "rb") as f:
+        expected = f.read()
+    resp = serialize_response(data, "xml")
+    assert "text/xml; charset=UTF-8" == resp.content_type
+    assert expected == resp.data
+
+
+def test_serialize_xml_chunks():
+    data = {"results": [{"id": str(i)} for i in range(10000)]}
+    chunks = list(serialize_response(data, "xml").iter_encoded())
+    assert len(chunks) > 1
+    assert b"".join(chunks) == serialize_response(data, "xml").data
+    assert chunks[-1].endswith(b"<id>9999</id></result></results></response>")
+
+
 def test_serialize_xml_attribute():
     data = {"@status": "ok"}
     resp = serialize_response(data, "xml")
     assert "text/xml; charset=UTF-8" == resp.content_type
     expected = b"""<?xml version='1.0' encoding='UTF-8'?>\n<response status="ok" />"""
     assert expected == resp.data
+
+
+@pytest.mark.parametrize("json_encoder", ["json", "msgspec"])
+def test_serialize_json_encoders_same_bytes(json_encoder):
+    data: Dict[str, Any] = {
+        "status": "ok",
+        "b": [1, 2.5, 0.1, -3, None, True, False, {}],
+        "a": {"title": 'Sigur Rós "\\x" \x7f\x01\t\n 日本 \U0001f600', "@id": "x"},
+    }
+    resp = serialize_response(data, "jsonp:getData", json_encoder=json_encoder)
+    assert "application/javascript; charset=UTF-8" == resp.content_type
+    expected = b"getData(%s)" % json.dumps(data, sort_keys=True).encode("ascii")
+    assert expected == resp.data
+
+
+@pytest.mark.parametrize("json_encoder", ["json", "msgspec"])
+def test_serialize_json_escapes_del(json_encoder):
+    resp = serialize_response({"title": "\x7f"}, "json", json_encoder=json_encoder)
+    assert b'{"title": "\\u007f"}' == resp.data
+
+
+def test_serialize_json_msgspec_compact():
+    data = {"status": "ok", "artists": [{"name": "Björk", "year": 1965}]}
+    resp = serialize_response(data, "json", json_encoder="msgspec_compact")
+    assert "application/json; charset=UTF-8" == resp.content_type
+    expected = '{"artists":[{"name":"Björk","year":1965}],"status":"ok"}'
+    assert expected.encode("utf-8") == resp.data
+
+
+def test_json_encoder_config(monkeypatch):
+    assert sorted(JSON_ENCODERS) == sorted(JSON_ENCODER_NAMES)
+    config = WebSiteConfig()
+    monkeypatch.setenv("TEST_JSON_ENCODER", "msgspec")
+    config.read_env("TEST_")
+    assert config.json_encoder == "msgspec"
+    monkeypatch.setenv("TEST_JSON_ENCODER", "unknown")
+    with pytest.raises(ValueError):
+        config.read_env("TEST_")
+
+
+def test_serialize_json_unknown_encoder():
+    with pytest.raises(ValueError):
+        serialize_response({"status": "ok"}, "json", json_encoder="unknown")
@@ -3,10 +3,11 @@
 
 import json
 import unittest
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, cast
 from unittest import mock
 from uuid import UUID
 
+from sqlalchemy.exc import OperationalError
 from werkzeug.datastructures import MultiDict
 from werkzeug.test import EnvironBuilder
 from werkzeug.wrappers import Request
@@ -23,7 +24,9 @@ from acoustid.api.v2 import (
     SubmitHandlerParams,
 )
 from acoustid.api.v2.misc import UserCreateAnonymousHandler, UserLookupHandler
+from acoustid.data.fingerprint import FingerprintSearcher
 from acoustid.script import ScriptContext
+from acoustid.tasks import dequeue_task, enqueue_task
 from tests import (
     TEST_1_FP,
     TEST_1_FP_RAW,
@@ -36,6 +39,7 @@ from tests import (
     prepare_database,
     with_script_context,
 )
+from tests.fakes import FakeStatsClient, FakeTaskContext
 
 
 @with_script_context
@@ -359,6 +363,165 @@ INSERT INTO fingerprint (length, fingerprint, track_id, submission_count)
     assert "200 OK" == resp.status
 
 
+@with_script_context
+def test_lookup_handler_metadata_past_deadline(ctx: ScriptContext) -> None:
+    prepare_database(
+        ctx.db.get_fingerprint_db(),
+        """
+INSERT INTO fingerprint (length, fingerprint, track_id, submission_count)
+    VALUES (:length, :fp, 1, 1);
+""",
+        {"length": TEST_1_LENGTH, "fp": TEST_1_FP_RAW},
+    )
+    ctx.db.session.commit()
+
+    values = {
+        "format": "json",
+        "client": "app1key",
+        "duration": str(TEST_1_LENGTH),
+        "fingerprint": TEST_1_FP,
+        "meta": "recordings",
+    }
+    builder = EnvironBuilder(method="POST", data=values)
+    timeout = OperationalError(
+        "SELECT", {}, Exception("canceling statement due to statement timeout")
+    )
+    with mock.patch("acoustid.api.v2.lookup_metadata", side_effect=timeout):
+        handler = LookupHandler(ctx)
+        resp = handler.handle(Request(builder.get_environ()))
+    expected = {
+        "status": "ok",
+        "results": [
+            {
+                "id": "eb31d1c3-950e-468b-9e36-e46fa75b1291",
+                "score": 1.0,
+            }
+        ],
+    }
+    assert_json_equals(expected, resp.data)
+    assert "200 OK" == resp.status
+
+
+@with_script_context
+def test_lookup_handler_batch_duplicates(ctx: ScriptContext) -> None:
+    prepare_database(
+        ctx.db.get_fingerprint_db(),
+        """
+INSERT INTO fingerprint (length, fingerprint, track_id, submission_count)
+    VALUES (:length, :fp, 1, 1);
+""",
+        {"length": TEST_1_LENGTH, "fp": TEST_1_FP_RAW},
+    )
+    ctx.db.session.commit()
+
+    values = {
+        "format": "json",
+        "client": "app1key",
+        "batch": "1",
+        "duration.0": str(TEST_1_LENGTH),
+        "fingerprint.0": TEST_1_FP,
+        "duration.1": str(TEST_2_LENGTH),
+        "fingerprint.1": TEST_2_FP,
+        "duration.2": str(TEST_1_LENGTH),
+        "fingerprint.2": TEST_1_FP,
+    }
+    builder = EnvironBuilder(method="POST", data=values)
+    search_many = FingerprintSearcher.search_many
+    with mock.patch.object(
+        FingerprintSearcher, "search_many", autospec=True, side_effect=search_many
+    ) as mock_search_many:
+        handler = LookupHandler(ctx)
+        resp = handler.handle(Request(builder.get_environ()))
+    assert len(mock_search_many.call_args[0][1]) == 2
+    result = {"id": "eb31d1c3-950e-468b-9e36-e46fa75b1291", "score": 1.0}
+    expected = {
+        "status": "ok",
+        "fingerprints": [
+            {"index": 0, "results": [result]},
+            {"index": 1, "results": []},
+            {"index": 2, "results": [result]},
+        ],
+    }
+    assert_json_equals(expected, resp.data)
+    assert "200 OK" == resp.status
+
+
+@with_script_context
+def test_lookup_handler_reports_stage_durations(ctx: ScriptContext) -> None:
+    prepare_database(
+        ctx.db.get_fingerprint_db(),
+        """
+INSERT INTO fingerprint (length, fingerprint, track_id, submission_count)
+    VALUES (:length, :fp, 1, 1);
+""",
+        {"length": TEST_1_LENGTH, "fp": TEST_1_FP_RAW},
+    )
+    ctx.db.session.commit()
+
+    values = {
+        "format": "json",
+        "client": "app1key",
+        "duration": str(TEST_1_LENGTH),
+        "fingerprint": TEST_1_FP,
+        "meta": "recordingids",
+    }
+    builder = EnvironBuilder(method="POST", data=values)
+    statsd = FakeStatsClient()
+    with mock.patch.object(ctx, "statsd", statsd):
+        handler = LookupHandler(ctx)
+        resp = handler.handle(Request(builder.get_environ()))
+    assert "200 OK" == resp.status
+
+    prefix = "api.stage_duration_seconds,request=LookupHandler,meta=recordingids,stage="
+    stages = {
+        name.removeprefix(prefix)
+        for name, value in statsd.timings
+        if name.startswith(prefix)
+    }
+    assert {"parse", "search", "db_search", "resolve_tracks", "serialize"} <= stages
+    assert statsd.counters["api.lookup.searches.total"] == 1
+
+
+@with_script_context
+def test_lookup_handler_enqueues_missing_mbid_once(ctx: ScriptContext) -> None:
+    prepare_database(
+        ctx.db.get_fingerprint_db(),
+        """
+INSERT INTO fingerprint (length, fingerprint, track_id, submission_count)
+    VALUES (:length, :fp, 1, 1);
+""",
+        {"length": TEST_1_LENGTH, "fp": TEST_1_FP_RAW},
+    )
+    ctx.db.session.commit()
+
+    values = {
+        "format": "json",
+        "client": "app1key",
+        "duration": str(TEST_1_LENGTH),
+        "fingerprint": TEST_1_FP,
+        "meta": "recordings",
+    }
+    builder = EnvironBuilder(method="POST", data=values)
+    task_ctx = FakeTaskContext()
+
+    def enqueue_fake_task(ctx: Any, *args: Any, **kwargs: Any) -> bool:
+        return enqueue_task(cast(Any, task_ctx), *args, **kwargs)
+
+    # the MBID of track 1 is not in MusicBrainz
+    with mock.patch("acoustid.api.v2.enqueue_task", side_effect=enqueue_fake_task):
+        for _ in range(2):
+            handler = LookupHandler(ctx)
+            resp = handler.handle(Request(builder.get_environ()))
+            assert "200 OK" == resp.status
+
+    name, kwargs = dequeue_task(cast(Any, task_ctx), timeout=1)
+    assert (name, kwargs) == (
+        "merge_missing_mbid",
+        {"mbid": "b81f83ee-4da4-11e0-9ed8-0025225356f3"},
+    )
+    assert not any(task_ctx.redis.lists.values())
+
+
 @with_script_context
 def test_submit_handler_params(ctx):
     # type: (ScriptContext) -> None
@@ -870,3 +1033,15 @@ def test_cluster_requests_touch_no_bucket_at_all(ctx):
         assert "200 OK" == handler.handle(_cluster_secret_request("wrong")).status
         assert "global" in buckets
         assert "ip" in buckets
+
+
+def test_lookup_handler_group_metadata() -> None:
+    handler = LookupHandler(cast(Any, None))
+    metadata = [
+        {"recording_id": "a", "release_id": "1"},
+        {"recording_id": "b", "release_id": "2"},
+        {"recording_id": "a", "release_id": "3"},
+        {"recording_id": "c", "release_id": "4"},
+    ]
+    groups = dict(handler._group_metadata(metadata, {1: ["a", "b"], 2: ["c", "d"]}))
+    assert groups == {1: metadata[:3], 2: [metadata[3]]}
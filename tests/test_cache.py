@@ -0,0 +1,176 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import threading
+from typing import Any, Dict, List, Optional, Set, cast
+from unittest import mock
+
+from acoustid.cache import DimensionCache, TimeSlicedBloomFilter, TwoTierCache
+from acoustid.data.fingerprint import (
+    FingerprintMatch,
+    LookupMissCache,
+    decode_lookup_cache_entry,
+    encode_lookup_cache_entry,
+    simhash_neighbors,
+)
+from tests.fakes import FakeRedis, FakeStatsClient
+
+
+def create_cache(
+    redis: Optional[FakeRedis], statsd: FakeStatsClient, local_size: int = 10
+) -> TwoTierCache[str]:
+    return TwoTierCache(
+        "test",
+        encode=lambda v: v.encode("utf8"),
+        decode=lambda v: v.decode("utf8"),
+        ttl=60,
+        local_size=local_size,
+        redis=cast(Any, redis),
+        statsd=cast(Any, statsd),
+    )
+
+
+def test_two_tier_cache() -> None:
+    redis = FakeRedis()
+    statsd = FakeStatsClient()
+    cache = create_cache(redis, statsd)
+
+    assert cache.get_many(["a", "b"]) == {}
+    cache.set_many({"a": "1"})
+    assert redis.data == {"cache:test:a": b"1"}
+
+    assert cache.get_many(["a", "b"]) == {"a": "1"}
+    assert statsd.counters["cache.requests_total,cache=test,tier=local,result=hit"] == 1
+
+    # another process, only the shared tier is warm
+    cache.clear_local()
+    assert cache.get("a") == "1"
+    assert statsd.counters["cache.requests_total,cache=test,tier=redis,result=hit"] == 1
+    assert cache.local is not None and "a" in cache.local
+
+
+def test_two_tier_cache_evictions() -> None:
+    statsd = FakeStatsClient()
+    cache = create_cache(None, statsd, local_size=2)
+    cache.set_many({"a": "1", "b": "2", "c": "3"})
+    assert statsd.counters["cache.evictions_total,cache=test"] == 1
+
+
+def test_two_tier_cache_threads() -> None:
+    cache = create_cache(None, FakeStatsClient(), local_size=8)
+    errors: List[BaseException] = []
+
+    def run(n: int) -> None:
+        try:
+            for i in range(2000):
+                key = str((n + i) % 32)
+                cache.set_many({key: key})
+                cache.get_many([key, str(i % 32)])
+                if i % 10 == 0:
+                    cache.delete_many([key])
+        except BaseException as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert cache.local is not None and len(cache.local) <= 8
+
+
+def test_two_tier_cache_redis_errors_are_misses() -> None:
+    redis = FakeRedis()
+    redis.broken = True
+    cache = create_cache(redis, FakeStatsClient())
+    cache.set("a", "1")
+    assert cache.get("a") == "1"
+    cache.clear_local()
+    assert cache.get("a") is None
+
+
+def test_lookup_cache_entry_roundtrip() -> None:
+    matches = [FingerprintMatch(1, 2, "6e9f3b53-6ebd-4ec1-a0b0-a2b3f1a1d5a8", 0.75)]
+    assert decode_lookup_cache_entry(encode_lookup_cache_entry(matches)) == matches
+
+
+def create_bloom_filter(redis: Optional[FakeRedis]) -> TimeSlicedBloomFilter:
+    return TimeSlicedBloomFilter(
+        "test", ttl=400, size=1024, redis=cast(Any, redis), statsd=None
+    )
+
+
+def test_bloom_filter() -> None:
+    redis = FakeRedis()
+    bloom_filter = create_bloom_filter(redis)
+    with mock.patch("time.time", return_value=1000.0):
+        assert bloom_filter.contains_many(["a", "b"]) == [False, False]
+        bloom_filter.add_many(["a"])
+        assert bloom_filter.contains_many(["a", "b"]) == [True, False]
+    assert redis.expires == {"bloom:test:10": 500}
+    with mock.patch("time.time", return_value=1399.0):
+        assert bloom_filter.contains_many(["a"]) == [True]
+    with mock.patch("time.time", return_value=1400.0):
+        assert bloom_filter.contains_many(["a"]) == [False]
+
+
+def test_bloom_filter_redis_errors() -> None:
+    redis = FakeRedis()
+    redis.broken = True
+    bloom_filter = create_bloom_filter(redis)
+    bloom_filter.add_many(["a"])
+    assert bloom_filter.contains_many(["a"]) == [False]
+
+
+def test_lookup_miss_cache() -> None:
+    miss_cache = LookupMissCache(create_bloom_filter(FakeRedis()))
+    miss_cache.add_many(["fp1", "fp2"])
+    assert miss_cache.contains_many([("fp1", 5), ("fp2", -7), ("fp3", 5)]) == [
+        True,
+        True,
+        False,
+    ]
+    # a new fingerprint one bit away from the first one
+    miss_cache.invalidate(5 ^ 0x100)
+    assert miss_cache.contains_many([("fp1", 5), ("fp2", -7)]) == [False, True]
+
+
+def test_simhash_neighbors() -> None:
+    assert simhash_neighbors(-1, 0) == {-1}
+    neighbors = simhash_neighbors(0, 1)
+    assert len(neighbors) == 33
+    assert -0x80000000 in neighbors and 1 in neighbors and 0 in neighbors
+
+
+def test_dimension_cache() -> None:
+    statsd = FakeStatsClient()
+    cache: DimensionCache[int, List[str]] = DimensionCache(
+        "test", 4, statsd=cast(Any, statsd)
+    )
+    loaded: List[Set[int]] = []
+
+    def load(ids: Set[int]) -> Dict[int, List[str]]:
+        loaded.append(ids)
+        return {id: ["x"] * id for id in ids if id != 0}
+
+    assert cache.get_many([0, 1, 2], load) == {1: ["x"], 2: ["x", "x"]}
+    assert cache.get_many([1, 2, 3], load, default=[]) == {
+        1: ["x"],
+        2: ["x", "x"],
+        3: ["x", "x", "x"],
+    }
+    # only the missing ids are loaded, ids without a default are not cached
+    assert loaded == [{0, 1, 2}, {3}]
+    assert statsd.counters == {
+        "cache.requests_total,cache=test,tier=local,result=hit": 2,
+        "cache.requests_total,cache=test,tier=local,result=miss": 4,
+    }
+
+    # the size counts list items, 3 + 2 does not fit
+    assert 1 not in cache.entries or 2 not in cache.entries
+    assert cache.get_many([0], load, default=[]) == {0: []}
+    assert cache.get_many([0], load) == {0: []}
+
+    cache.clear()
+    assert not cache.entries
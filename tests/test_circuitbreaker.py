@@ -0,0 +1,69 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+from unittest import mock
+
+import pytest
+
+from acoustid.circuitbreaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+)
+
+
+def test_opens_after_consecutive_failures() -> None:
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10.0)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_half_open_probe() -> None:
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10.0)
+    with mock.patch("time.monotonic", return_value=100.0):
+        breaker.record_failure()
+        assert not breaker.allow()
+    with mock.patch("time.monotonic", return_value=110.0):
+        # only one probe at a time
+        assert breaker.allow()
+        assert breaker.state == HALF_OPEN
+        assert not breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == OPEN
+        assert not breaker.allow()
+    with mock.patch("time.monotonic", return_value=120.0):
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CLOSED
+        assert breaker.allow()
+        assert breaker.allow()
+
+
+def test_ignored_probe() -> None:
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10.0)
+    with mock.patch("time.monotonic", return_value=100.0):
+        breaker.record_failure()
+    with mock.patch("time.monotonic", return_value=110.0):
+        assert breaker.allow()
+        breaker.record_ignored()
+        # the next call probes again
+        assert breaker.state == HALF_OPEN
+        assert breaker.allow()
+
+
+def test_disabled() -> None:
+    breaker = CircuitBreaker("test", failure_threshold=0)
+    for i in range(10):
+        breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.state == CLOSED
@@ -1,11 +1,40 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import collections
+from typing import Any, List, Optional, Sequence, Tuple, cast
+from unittest import mock
+
+import pytest
 from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql
 
-from acoustid.data.fingerprint import insert_fingerprint
+from acoustid.cache import TimeSlicedBloomFilter
+from acoustid.config import CacheConfig, WebSiteConfig
+from acoustid.data.fingerprint import (
+    FingerprintMatch,
+    FingerprintSearcher,
+    LookupMissCache,
+    compute_query_simhash,
+    create_lookup_cache,
+    insert_fingerprint,
+)
+from acoustid.indexclient import IndexClientUnavailableError
 from acoustid.script import ScriptContext
-from tests import with_script_context
+from tests import (
+    TEST_1A_FP_RAW,
+    TEST_1B_FP_RAW,
+    TEST_2_FP_RAW,
+    prepare_database,
+    with_script_context,
+)
+from tests.fakes import (
+    FakeFingerprintDB,
+    FakeFpstore,
+    FakeRedis,
+    UnavailableFpstore,
+    UnavailableIndexPool,
+)
 
 
 @with_script_context
@@ -40,3 +69,306 @@ def test_insert_fingerprint(ctx):
         ([1, 2, 3, 4, 5, 6], 123, 192, 1, 2),
     ]
     assert expected_rows == rows
+
+
+def test_search_fpstore_candidates_runs_concurrently() -> None:
+    # The barrier only opens once every search is waiting on it, so this
+    # would time out if the searches ran one after another.
+    fpstore = FakeFpstore(3)
+    searcher = FingerprintSearcher(cast(Any, None), cast(Any, None), cast(Any, fpstore))
+    candidates = searcher._search_fpstore_candidates([[1], [2], [3]], 10)
+    assert candidates == [{1: 0.9}, {2: 0.9}, {3: 0.9}]
+
+
+@with_script_context
+def test_search_many_via_fpstore(ctx: ScriptContext) -> None:
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    prepare_database(
+        fingerprint_db,
+        """
+INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+    VALUES (:fp1, 100, 1, 1), (:fp2, 100, 2, 1), (:fp3, 300, 3, 1);
+""",
+        dict(fp1=TEST_1A_FP_RAW, fp2=TEST_1B_FP_RAW, fp3=TEST_2_FP_RAW),
+    )
+    searcher = FingerprintSearcher(
+        fingerprint_db, cast(Any, None), cast(Any, FakeFpstore(3))
+    )
+    with mock.patch("acoustid.data.fingerprint.SEARCH_ONLY_IN_DATABASE", False):
+        results = searcher.search_many([([1], 100), ([2], 104), ([3], 100)])
+    # the candidates of all searches are resolved to their tracks, the
+    # third one is too far off in length
+    assert [[(m.fingerprint_id, m.track_id) for m in r or []] for r in results] == [
+        [(1, 1)],
+        [(2, 2)],
+        [],
+    ]
+    assert results[0] is not None
+    assert str(results[0][0].track_gid) == "eb31d1c3-950e-468b-9e36-e46fa75b1291"
+
+
+def test_search_fpstore_candidates_timeout_in_fast_mode() -> None:
+    fpstore = FakeFpstore(2, timeout_on=2)
+    searcher = FingerprintSearcher(cast(Any, None), cast(Any, None), cast(Any, fpstore))
+    candidates = searcher._search_fpstore_candidates([[1], [2]], 10)
+    assert candidates == [{1: 0.9}, None]
+
+
+def test_resolve_fpstore_candidates_in_one_statement() -> None:
+    Row = collections.namedtuple("Row", ["id", "track_id", "length", "track_gid"])
+    db = FakeFingerprintDB(
+        [
+            Row(1, 10, 100, "gid-10"),
+            Row(2, 20, 100, "gid-20"),
+            Row(3, 30, 200, "gid-30"),
+        ]
+    )
+    searcher = FingerprintSearcher(cast(Any, db), cast(Any, None))
+    searcher.max_length_diff = 7
+    matches = searcher._resolve_fpstore_candidates(
+        [100, 200, 300], [{1: 0.5, 2: 0.8, 3: 0.9}, {3: 0.7}, {}], 10
+    )
+    assert len(db.statements) == 1
+    assert matches == [
+        [
+            FingerprintMatch(2, 20, "gid-20", 0.8),
+            FingerprintMatch(1, 10, "gid-10", 0.5),
+        ],
+        [FingerprintMatch(3, 30, "gid-30", 0.7)],
+        [],
+    ]
+
+
+@with_script_context
+def test_resolve_fpstore_candidates_from_database(ctx: ScriptContext) -> None:
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    prepare_database(
+        fingerprint_db,
+        """
+INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+    VALUES (:fp1, 100, 1, 1), (:fp2, 100, 2, 1), (:fp3, 200, 3, 1);
+""",
+        dict(fp1=TEST_1A_FP_RAW, fp2=TEST_1B_FP_RAW, fp3=TEST_2_FP_RAW),
+    )
+    searcher = FingerprintSearcher(fingerprint_db, cast(Any, None))
+    matches = searcher._resolve_fpstore_candidates(
+        [100, 200, 300], [{1: 0.5, 2: 0.8, 3: 0.9, 4: 1.0}, {3: 0.7}, {}], 10
+    )
+    # each query keeps only the candidates within its own length window,
+    # unknown fingerprints are dropped
+    assert [
+        [(m.fingerprint_id, m.track_id, m.score) for m in r or []] for r in matches
+    ] == [
+        [(2, 2, 0.8), (1, 1, 0.5)],
+        [(3, 3, 0.7)],
+        [],
+    ]
+
+
+def test_compare_candidates_in_app() -> None:
+    Row = collections.namedtuple("Row", ["id", "track_id", "track_gid", "fingerprint"])
+    searcher = FingerprintSearcher(cast(Any, None), cast(Any, None))
+    matches = searcher._compare_candidates(
+        TEST_1A_FP_RAW,
+        [
+            Row(1, 10, "gid-10", TEST_2_FP_RAW),
+            Row(2, 20, "gid-20", TEST_1B_FP_RAW),
+            Row(3, 30, "gid-30", TEST_1A_FP_RAW),
+        ],
+        max_results=10,
+    )
+    assert [(m.fingerprint_id, m.track_gid) for m in matches] == [
+        (3, "gid-30"),
+        (2, "gid-20"),
+    ]
+    assert matches[0].score == 1.0
+
+
+@with_script_context
+def test_search_with_lookup_cache(ctx: ScriptContext) -> None:
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    prepare_database(
+        fingerprint_db,
+        """
+INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+    VALUES (:fp1, 100, 1, 1);
+""",
+        dict(fp1=TEST_1A_FP_RAW),
+    )
+    config = CacheConfig()
+    config.lookup_ttl = 60
+    config.lookup_local_size = 0
+    cache = create_lookup_cache(config, cast(Any, FakeRedis()), None)
+    searcher = FingerprintSearcher(fingerprint_db, cast(Any, None), cache=cache)
+
+    def search(fp: List[int]) -> List[Tuple[int, int, str]]:
+        matches = searcher.search(fp, 100)
+        assert matches is not None
+        return [(m.fingerprint_id, m.track_id, str(m.track_gid)) for m in matches]
+
+    expected = [(1, 1, "eb31d1c3-950e-468b-9e36-e46fa75b1291")]
+    assert search(TEST_1A_FP_RAW) == expected
+    # the same fingerprint is answered from the cache, others are not
+    fingerprint_db.execute(sql.text("DELETE FROM fingerprint"))
+    assert search(TEST_1A_FP_RAW) == expected
+    assert search(TEST_1B_FP_RAW) == []
+
+
+class CountingSearcher(FingerprintSearcher):
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(cast(Any, None), cast(Any, None), **kwargs)
+        self.searched: List[List[int]] = []
+
+    def _search_many(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        self.searched.extend(fp for fp, length in queries)
+        return [[] if fp == TEST_2_FP_RAW else None for fp, length in queries]
+
+
+def test_search_many_with_miss_cache() -> None:
+    miss_cache = LookupMissCache(
+        TimeSlicedBloomFilter("test", ttl=3600, size=1024, redis=cast(Any, FakeRedis()))
+    )
+    searcher = CountingSearcher(miss_cache=miss_cache)
+    queries = [(TEST_1A_FP_RAW, 100), (TEST_2_FP_RAW, 100)]
+    assert searcher.search_many(queries) == [None, []]
+    assert searcher.search_many(queries) == [None, []]
+    # the timed out search is repeated, the miss is not
+    assert searcher.searched == [TEST_1A_FP_RAW, TEST_2_FP_RAW, TEST_1A_FP_RAW]
+
+    miss_cache.invalidate(compute_query_simhash(TEST_2_FP_RAW))
+    searcher.search_many(queries[1:])
+    assert searcher.searched[-1] == TEST_2_FP_RAW
+
+
+def test_search_fallback_when_fpstore_is_unavailable() -> None:
+    searcher = FingerprintSearcher(
+        cast(Any, None), cast(Any, None), cast(Any, UnavailableFpstore())
+    )
+    with mock.patch("acoustid.data.fingerprint.SEARCH_ONLY_IN_DATABASE", False):
+        assert searcher._search_many([(TEST_1A_FP_RAW, 100)]) == [None]
+        # no results, but not because there are no matches
+        assert searcher.search_many([(TEST_1A_FP_RAW, 100)]) == [None]
+
+
+@with_script_context
+def test_search_fallback_to_database(ctx: ScriptContext) -> None:
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    prepare_database(
+        fingerprint_db,
+        """
+INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+    VALUES (:fp1, 100, 1, 1);
+""",
+        dict(fp1=TEST_1A_FP_RAW),
+    )
+    fpstore = cast(Any, UnavailableFpstore())
+    with mock.patch("acoustid.data.fingerprint.SEARCH_ONLY_IN_DATABASE", False):
+        searcher = FingerprintSearcher(fingerprint_db, cast(Any, None), fpstore)
+        assert searcher.search(TEST_1A_FP_RAW, 100) is None
+
+        searcher = FingerprintSearcher(
+            fingerprint_db, cast(Any, None), fpstore, fallback="database"
+        )
+        matches = searcher.search(TEST_1A_FP_RAW, 100)
+    assert matches is not None
+    assert [(m.fingerprint_id, m.track_id) for m in matches] == [(1, 1)]
+
+
+def test_search_fallback_config(monkeypatch: pytest.MonkeyPatch) -> None:
+    config = WebSiteConfig()
+    monkeypatch.setenv("TEST_SEARCH_FALLBACK", "database")
+    config.read_env("TEST_")
+    assert config.search_fallback == "database"
+    # rejected when the config is loaded, not on every search
+    monkeypatch.setenv("TEST_SEARCH_FALLBACK", "databse")
+    with pytest.raises(ValueError):
+        config.read_env("TEST_")
+
+
+def test_search_fallback_when_index_is_unavailable() -> None:
+    index_pool = UnavailableIndexPool()
+    db = FakeFingerprintDB([FingerprintMatch(1, 10, "gid-10", 0.9)])
+    with mock.patch("acoustid.data.fingerprint.SEARCH_ONLY_IN_DATABASE", False):
+        # fast searches do not use the index
+        searcher = FingerprintSearcher(cast(Any, db), cast(Any, index_pool))
+        assert searcher._search_directly(TEST_1A_FP_RAW, 100) == []
+        assert index_pool.connects == 0
+
+        searcher = FingerprintSearcher(cast(Any, db), cast(Any, index_pool), fast=False)
+        with pytest.raises(IndexClientUnavailableError):
+            searcher._search_directly(TEST_1A_FP_RAW, 100)
+        assert index_pool.connects == 1
+        assert db.statements == []
+
+        searcher = FingerprintSearcher(
+            cast(Any, db), cast(Any, index_pool), fast=False, fallback="database"
+        )
+        matches = searcher._search_directly(TEST_1A_FP_RAW, 100)
+        assert matches == [FingerprintMatch(1, 10, "gid-10", 0.9)]
+        assert index_pool.connects == 2
+
+
+class PrefilterSearcher(FingerprintSearcher):
+    def __init__(self, db: Any, **kwargs: Any) -> None:
+        super().__init__(db, cast(Any, None), **kwargs)
+        self.searched: List[List[int]] = []
+
+    def _search_backends(
+        self,
+        queries: Sequence[Tuple[List[int], int]],
+        max_results: Optional[int] = None,
+    ) -> List[Optional[List[FingerprintMatch]]]:
+        self.searched.extend(fp for fp, length in queries)
+        return [[] for fp, length in queries]
+
+
+def test_search_many_with_simhash_prefilter() -> None:
+    Row = collections.namedtuple("Row", ["id", "track_id", "track_gid", "fingerprint"])
+    db = FakeFingerprintDB([Row(1, 10, "gid-10", TEST_1A_FP_RAW)])
+    searcher = PrefilterSearcher(db, simhash_radius=1)
+    results = searcher.search_many([(TEST_1A_FP_RAW, 100), (TEST_2_FP_RAW, 100)])
+    assert results == [[FingerprintMatch(1, 10, "gid-10", 1.0)], []]
+    # only the query without a near-duplicate needs the full search
+    assert searcher.searched == [TEST_2_FP_RAW]
+    assert len(db.statements) == 2
+
+
+def test_simhash_prefilter_radius_is_limited() -> None:
+    with pytest.raises(ValueError):
+        FingerprintSearcher(cast(Any, None), cast(Any, None), simhash_radius=3)
+
+
+def test_simhash_prefilter_radius_config(monkeypatch: pytest.MonkeyPatch) -> None:
+    config = WebSiteConfig()
+    monkeypatch.setenv("TEST_SIMHASH_PREFILTER_RADIUS", "v2.lookup=1")
+    config.read_env("TEST_")
+    assert config.simhash_prefilter_radius == {"v2.lookup": 1}
+    for radius in ("-1", "3"):
+        monkeypatch.setenv("TEST_SIMHASH_PREFILTER_RADIUS", f"v2.lookup={radius}")
+        with pytest.raises(ValueError):
+            config.read_env("TEST_")
+
+
+def test_staged_search() -> None:
+    confident_db = FakeFingerprintDB([FingerprintMatch(1, 10, "gid-10", 0.9)])
+    searcher = FingerprintSearcher(
+        cast(Any, confident_db), cast(Any, None), staged=True
+    )
+    matches = searcher._search_directly(TEST_1A_FP_RAW, 100)
+    assert matches == [FingerprintMatch(1, 10, "gid-10", 0.9)]
+    assert len(confident_db.statements) == 1
+    statement = str(confident_db.statements[0].compile(dialect=postgresql.dialect()))
+    assert "subarray" in statement
+
+    # a weak match escalates to the full query
+    weak_db = FakeFingerprintDB([FingerprintMatch(1, 10, "gid-10", 0.8)])
+    searcher = FingerprintSearcher(cast(Any, weak_db), cast(Any, None), staged=True)
+    matches = searcher._search_directly(TEST_1A_FP_RAW, 100)
+    assert matches == [FingerprintMatch(1, 10, "gid-10", 0.8)]
+    assert len(weak_db.statements) == 2
+    statement = str(weak_db.statements[1].compile(dialect=postgresql.dialect()))
+    assert "subarray" not in statement
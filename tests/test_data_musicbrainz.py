@@ -1,16 +1,37 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import datetime
+import decimal
+import itertools
 import uuid
+from typing import Any, cast
+from unittest import mock
 
+import pytest
 from sqlalchemy import sql
 
 from acoustid import tables as schema
 from acoustid.api import serialize_response
 from acoustid.api.v2 import LookupHandler
-from acoustid.data.musicbrainz import _load_isrcs, lookup_metadata
+from acoustid.cache import TwoTierCache
+from acoustid.data.musicbrainz import (
+    MetadataCache,
+    _load_isrcs,
+    _lookup_metadata,
+    _lookup_metadata_json,
+    build_recording_documents,
+    decode_metadata_cache_entry,
+    decode_recording_document,
+    encode_metadata_cache_entry,
+    encode_recording_document,
+    lookup_metadata,
+    project_recording_document,
+)
+from acoustid.deadline import Deadline
 from acoustid.script import ScriptContext
 from tests import with_script_context
+from tests.fakes import FakeRedis
 
 RECORDING_1 = "77ef7468-e8f8-4b3e-93c5-a5a8b0a6ec4a"
 RECORDING_2 = "5b1e1b26-a3b8-4ba0-8d21-c1f0f9e8fdf6"
@@ -60,6 +81,38 @@ def insert_isrc(conn, recording_id, isrc):
     )
 
 
+def insert_release(conn, recording_id, artist_credit, name="Album"):
+    """A release group, release and medium with the recording as its only track."""
+    release_group_id = conn.execute(
+        schema.mb_release_group.insert().values(
+            gid=uuid.uuid4(), name=name, artist_credit=artist_credit
+        )
+    ).inserted_primary_key[0]
+    release_id = conn.execute(
+        schema.mb_release.insert().values(
+            gid=uuid.uuid4(),
+            name=name,
+            artist_credit=artist_credit,
+            release_group=release_group_id,
+        )
+    ).inserted_primary_key[0]
+    medium_id = conn.execute(
+        schema.mb_medium.insert().values(release=release_id, position=1, track_count=1)
+    ).inserted_primary_key[0]
+    conn.execute(
+        schema.mb_track.insert().values(
+            gid=uuid.uuid4(),
+            recording=recording_id,
+            medium=medium_id,
+            position=1,
+            number="1",
+            name="Track One",
+            artist_credit=artist_credit,
+            length=180000,
+        )
+    )
+
+
 @with_script_context
 def test_load_isrcs_groups_by_recording(ctx: ScriptContext) -> None:
     conn = ctx.db.get_musicbrainz_db()
@@ -226,3 +279,183 @@ def test_isrc_table_is_reachable(ctx: ScriptContext) -> None:
     server reads actually carries musicbrainz.isrc."""
     conn = ctx.db.get_musicbrainz_db()
     conn.execute(sql.select(sql.func.count()).select_from(schema.mb_isrc))
+
+
+def test_metadata_cache() -> None:
+    cache = MetadataCache(
+        TwoTierCache(
+            "metadata",
+            encode=encode_metadata_cache_entry,
+            decode=decode_metadata_cache_entry,
+            ttl=3600,
+            local_size=0,
+            redis=cast(Any, FakeRedis()),
+        )
+    )
+    conn = cast(Any, None)
+    rows = [
+        {"recording_id": RECORDING_1, "recording_title": "A"},
+        {"recording_id": RECORDING_1, "recording_title": "B"},
+    ]
+    replication_date = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    with (
+        mock.patch(
+            "acoustid.data.musicbrainz.get_last_replication_date",
+            return_value=replication_date,
+        ),
+        mock.patch(
+            "acoustid.data.musicbrainz._lookup_metadata", return_value=rows
+        ) as mock_lookup,
+    ):
+        recording_ids = [RECORDING_1, RECORDING_2]
+        assert lookup_metadata(conn, recording_ids, cache=cache) == rows
+        assert lookup_metadata(conn, recording_ids, cache=cache) == rows
+        assert mock_lookup.call_count == 1
+
+        # entries are kept separately for each set of loaded metadata
+        lookup_metadata(conn, recording_ids, load_releases=True, cache=cache)
+        assert mock_lookup.call_count == 2
+
+        # a new replication packet starts a new generation
+        cache.generation_checked = 0.0
+        replication_date += datetime.timedelta(hours=1)
+        with mock.patch(
+            "acoustid.data.musicbrainz.get_last_replication_date",
+            return_value=replication_date,
+        ):
+            assert lookup_metadata(conn, recording_ids, cache=cache) == rows
+        assert mock_lookup.call_count == 3
+
+
+def test_recording_documents() -> None:
+    recording = {
+        "recording_id": RECORDING_1,
+        "recording_title": "A",
+        "recording_duration": decimal.Decimal("180.5"),
+        "recording_artists": [{"id": "x", "name": "X"}],
+        "recording_isrcs": ["USABC0000001"],
+    }
+    release = {
+        "track_id": "t",
+        "release_id": "r",
+        "release_title": "R",
+        "release_events": [],
+        "release_group_id": "g",
+        "release_group_title": "G",
+    }
+
+    def fake_lookup_metadata(conn, recording_ids, load_releases=False, **kwargs):
+        if load_releases:
+            return [{**recording, **release}]
+        return [dict(recording)]
+
+    with mock.patch(
+        "acoustid.data.musicbrainz._lookup_metadata", side_effect=fake_lookup_metadata
+    ):
+        documents = build_recording_documents(
+            cast(Any, None), [RECORDING_1, RECORDING_2]
+        )
+    document = decode_recording_document(
+        encode_recording_document(documents[RECORDING_1])
+    )
+
+    expected = {**recording, "recording_duration": 180.5}
+    del expected["recording_isrcs"]
+    assert project_recording_document(document) == [expected]
+    assert project_recording_document(document, load_releases=True) == [
+        {
+            **expected,
+            "track_id": "t",
+            "release_id": "r",
+            "release_title": "R",
+            "release_events": [],
+        }
+    ]
+    assert project_recording_document(
+        document, load_releases=True, load_release_groups=True, load_isrcs=True
+    ) == [{**recording, **release, "recording_duration": 180.5}]
+
+    # recordings that are not in MusicBrainz have no rows
+    assert project_recording_document(documents[RECORDING_2]) == []
+
+    conn = cast(Any, None)
+    document_db = cast(Any, object())
+    replication_date = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    with (
+        mock.patch(
+            "acoustid.data.musicbrainz.get_last_replication_date",
+            return_value=replication_date,
+        ),
+        mock.patch(
+            "acoustid.data.musicbrainz.load_recording_documents",
+            return_value={RECORDING_1: document},
+        ) as mock_load_documents,
+        mock.patch(
+            "acoustid.data.musicbrainz._lookup_metadata", return_value=[]
+        ) as mock_lookup,
+    ):
+        recording_ids = [RECORDING_1, RECORDING_2]
+        assert lookup_metadata(conn, recording_ids, document_db=document_db) == [
+            expected
+        ]
+        assert mock_lookup.call_args.args[1] == [RECORDING_2]
+        # documents are checked against the last replication
+        assert mock_load_documents.call_args.args[2] == replication_date
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.statements: list[str] = []
+
+    def execute(self, query: Any, params: Any = None) -> list[Any]:
+        self.statements.append(str(query))
+        return []
+
+
+def test_lookup_metadata_deadline() -> None:
+    conn = FakeConnection()
+    assert lookup_metadata(cast(Any, conn), [RECORDING_1], deadline=Deadline(10)) == []
+    # the statement timeout is set again before every query
+    assert [s.split()[0] for s in conn.statements] == ["SET", "SELECT", "SET"]
+
+    conn = FakeConnection()
+    deadline = Deadline(10)
+    deadline.expires = deadline.started
+    with pytest.raises(TimeoutError):
+        lookup_metadata(cast(Any, conn), [RECORDING_1], deadline=deadline)
+    assert conn.statements == []
+
+
+@with_script_context
+def test_lookup_metadata_json_matches_rows(ctx: ScriptContext) -> None:
+    conn = ctx.db.get_musicbrainz_db()
+    ac = insert_artist_credit(conn)
+    id1 = insert_recording(conn, RECORDING_1, "Track One", ac)
+    insert_isrc(conn, id1, "USRC17607839")
+    insert_isrc(conn, id1, "GBAYE0601498")
+    insert_release(conn, id1, ac, "Album")
+    insert_release(conn, id1, insert_artist_credit(conn, "Someone"), "Single")
+    # no releases at all
+    insert_recording(conn, RECORDING_2, "Track Two", ac)
+
+    def sort_key(row: dict[str, Any]) -> tuple[str, str]:
+        return row["recording_id"], row.get("release_id", "")
+
+    recording_ids = [RECORDING_1, RECORDING_2]
+    flags = itertools.product([False, True], repeat=3)
+    for load_releases, load_release_groups, load_isrcs in flags:
+        expected = _lookup_metadata(
+            conn,
+            recording_ids,
+            load_releases=load_releases,
+            load_release_groups=load_release_groups,
+            load_isrcs=load_isrcs,
+        )
+        actual = _lookup_metadata_json(
+            conn,
+            recording_ids,
+            load_releases=load_releases,
+            load_release_groups=load_release_groups,
+            load_isrcs=load_isrcs,
+        )
+        assert sorted(actual, key=sort_key) == sorted(expected, key=sort_key)
@@ -2,16 +2,26 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import uuid
+from typing import Any, cast
+from unittest import mock
 
 import pytest
-from sqlalchemy import select, text
+from sqlalchemy import select, sql, text
 
 from acoustid import const, tables
+from acoustid.circuitbreaker import CircuitBreaker
+from acoustid.config import CacheConfig
+from acoustid.data.fingerprint import (
+    FingerprintSearcher,
+    compute_query_simhash,
+    create_lookup_miss_cache,
+)
 from acoustid.data.submission import (
     import_queued_submissions,
     import_submission,
     insert_submission,
 )
+from acoustid.indexclient import IndexClientPool, IndexClientUnavailableError
 from acoustid.script import ScriptContext
 from tests import (
     TEST_1_FP_RAW,
@@ -29,6 +39,7 @@ from tests import (
     prepare_database,
     with_script_context,
 )
+from tests.fakes import FakeRedis
 
 
 @with_script_context
@@ -469,6 +480,52 @@ def test_import_submission_new_track(ctx):
     assert 5 == fingerprint["track_id"]
 
 
+@with_script_context
+def test_import_submission_with_index_unavailable(ctx):
+    # type: (ScriptContext) -> None
+    ingest_db = ctx.db.get_ingest_db()
+    app_db = ctx.db.get_app_db()
+    fingerprint_db = ctx.db.get_fingerprint_db()
+
+    prepare_database(
+        fingerprint_db,
+        """
+    INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+        VALUES (:fp, :len, 1, 1);
+    """,
+        dict(fp=TEST_1A_FP_RAW, len=TEST_1A_LENGTH),
+    )
+    num_tracks = fingerprint_db.execute(
+        select(sql.func.count()).select_from(tables.track)
+    ).scalar()
+
+    submission_id = insert_submission(
+        ingest_db,
+        {
+            "fingerprint": TEST_1B_FP_RAW,
+            "length": TEST_1B_LENGTH,
+            "source_id": 1,
+        },
+    )
+    query = select(tables.submission).where(tables.submission.c.id == submission_id)
+    submission = ingest_db.execute(query).one()._mapping
+
+    breaker = CircuitBreaker("index", failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    index_pool = IndexClientPool(breaker=breaker)
+    with mock.patch("acoustid.data.fingerprint.SEARCH_ONLY_IN_DATABASE", False):
+        with pytest.raises(IndexClientUnavailableError):
+            import_submission(ingest_db, app_db, fingerprint_db, index_pool, submission)
+
+    # the submission was not imported as a new track
+    assert (
+        num_tracks
+        == fingerprint_db.execute(
+            select(sql.func.count()).select_from(tables.track)
+        ).scalar()
+    )
+
+
 @with_script_context
 def test_import_submission_new_track_different(ctx):
     # type: (ScriptContext) -> None
@@ -626,3 +683,52 @@ def test_import_queued_submissions(ctx):
         text("SELECT count(*) FROM track WHERE id IN (5,6,7)")
     ).scalar()
     assert 2 == count
+
+
+@with_script_context
+def test_import_submission_invalidates_lookup_misses(ctx):
+    # type: (ScriptContext) -> None
+    ingest_db = ctx.db.get_ingest_db()
+    app_db = ctx.db.get_app_db()
+    fingerprint_db = ctx.db.get_fingerprint_db()
+
+    config = CacheConfig()
+    config.lookup_miss_ttl = 3600
+    config.lookup_miss_filter_size = 1024
+    miss_cache = create_lookup_miss_cache(config, cast(Any, FakeRedis()), None)
+    searcher = FingerprintSearcher(
+        fingerprint_db, cast(Any, None), miss_cache=miss_cache
+    )
+    miss_key = (
+        searcher._cache_key(TEST_2_FP_RAW, TEST_2_LENGTH, None),
+        compute_query_simhash(TEST_2_FP_RAW),
+    )
+
+    assert searcher.search(TEST_2_FP_RAW, TEST_2_LENGTH) == []
+    assert miss_cache.contains_many([miss_key]) == [True]
+
+    submission_id = insert_submission(
+        ingest_db,
+        {
+            "fingerprint": TEST_2_FP_RAW,
+            "length": TEST_2_LENGTH,
+            "source_id": 1,
+        },
+    )
+    query = select(tables.submission).where(tables.submission.c.id == submission_id)
+    submission = ingest_db.execute(query).one()._mapping
+    handled, fingerprint = import_submission(
+        ingest_db,
+        app_db,
+        fingerprint_db,
+        ctx.index,
+        submission,
+        lookup_miss_cache=miss_cache,
+    )
+    assert handled and fingerprint is not None
+
+    # the imported fingerprint is found, not the recorded miss
+    assert miss_cache.contains_many([miss_key]) == [False]
+    matches = searcher.search(TEST_2_FP_RAW, TEST_2_LENGTH)
+    assert matches is not None
+    assert [m.fingerprint_id for m in matches] == [fingerprint["id"]]
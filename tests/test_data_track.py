@@ -1,20 +1,30 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+from typing import Any, cast
+from unittest import mock
 from uuid import UUID
 
 from sqlalchemy import text
 
+from acoustid.cache import TwoTierCache
 from acoustid.data.submission import insert_submission
 from acoustid.data.track import (
+    TrackMappingCache,
     can_add_fp_to_track,
     can_merge_tracks,
+    decode_track_mapping_cache_entry,
     disable_mbid,
+    encode_track_mapping_cache_entry,
+    insert_mbid,
     insert_track,
+    lookup_mbids,
+    lookup_meta_ids,
     merge_mbids,
     merge_missing_mbid,
     merge_tracks,
 )
+from acoustid.db import run_commit_callbacks, track_commits
 from acoustid.script import ScriptContext
 from tests import (
     TEST_1A_FP_RAW,
@@ -26,6 +36,7 @@ from tests import (
     prepare_database,
     with_script_context,
 )
+from tests.fakes import FakeRedis
 
 
 @with_script_context
@@ -281,6 +292,56 @@ INSERT INTO track_mbid (track_id, mbid, submission_count) VALUES (1, 'd575d506-4
     assert expected_rows == rows
 
 
+@with_script_context
+def test_track_mapping_cache_invalidated_after_commit(ctx: ScriptContext) -> None:
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    ingest_db = ctx.db.get_ingest_db()
+    two_tier_cache = mock.Mock()
+    cache = TrackMappingCache(two_tier_cache)
+
+    insert_mbid(
+        fingerprint_db,
+        ingest_db,
+        1,
+        "d575d506-4da4-11e0-b951-0025225356f3",
+        cache=cache,
+    )
+    assert not two_tier_cache.delete_many.called
+    ctx.db.session.rollback()
+    assert not two_tier_cache.delete_many.called
+
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    ingest_db = ctx.db.get_ingest_db()
+    insert_mbid(
+        fingerprint_db,
+        ingest_db,
+        1,
+        "d575d506-4da4-11e0-b951-0025225356f3",
+        cache=cache,
+    )
+    assert not two_tier_cache.delete_many.called
+    ctx.db.session.commit()
+    two_tier_cache.delete_many.assert_called_once_with(["mbids:1", "meta:1"])
+
+
+def test_track_mapping_cache_invalidate_after_commit() -> None:
+    two_tier_cache = mock.Mock()
+    cache = TrackMappingCache(two_tier_cache)
+    conn = cast(Any, mock.Mock())
+
+    # without anything tracking the commits, entries are deleted right away
+    cache.invalidate_after_commit(conn, [1])
+    assert two_tier_cache.delete_many.call_count == 1
+
+    with track_commits(conn) as callbacks:
+        cache.invalidate_after_commit(conn, [2])
+        assert two_tier_cache.delete_many.call_count == 1
+        run_commit_callbacks(callbacks)
+        two_tier_cache.delete_many.assert_called_with(["mbids:2", "meta:2"])
+        run_commit_callbacks(callbacks)
+        assert two_tier_cache.delete_many.call_count == 2
+
+
 @with_script_context
 def test_insert_track(ctx):
     # type: (ScriptContext) -> None
@@ -483,8 +544,11 @@ INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
             len3=TEST_2_LENGTH,
         ),
     )
-    groups = can_merge_tracks(ctx.db.get_fingerprint_db(), [1, 2, 3])
-    assert [set([1, 2])] == groups
+    for compare_in_app in (False, True):
+        groups = can_merge_tracks(
+            ctx.db.get_fingerprint_db(), [1, 2, 3], compare_in_app=compare_in_app
+        )
+        assert [set([1, 2])] == groups
 
 
 @with_script_context
@@ -498,15 +562,67 @@ INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
     """,
         dict(fp1=TEST_1A_FP_RAW, len1=TEST_1A_LENGTH),
     )
-    res = can_add_fp_to_track(
-        ctx.db.get_fingerprint_db(), 1, TEST_2_FP_RAW, TEST_2_LENGTH
-    )
-    assert res is False
-    res = can_add_fp_to_track(
-        ctx.db.get_fingerprint_db(), 1, TEST_1B_FP_RAW, TEST_1B_LENGTH + 20
-    )
-    assert res is False
-    res = can_add_fp_to_track(
-        ctx.db.get_fingerprint_db(), 1, TEST_1B_FP_RAW, TEST_1B_LENGTH
+    for compare_in_app in (False, True):
+        res = can_add_fp_to_track(
+            ctx.db.get_fingerprint_db(),
+            1,
+            TEST_2_FP_RAW,
+            TEST_2_LENGTH,
+            compare_in_app=compare_in_app,
+        )
+        assert res is False
+        res = can_add_fp_to_track(
+            ctx.db.get_fingerprint_db(),
+            1,
+            TEST_1B_FP_RAW,
+            TEST_1B_LENGTH + 20,
+            compare_in_app=compare_in_app,
+        )
+        assert res is False
+        res = can_add_fp_to_track(
+            ctx.db.get_fingerprint_db(),
+            1,
+            TEST_1B_FP_RAW,
+            TEST_1B_LENGTH,
+            compare_in_app=compare_in_app,
+        )
+        assert res is True
+
+
+def test_track_mapping_cache() -> None:
+    cache = TrackMappingCache(
+        TwoTierCache(
+            "track_mapping",
+            encode=encode_track_mapping_cache_entry,
+            decode=decode_track_mapping_cache_entry,
+            ttl=3600,
+            local_size=0,
+            redis=cast(Any, FakeRedis()),
+        )
     )
-    assert res is True
+    conn = cast(Any, None)
+    mbid = "77ef7468-e8f8-4b3e-93c5-a5a8b0a6ec4a"
+    with (
+        mock.patch(
+            "acoustid.data.track._lookup_mbids", return_value={1: [(mbid, 3)]}
+        ) as mock_lookup_mbids,
+        mock.patch(
+            "acoustid.data.track._lookup_meta_ids", return_value={1: [10, 11, 12]}
+        ) as mock_lookup_meta_ids,
+    ):
+        assert lookup_mbids(conn, [1, 2], cache=cache) == {1: [(mbid, 3)]}
+        assert lookup_mbids(conn, [1, 2], cache=cache) == {1: [(mbid, 3)]}
+        assert mock_lookup_mbids.call_count == 1
+
+        assert lookup_meta_ids(conn, [1], 3, cache=cache) == {1: [10, 11, 12]}
+        assert lookup_meta_ids(conn, [1], 2, cache=cache) == {1: [10, 11]}
+        assert mock_lookup_meta_ids.call_count == 1
+        # an entry loaded with a limit does not serve a higher one
+        lookup_meta_ids(conn, [1], None, cache=cache)
+        assert mock_lookup_meta_ids.call_count == 2
+
+        cache.invalidate([1])
+        lookup_mbids(conn, [1], cache=cache)
+        lookup_meta_ids(conn, [1], 2, cache=cache)
+        assert mock_lookup_mbids.call_count == 2
+        assert mock_lookup_meta_ids.call_count == 3
@@ -0,0 +1,32 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+
+from acoustid.deadline import Deadline
+
+
+def test_deadline_without_timeout() -> None:
+    deadline = Deadline()
+    assert deadline.remaining() is None
+    assert not deadline.expired()
+    assert deadline.timeout() is None
+    assert deadline.timeout(1.0) == 1.0
+
+
+def test_deadline() -> None:
+    deadline = Deadline(10.0)
+    remaining = deadline.remaining()
+    assert remaining is not None and 9.0 < remaining <= 10.0
+    assert not deadline.expired()
+    assert deadline.timeout(1.0) == 1.0
+    timeout = deadline.timeout(60.0)
+    assert timeout is not None and timeout <= 10.0
+
+
+def test_deadline_expired() -> None:
+    deadline = Deadline(0.001)
+    time.sleep(0.002)
+    assert deadline.expired()
+    assert deadline.remaining() == 0.0
+    assert deadline.timeout(1.0) == 0.0
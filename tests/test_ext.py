@@ -2,13 +2,17 @@ import array
 
 import pytest
 from acoustid_ext.fingerprint import (
+    compare_fingerprint,
+    compare_fingerprints,
     compute_shingled_simhashes,
     compute_simhash,
     decode_fingerprint,
     decode_postgres_array,
     encode_fingerprint,
+    extract_query,
 )
 
+from acoustid import const
 from tests import (
     TEST_1A_FP_RAW,
     TEST_1B_FP_RAW,
@@ -131,3 +135,60 @@ def test_decode_postgres_array() -> None:
 
     with pytest.raises(ValueError):
         decode_postgres_array("")
+
+
+def test_extract_query() -> None:
+    silence = 627964279
+    hashes = [silence] + [i << 4 for i in range(200)]
+    query = extract_query(hashes)
+    assert query.typecode == "I"
+    # the start is an index into the original hashes, silence included
+    assert query.tolist() == [i << 4 for i in range(79, 199)]
+
+    # short fingerprints move the start back to fill the query
+    assert extract_query([i << 4 for i in range(100)]).tolist() == [
+        i << 4 for i in range(100)
+    ]
+
+    # only the top 28 bits are used, and each term only once
+    assert extract_query([0x11, 0x12, 0x21, silence], size=10).tolist() == [
+        0x10,
+        0x20,
+    ]
+
+    assert extract_query([silence]).tolist() == []
+    assert extract_query([1, 2, 3], size=0).tolist() == []
+
+
+def test_extract_query_signed() -> None:
+    query = extract_query(TEST_1A_FP_RAW, signed=True)
+    assert query.typecode == "i"
+    assert len(query) == 120
+    unsigned_query = extract_query(array.array("i", TEST_1A_FP_RAW))
+    assert [q & 0xFFFFFFFF for q in query] == unsigned_query.tolist()
+
+
+def test_extract_query_invalid_type() -> None:
+    with pytest.raises(TypeError):
+        extract_query(array.array("h", [1, 2, 3]))
+
+
+def test_compare_fingerprint() -> None:
+    def compare(a: list[int], b: list[int]) -> float:
+        return compare_fingerprint(a, b, 80, signed=True)
+
+    assert compare(TEST_1A_FP_RAW, TEST_1A_FP_RAW) >= 1.0
+    assert compare(TEST_1A_FP_RAW, TEST_1B_FP_RAW) >= const.FINGERPRINT_MERGE_THRESHOLD
+    assert compare(TEST_1A_FP_RAW, TEST_1C_FP_RAW) >= const.TRACK_MERGE_THRESHOLD
+    assert compare(TEST_1A_FP_RAW, TEST_1D_FP_RAW) < const.TRACK_MERGE_THRESHOLD
+    assert compare(TEST_1A_FP_RAW, TEST_2_FP_RAW) < const.TRACK_MERGE_THRESHOLD
+    assert compare(TEST_1A_FP_RAW, []) == 0.0
+
+
+def test_compare_fingerprints() -> None:
+    candidates = [TEST_1B_FP_RAW, TEST_2_FP_RAW, TEST_1A_FP_RAW, TEST_1C_FP_RAW]
+    scores = compare_fingerprints(TEST_1A_FP_RAW, candidates, 80, signed=True)
+    assert scores.tolist() == [
+        compare_fingerprint(c, TEST_1A_FP_RAW, 80, signed=True) for c in candidates
+    ]
+    assert len(compare_fingerprints(TEST_1A_FP_RAW, [], 80, signed=True)) == 0
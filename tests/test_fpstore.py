@@ -0,0 +1,244 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import array
+import json
+import time
+
+import msgspec
+import pytest
+import requests
+
+from acoustid.circuitbreaker import CircuitOpenError
+from acoustid.config import FpstoreConfig
+from acoustid.deadline import Deadline
+from acoustid.fpstore import (
+    MIN_LATENCY_SAMPLES,
+    FpstoreClient,
+    FpstoreSearchResult,
+    encode_hashes,
+    to_unsigned_hashes,
+)
+from tests.fakes import FakeReplicasClient
+
+
+def create_client(**options: object) -> FpstoreClient:
+    cfg = FpstoreConfig()
+    cfg.host = "fpstore"
+    for name, value in options.items():
+        setattr(cfg, name, value)
+    return FpstoreClient(cfg)
+
+
+def create_response(content_type: str, content: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = content_type
+    response._content = content
+    return response
+
+
+def test_to_unsigned_hashes() -> None:
+    expected = array.array("I", [1, 0xFFFFFFFF, 0x80000000])
+    assert to_unsigned_hashes([1, -1, -0x80000000]) == expected
+    assert to_unsigned_hashes([1, 0xFFFFFFFF, 0x80000000]) == expected
+    assert to_unsigned_hashes(array.array("i", [1, -1, -0x80000000])) == expected
+    assert to_unsigned_hashes(expected) is expected
+
+
+def test_build_search_request_json() -> None:
+    with create_client() as client:
+        request = client._build_search_request(
+            client.replicas[0], [1, -1], 10, True, 0.5, 1.0
+        )
+    assert request.headers["Content-Type"] == "application/json"
+    assert json.loads(request.data) == {
+        "fingerprint": {"version": 1, "hashes": [1, 0xFFFFFFFF]},
+        "limit": 10,
+        "fast_mode": True,
+        "min_score": 0.5,
+    }
+
+
+def test_build_search_request_msgpack() -> None:
+    with create_client(encoding="msgpack", keep_alive=False) as client:
+        request = client._build_search_request(
+            client.replicas[0], [1, -1], 10, True, 0.5, 1.0
+        )
+    assert request.headers["Content-Type"] == "application/vnd.msgpack"
+    assert request.headers["Accept"] == "application/vnd.msgpack"
+    assert request.headers["Connection"] == "close"
+    body = msgspec.msgpack.decode(request.data)
+    hashes = body["fingerprint"]["hashes"]
+    assert hashes == b"\x01\x00\x00\x00\xff\xff\xff\xff"
+    assert hashes == encode_hashes(array.array("i", [1, -1]))
+
+
+def test_parse_search_response() -> None:
+    results = [{"id": "123", "score": 0.9}, {"id": 456, "score": 0.5}]
+    expected = [FpstoreSearchResult(123, 0.9), FpstoreSearchResult(456, 0.5)]
+    with create_client() as client:
+        response = create_response(
+            "application/json", json.dumps({"results": results}).encode()
+        )
+        assert client._parse_search_response(response) == expected
+        response = create_response(
+            "application/vnd.msgpack", msgspec.msgpack.encode({"results": results})
+        )
+        assert client._parse_search_response(response) == expected
+        response = create_response("application/json", b"{}")
+        assert client._parse_search_response(response) == []
+
+
+def test_pool_size() -> None:
+    with create_client(pool_size=50, pool_block=True) as client:
+        adapter = client.session.get_adapter("http://fpstore:4659/")
+        assert adapter._pool_maxsize == 50  # type: ignore[attr-defined]
+        assert adapter._pool_block is True  # type: ignore[attr-defined]
+
+
+def test_invalid_encoding() -> None:
+    with pytest.raises(ValueError):
+        create_client(encoding="xml")
+
+
+def create_replicas_client(**options: object) -> FakeReplicasClient:
+    cfg = FpstoreConfig()
+    cfg.replicas = ["a:1", "b:1"]
+    for name, value in options.items():
+        setattr(cfg, name, value)
+    return FakeReplicasClient(cfg)
+
+
+def test_replicas_from_config() -> None:
+    cfg = FpstoreConfig()
+    assert not cfg.is_enabled()
+    cfg.host = "fpstore"
+    cfg.replicas = ["a:1234", "b"]
+    assert cfg.get_replicas() == [("fpstore", 4659), ("a", 1234), ("b", 4659)]
+
+
+def test_search_round_robin() -> None:
+    with create_replicas_client() as client:
+        for i in range(4):
+            client.search([1])
+        assert client.calls == ["a:1", "b:1", "a:1", "b:1"]
+
+
+def test_search_hedged() -> None:
+    with create_replicas_client(eject_latency_factor=0) as client:
+        for replica in client.replicas:
+            replica.latencies.extend([0.001] * MIN_LATENCY_SAMPLES)
+        client.delays["a:1"] = 1.0
+        started = time.monotonic()
+        results = client.search([1])
+        assert time.monotonic() - started < 0.5
+        # b answered, a is still running
+        assert results == [FpstoreSearchResult(1, 1.0)]
+        assert client.calls == ["a:1", "b:1"]
+
+
+def test_search_hedged_within_timeout() -> None:
+    with create_replicas_client(eject_latency_factor=0) as client:
+        for replica in client.replicas:
+            replica.latencies.extend([0.001] * MIN_LATENCY_SAMPLES)
+        client.delays["a:1"] = 1.0
+        client.delays["b:1"] = 1.0
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            client.search([1], timeout=0.2)
+        assert time.monotonic() - started < 0.5
+        assert client.calls == ["a:1", "b:1"]
+        # the hedged search only gets what is left of the timeout
+        assert client.timeouts[0] == 0.2
+        assert client.timeouts[1] < 0.2
+
+
+def test_search_hedged_within_deadline() -> None:
+    with create_replicas_client(eject_latency_factor=0) as client:
+        for replica in client.replicas:
+            replica.latencies.extend([0.001] * MIN_LATENCY_SAMPLES)
+        client.delays["a:1"] = 1.0
+        client.delays["b:1"] = 1.0
+        deadline = Deadline(0.2)
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            client.search([1], timeout=5.0, deadline=deadline)
+        assert time.monotonic() - started < 0.5
+        assert client.timeouts[1] < 0.2
+
+
+def test_search_hedged_after_failure() -> None:
+    with create_replicas_client() as client:
+        for replica in client.replicas:
+            replica.latencies.extend([0.001] * MIN_LATENCY_SAMPLES)
+        client.failing.append("a:1")
+        assert client.search([1]) == [FpstoreSearchResult(1, 1.0)]
+
+
+def test_eject_failing_replica() -> None:
+    with create_replicas_client(hedge_percentile=0, eject_failures=2) as client:
+        client.failing.append("a:1")
+        for i in range(4):
+            try:
+                client.search([1])
+            except requests.ConnectionError:
+                pass
+        assert client.replicas[0].is_ejected(time.monotonic())
+        client.calls.clear()
+        client.search([1])
+        client.search([1])
+        assert client.calls == ["b:1", "b:1"]
+
+
+def test_eject_slow_replica() -> None:
+    with create_replicas_client(hedge_percentile=0) as client:
+        slow, fast = client.replicas
+        fast.latencies.extend([0.01] * MIN_LATENCY_SAMPLES)
+        for i in range(MIN_LATENCY_SAMPLES):
+            client._record_success(slow, 0.05)
+        assert slow.is_ejected(time.monotonic())
+        # the other one stays, even when it gets slow as well
+        for i in range(MIN_LATENCY_SAMPLES):
+            client._record_success(fast, 1.0)
+        assert not fast.is_ejected(time.monotonic())
+
+
+def test_search_past_deadline() -> None:
+    with create_replicas_client() as client:
+        deadline = Deadline(0.001)
+        time.sleep(0.002)
+        with pytest.raises(TimeoutError):
+            client.search([1], deadline=deadline)
+        assert client.calls == []
+
+
+def test_search_deadline_timeouts_are_not_failures() -> None:
+    with create_replicas_client(
+        hedge_percentile=0, breaker_failures=1, eject_failures=1
+    ) as client:
+        client.timing_out.extend(["a:1", "b:1"])
+        for i in range(2):
+            with pytest.raises(TimeoutError):
+                client.search([1], timeout=5.0, deadline=Deadline(1.0))
+        # the deadline cut the timeout short, that is not the store's fault
+        assert client.breaker.allow()
+        assert not any(r.is_ejected(time.monotonic()) for r in client.replicas)
+
+        with pytest.raises(TimeoutError):
+            client.search([1], timeout=5.0)
+        assert client.replicas[0].is_ejected(time.monotonic())
+        with pytest.raises(CircuitOpenError):
+            client.search([1], timeout=5.0)
+
+
+def test_search_circuit_breaker() -> None:
+    with create_replicas_client(breaker_failures=2, eject_failures=0) as client:
+        client.failing.extend(["a:1", "b:1"])
+        for i in range(2):
+            with pytest.raises(requests.ConnectionError):
+                client.search([1])
+        client.calls.clear()
+        with pytest.raises(CircuitOpenError):
+            client.search([1])
+        assert client.calls == []
@@ -5,10 +5,18 @@ import errno
 import socket
 import threading
 from typing import Iterator
+from unittest import mock
 
 import pytest
 
-from acoustid.indexclient import CRLF, IndexClient, IndexClientError, IndexClientPool
+from acoustid.circuitbreaker import CircuitBreaker
+from acoustid.indexclient import (
+    CRLF,
+    IndexClient,
+    IndexClientError,
+    IndexClientPool,
+    IndexClientUnavailableError,
+)
 
 
 class FakeIndexServer(object):
@@ -302,3 +310,37 @@ def test_pool_is_safe_under_concurrent_use(index_server: FakeIndexServer) -> Non
     assert errors == []
     assert len(pool.clients) <= pool.max_idle_clients
     pool.dispose()
+
+
+def test_pool_circuit_breaker(index_server: FakeIndexServer) -> None:
+    """Once the breaker opens, connect() fails without touching the network."""
+    breaker = CircuitBreaker("index", failure_threshold=2, reset_timeout=60.0)
+    host, port = index_server.host, index_server.port
+    index_server.close()
+    pool = IndexClientPool(host=host, port=port, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(IndexClientError):
+            pool.connect()
+
+    with mock.patch("acoustid.indexclient.IndexClient") as client_class:
+        with pytest.raises(IndexClientUnavailableError):
+            pool.connect()
+        client_class.assert_not_called()
+
+
+def test_pool_circuit_breaker_counts_searches(index_server: FakeIndexServer) -> None:
+    breaker = CircuitBreaker("index", failure_threshold=1, reset_timeout=60.0)
+    pool = IndexClientPool(
+        host=index_server.host, port=index_server.port, breaker=breaker
+    )
+    with pytest.raises(IndexClientError):
+        with pool.connect() as index:
+            assert index._client.sock is not None
+            index._client.sock = FailingSocket(  # type: ignore[assignment]
+                index._client.sock, BrokenPipeError(32, "Broken pipe"), "sendall"
+            )
+            index.search([1, 2, 3])
+    with pytest.raises(IndexClientUnavailableError):
+        pool.connect()
+    pool.dispose()
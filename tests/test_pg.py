@@ -1,6 +1,8 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import pytest
+from acoustid_ext.fingerprint import compare_fingerprint, extract_query
 from sqlalchemy import sql
 
 from acoustid import const
@@ -2426,3 +2428,45 @@ def test_match_different(ctx):
     query = sql.select(sql.func.acoustid_compare2(TEST_1A_FP_RAW, TEST_2_FP_RAW, 80))
     score = ctx.db.get_fingerprint_db().execute(query).scalar_one()
     assert score < const.TRACK_MERGE_THRESHOLD
+
+
+@with_script_context
+def test_extract_query(ctx):
+    # type: (ScriptContext) -> None
+    fingerprints = [
+        TEST_1A_FP_RAW,
+        TEST_1B_FP_RAW,
+        TEST_1C_FP_RAW,
+        TEST_1D_FP_RAW,
+        TEST_2_FP_RAW,
+        TEST_1A_FP_RAW[:50],
+        [627964279] * 10 + TEST_2_FP_RAW[:130],
+        [627964279],
+        [],
+    ]
+    for fp in fingerprints:
+        query = sql.select(sql.func.acoustid_extract_query(fp))
+        expected = ctx.db.get_fingerprint_db().execute(query).scalar_one()
+        assert extract_query(fp, signed=True).tolist() == expected
+
+
+@with_script_context
+def test_compare_fingerprint(ctx):
+    # type: (ScriptContext) -> None
+    fingerprints = [
+        TEST_1A_FP_RAW,
+        TEST_1B_FP_RAW,
+        TEST_1C_FP_RAW,
+        TEST_1D_FP_RAW,
+        TEST_2_FP_RAW,
+        TEST_1B_FP_RAW[100:],
+    ]
+    for fp1 in fingerprints:
+        for fp2 in fingerprints:
+            for max_offset in (0, 80):
+                query = sql.select(
+                    sql.func.acoustid_compare2(fp1, fp2, max_offset).label("score")
+                )
+                expected = ctx.db.get_fingerprint_db().execute(query).scalar_one()
+                score = compare_fingerprint(fp1, fp2, max_offset, signed=True)
+                assert score == pytest.approx(expected, abs=1e-6)
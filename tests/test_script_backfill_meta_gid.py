@@ -2,9 +2,11 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import uuid
+from unittest import mock
 
 from acoustid import tables
 from acoustid.data.submission import import_submission, insert_submission
+from acoustid.data.track import TrackMappingCache
 from acoustid.script import ScriptContext
 from acoustid.scripts.backfill_meta_gid import (
     backfill_meta_gid,
@@ -155,8 +157,12 @@ def test_backfill_meta_gid_merge(ctx: ScriptContext) -> None:
     )
     assert fingerprint is not None
 
-    last_meta_id = backfill_meta_gid(fingerprint_db, ingest_db, 0, 100)
+    cache = mock.Mock(spec=TrackMappingCache)
+    last_meta_id = backfill_meta_gid(fingerprint_db, ingest_db, 0, 100, cache=cache)
     assert 4 == last_meta_id
+    cache.invalidate_after_commit.assert_called_once_with(
+        fingerprint_db, [fingerprint["track_id"]]
+    )
 
     query = tables.track_meta.select().where(
         tables.track_meta.c.track_id == fingerprint["track_id"]
@@ -0,0 +1,61 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import datetime
+
+from acoustid import tables as schema
+from acoustid.data.musicbrainz import (
+    build_recording_documents,
+    load_recording_documents,
+    save_recording_documents,
+)
+from acoustid.script import ScriptContext
+from acoustid.scripts.build_recording_documents import (
+    REFRESH_AGE,
+    build_documents,
+    find_stale_documents,
+)
+from tests import with_script_context
+from tests.test_data_musicbrainz import (
+    RECORDING_1,
+    RECORDING_2,
+    insert_artist_credit,
+    insert_isrc,
+    insert_recording,
+)
+
+
+@with_script_context
+def test_stale_documents_are_rebuilt(ctx: ScriptContext) -> None:
+    musicbrainz_db = ctx.db.get_musicbrainz_db()
+    fingerprint_db = ctx.db.get_fingerprint_db()
+    ac = insert_artist_credit(musicbrainz_db)
+    id1 = insert_recording(musicbrainz_db, RECORDING_1, "Track One", ac)
+    insert_isrc(musicbrainz_db, id1, "GBAYE0601498")
+    insert_recording(musicbrainz_db, RECORDING_2, "Track Two", ac)
+
+    replication_date = datetime.datetime(2026, 1, 10, tzinfo=datetime.timezone.utc)
+    old_replication_date = replication_date - REFRESH_AGE * 2
+    documents = build_recording_documents(musicbrainz_db, [RECORDING_1])
+    save_recording_documents(fingerprint_db, documents, old_replication_date)
+    documents = build_recording_documents(musicbrainz_db, [RECORDING_2])
+    save_recording_documents(fingerprint_db, documents, replication_date)
+
+    # deleted ISRCs leave no trace in MusicBrainz, only a rebuild drops them
+    musicbrainz_db.execute(schema.mb_isrc.delete())
+
+    # the old document is past the maximum age and not used anymore
+    documents = load_recording_documents(
+        fingerprint_db, [RECORDING_1, RECORDING_2], replication_date
+    )
+    assert list(documents) == [RECORDING_2]
+
+    recording_ids = find_stale_documents(fingerprint_db, replication_date, 10)
+    assert recording_ids == [RECORDING_1]
+    build_documents(ctx, musicbrainz_db, recording_ids, replication_date)
+    assert find_stale_documents(fingerprint_db, replication_date, 10) == []
+
+    documents = load_recording_documents(
+        fingerprint_db, [RECORDING_1], replication_date
+    )
+    assert documents[RECORDING_1]["recording"]["recording_isrcs"] == []
@@ -3,12 +3,16 @@
 
 import gzip
 import wsgiref.util
-from typing import TYPE_CHECKING, Any, Callable, List, Tuple
+from typing import TYPE_CHECKING, Any, Callable, Iterator, List, Optional, Tuple
 
+import zstd
 from six import BytesIO
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from werkzeug.wrappers import Response
 
 from acoustid.server import (
     GzipRequestMiddleware,
+    ResponseCompressionMiddleware,
     add_cors_headers,
     replace_double_slashes,
 )
@@ -88,3 +92,77 @@ def test_add_cors_headers():
     wsgiref.util.setup_testing_defaults(environ)
     mw = add_cors_headers(app)
     mw(environ, start_response)
+
+
+def run_compression_middleware(response, accept_encoding=None, zstd_level=0):
+    # type: (Response, Optional[str], int) -> Tuple[str, Any, List[bytes]]
+    headers = []
+    if accept_encoding is not None:
+        headers.append(("Accept-Encoding", accept_encoding))
+    environ = EnvironBuilder(headers=headers).get_environ()
+    mw = ResponseCompressionMiddleware(response, min_size=100, zstd_level=zstd_level)
+    app_iter, status, response_headers = run_wsgi_app(mw, environ)
+    return status, response_headers, list(app_iter)
+
+
+def test_response_compression_gzip():
+    # type: () -> None
+    data = b'{"status": "ok"}' * 100
+    response = Response(data, content_type="application/json")
+    status, headers, chunks = run_compression_middleware(response, "gzip, deflate")
+    assert status == "200 OK"
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept-Encoding"
+    body = b"".join(chunks)
+    assert headers["Content-Length"] == str(len(body))
+    assert gzip.decompress(body) == data
+
+
+def test_response_compression_gzip_stream():
+    # type: () -> None
+    def generate():
+        # type: () -> Iterator[bytes]
+        for i in range(1000):
+            yield b"<result><id>%d</id></result>" % i
+
+    response = Response(generate(), content_type="text/xml; charset=UTF-8")
+    status, headers, chunks = run_compression_middleware(response, "gzip")
+    assert headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in headers
+    assert gzip.decompress(b"".join(chunks)) == b"".join(generate())
+
+
+def test_response_compression_zstd():
+    # type: () -> None
+    data = b'{"status": "ok"}' * 100
+    response = Response(data, content_type="application/json")
+    status, headers, chunks = run_compression_middleware(
+        response, "gzip, zstd", zstd_level=3
+    )
+    assert headers["Content-Encoding"] == "zstd"
+    assert zstd.decompress(b"".join(chunks)) == data
+
+    status, headers, chunks = run_compression_middleware(response, "gzip, zstd")
+    assert headers["Content-Encoding"] == "gzip"
+
+
+def test_response_compression_skipped():
+    # type: () -> None
+    small = Response(b'{"status": "ok"}', content_type="application/json")
+    status, headers, chunks = run_compression_middleware(small, "gzip")
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+    assert chunks == [b'{"status": "ok"}']
+
+    data = b'{"status": "ok"}' * 100
+    response = Response(data, content_type="application/json")
+    status, headers, chunks = run_compression_middleware(response)
+    assert "Content-Encoding" not in headers
+    assert headers["Vary"] == "Accept-Encoding"
+    assert b"".join(chunks) == data
+
+    binary = Response(data, content_type="application/octet-stream")
+    status, headers, chunks = run_compression_middleware(binary, "gzip")
+    assert "Content-Encoding" not in headers
+    assert "Vary" not in headers
+    assert b"".join(chunks) == data
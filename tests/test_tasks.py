@@ -0,0 +1,27 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+from typing import Any, cast
+
+from acoustid.tasks import dequeue_task, enqueue_task
+from tests.fakes import FakeTaskContext
+
+
+def test_enqueue_task_dedup() -> None:
+    ctx = FakeTaskContext()
+    task_ctx = cast(Any, ctx)
+    assert enqueue_task(task_ctx, "merge_missing_mbid", {"mbid": "a"}, dedup_ttl=60)
+    assert not enqueue_task(task_ctx, "merge_missing_mbid", {"mbid": "a"}, dedup_ttl=60)
+    assert enqueue_task(task_ctx, "merge_missing_mbid", {"mbid": "b"}, dedup_ttl=60)
+    assert sum(len(items) for items in ctx.redis.lists.values()) == 2
+    assert ctx.statsd.counters["tasks_deduplicated_total,task=merge_missing_mbid"] == 1
+
+    # without dedup_ttl, every call is enqueued
+    assert enqueue_task(task_ctx, "merge_missing_mbid", {"mbid": "a"})
+    assert sum(len(items) for items in ctx.redis.lists.values()) == 3
+
+    names = set()
+    for i in range(3):
+        name, kwargs = dequeue_task(task_ctx, timeout=10)
+        names.add((name, kwargs["mbid"]))
+    assert names == {("merge_missing_mbid", "a"), ("merge_missing_mbid", "b")}
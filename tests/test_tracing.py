@@ -0,0 +1,99 @@
+# Copyright (C) 2026 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import contextvars
+import logging
+from typing import Any, Tuple, cast
+from unittest import mock
+
+from acoustid.api.v2 import APIHandler, LookupHandlerParams
+from acoustid.tracing import get_spans, initialize_spans, span
+from tests.fakes import FakeStatsClient
+
+
+def test_span_without_collection() -> None:
+    def run() -> None:
+        with span("search"):
+            pass
+        assert get_spans() is None
+
+    contextvars.copy_context().run(run)
+
+
+def test_span_accumulates() -> None:
+    def run() -> None:
+        stages = initialize_spans()
+        with span("search"):
+            with span("compare"):
+                pass
+        with span("search"):
+            pass
+        assert stages is get_spans()
+        assert set(stages) == {"search", "compare"}
+        assert stages["search"] >= stages["compare"] >= 0
+
+    contextvars.copy_context().run(run)
+
+
+def test_span_on_exception() -> None:
+    def run() -> None:
+        stages = initialize_spans()
+        try:
+            with span("search"):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert "search" in stages
+
+    contextvars.copy_context().run(run)
+
+
+def make_handler(slow_request_threshold: float) -> Tuple[APIHandler, FakeStatsClient]:
+    handler = cast(APIHandler, APIHandler.__new__(APIHandler))
+    statsd = FakeStatsClient()
+    handler.ctx = mock.MagicMock()
+    handler.ctx.statsd = statsd
+    handler.ctx.config.website.slow_request_threshold = slow_request_threshold
+    return handler, statsd
+
+
+def test_report_spans(caplog: Any) -> None:
+    handler, statsd = make_handler(1.0)
+    params = LookupHandlerParams(handler.ctx.config)
+    params.meta = ["releases", "recordings", "bogus"]
+
+    def run() -> None:
+        stages = initialize_spans()
+        stages["search"] = 0.25
+        with caplog.at_level(logging.WARNING):
+            handler._report_spans("lookup", params, 0.5)
+
+    contextvars.copy_context().run(run)
+
+    assert statsd.timings == [
+        (
+            "api.stage_duration_seconds,request=lookup,meta=recordings+releases,stage=search",
+            250.0,
+        )
+    ]
+    assert not caplog.records
+
+
+def test_report_spans_slow_request(caplog: Any) -> None:
+    handler, statsd = make_handler(1.0)
+    params = LookupHandlerParams(handler.ctx.config)
+
+    def run() -> None:
+        stages = initialize_spans()
+        stages["search"] = 1.5
+        with caplog.at_level(logging.WARNING):
+            handler._report_spans("lookup", params, 2.0)
+
+    contextvars.copy_context().run(run)
+
+    assert statsd.timings == [
+        ("api.stage_duration_seconds,request=lookup,meta=none,stage=search", 1500.0)
+    ]
+    assert len(caplog.records) == 1
+    assert caplog.records[0].getMessage() == "Slow lookup request took 2.000 seconds"
+    assert caplog.records[0].stages == {"search": 1.5}